@@ -0,0 +1,39 @@
+"""Measures onion address validation for a 100k address contact list import.
+
+Run from the repository root:
+    python -m benchmarks.bench_address [addresses]
+"""
+import sys
+import time
+
+import config
+import core.utils
+from tests.helpers import make_address
+
+
+def bench(name: str, function, addresses: list):
+    start = time.perf_counter()
+    result = function(addresses)
+    elapsed = time.perf_counter() - start
+    valid = sum(result.values())
+    print(f'{name:>28}: {len(addresses) / elapsed:12,.0f} addresses/s ({valid} valid)')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    addresses = [make_address() for _ in range(count)]
+    # a ping flood: same length, but wrong checksum
+    fakes = [address[:-2] + ('aa' if address[-2:] != 'aa' else 'bb') for address in addresses]
+
+    core.utils.valid_address_cache.clear()
+    bench('uncached (check_address)', lambda a: {x: core.utils.check_address(x) for x in a}, addresses)
+    bench('first import', core.utils.validate_addresses, addresses)
+    # only the most recent VALID_ADDRESS_CACHE_SIZE addresses are still cached
+    bench('recheck known (cached)', core.utils.validate_addresses,
+          addresses[-config.VALID_ADDRESS_CACHE_SIZE:])
+    bench('fake addresses', core.utils.validate_addresses, fakes)
+    print(f'cache holds {len(core.utils.valid_address_cache)} addresses')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Measures encode_lf/decode_lf throughput and checks the round trip.
+
+Run from the repository root:
+    python -m benchmarks.bench_codec [megabytes]
+"""
+import os
+import random
+import sys
+import time
+
+from core.protocol import encode_lf, decode_lf
+
+
+def check_round_trip(samples: int = 100000):
+    # short random blobs made of the bytes the escaping cares about
+    alphabet = b'\\\n/nx'
+    for _ in range(samples):
+        blob = bytes(random.choice(alphabet) for _ in range(random.randint(0, 16)))
+        encoded = encode_lf(blob)
+        assert b'\n' not in encoded, blob
+        assert decode_lf(encoded) == blob, blob
+    print(f'round trip ok for {samples} random blobs')
+
+
+def bench(name: str, blob: bytes, rounds: int = 5):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        encoded = encode_lf(blob)
+    encode_time = (time.perf_counter() - start) / rounds
+    start = time.perf_counter()
+    for _ in range(rounds):
+        decoded = decode_lf(encoded)
+    decode_time = (time.perf_counter() - start) / rounds
+    assert decoded == blob
+    size = len(blob) / 2 ** 20
+    print(f'{name:>16}: encode {size / encode_time:8.1f} MiB/s, decode {size / decode_time:8.1f} MiB/s')
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    check_round_trip()
+    size = megabytes * 2 ** 20
+    bench('text', (b'Hello, World! ' * (size // 14 + 1))[:size])
+    bench('random binary', os.urandom(size))
+    bench('worst case', (b'\\\n' * (size // 2 + 1))[:size])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Measures what compressing binary frames saves and what it costs.
+
+Chat messages go through the deflate context of the connection, file
+blocks are compressed one by one. Every payload is encoded by a
+core.compression.Compressor, decoded by a FrameDecoder and compared with
+sending the same messages uncompressed. Tor circuits rarely carry more than
+a few MiB/s, so compression pays off as long as it is much faster than that.
+
+Run from the repository root:
+    python -m benchmarks.bench_compression [messages]
+"""
+import copy
+import hashlib
+import os
+import random
+import sys
+import time
+
+import config
+import core.compression
+import core.framing
+import core.protocol
+
+WORDS = ('hello how are you doing today the meeting is at five o clock see you there '
+         'did you get the file I sent yesterday yes thanks it works fine now').split()
+
+
+def text(size: int, rng: random.Random) -> bytes:
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words).encode('ascii')[:size]
+
+
+def file_blocks(data: bytes) -> list:
+    messages = []
+    for start in range(0, len(data), config.FILE_BLOCK_SIZE):
+        block = data[start:start + config.FILE_BLOCK_SIZE]
+        header = b'0123456789abcdef %d %s ' % (start, hashlib.md5(block).hexdigest().encode('ascii'))
+        message = core.protocol.ProtocolFiledata(blob=header + block)
+        message.stream = '0123456789abcdef'
+        messages.append(message)
+    return messages
+
+
+def run(messages: list, features: set | None) -> tuple[int, float, float]:
+    """Returns the bytes on the wire and the CPU seconds to encode and to decode."""
+    compressor = core.compression.Compressor(features) if features else None
+    start = time.process_time()
+    frames = [compressor.encode(message) if compressor else message.get_frame() for message in messages]
+    encode_time = time.process_time() - start
+    stream = b''.join(frames)
+
+    decoder = core.framing.FrameDecoder()
+    start = time.process_time()
+    received = []
+    for position in range(0, len(stream), 65536):
+        received += decoder.feed(stream[position:position + 65536])
+    decode_time = time.process_time() - start
+    assert [frame.payload for frame in received] == [message.blob for message in messages]
+    return len(stream), encode_time, decode_time
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rng = random.Random(1)
+    config.ini = copy.deepcopy(config.config_defaults)
+    size = count * config.FILE_BLOCK_SIZE // 50
+    payloads = {
+        'chat messages': [core.protocol.ProtocolNotImplemented(blob=text(rng.randint(260, 600), rng))
+                          for _ in range(count)],
+        'text file': file_blocks(text(size, rng)),
+        'random file': file_blocks(os.urandom(size)),
+    }
+    variants = {
+        'uncompressed': ('zlib', None),
+        'deflate': ('zlib', {b'binary', b'deflate'}),
+        'lzma': ('lzma', {b'binary', b'deflate', b'lzma'}),
+    }
+    for name, messages in payloads.items():
+        raw = sum(len(message.blob) for message in messages)
+        for variant, (algorithm, features) in variants.items():
+            if variant == 'lzma' and name == 'chat messages':
+                continue  # chat always uses the deflate context
+            config.ini['compression']['algorithm'] = algorithm
+            before = core.compression.get_stats()
+            wire, encode_time, decode_time = run(messages, features)
+            after = core.compression.get_stats()
+            skipped = after['skipped_bytes'] - before['skipped_bytes']
+            cpu = encode_time + decode_time
+            label = f'{name} ({variant})'
+            print(f'{label:>28}: {wire / raw * 100:6.1f} % on the wire, '
+                  f'encode {raw / max(encode_time, 1e-9) / 1024 / 1024:8.1f} MiB/s, '
+                  f'decode {raw / max(decode_time, 1e-9) / 1024 / 1024:8.1f} MiB/s, '
+                  f'{cpu / len(messages) * 1e6:8.1f} us CPU/message'
+                  + (f', {skipped / raw * 100:.0f} % skipped as incompressible' if skipped else ''))
+    stats = core.compression.get_stats()
+    print(f'{"total":>28}: {stats["bytes_saved"] / 1024 / 1024:.1f} MiB saved for '
+          f'{stats["compress_seconds"]:.2f} s compressing, {stats["decompress_seconds"]:.2f} s decompressing')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Measures switching the chat list group/status filter with many buddies.
+
+Run from the repository root:
+    python -m benchmarks.bench_contacts [buddies]
+"""
+import random
+import sys
+import time
+
+import config
+import core.contacts
+
+
+def make_store(count: int) -> core.contacts.ContactStore:
+    statuses = [config.STATUS_OFFLINE, config.STATUS_ONLINE, config.STATUS_AWAY, config.STATUS_XA]
+    return core.contacts.ContactStore({
+        'id': str(i), 'position': i, 'icon': config.Gui.ICON_APP, 'name': f'Buddy {i}',
+        'message': '', 'group': random.randint(1, 3), 'status': random.choice(statuses),
+    } for i in range(count))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    store = make_store(count)
+    filters = [(group, status) for group in range(4)
+               for status in (config.STATUS_ALL, config.STATUS_ONLINE, config.STATUS_OFFLINE)]
+
+    for name in ('first switch', 'cached switch'):
+        times = []
+        for group, status in filters:
+            start = time.perf_counter()
+            buddies = store.get(group, status)
+            for buddy in buddies:
+                core.contacts.get_icon(buddy['icon'])
+            times.append(time.perf_counter() - start)
+        print(f'{name:>22}: worst {max(times) * 1000:7.3f} ms, mean {sum(times) / len(times) * 1000:7.3f} ms')
+
+    start = time.perf_counter()
+    store.update('0', status=config.STATUS_OFFLINE)
+    store.get(0, config.STATUS_ALL)
+    print(f'{"status change + redraw":>22}: {(time.perf_counter() - start) * 1000:7.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""Measures a headless daemon that keeps thousands of buddies connected.
+
+The daemon runs in this process with a temporary profile. A peer process
+stands in for the network: it is the SOCKS proxy (Tor) that grants every
+outgoing connect and keeps the connection open, and it opens as many
+incoming connections. The buddies are added through the control socket.
+Reported are the threads and the memory of the daemon and the round trip
+of control requests while all connections are open.
+
+Run from the repository root:
+    python -m benchmarks.bench_daemon [buddies]
+"""
+import asyncio
+import contextlib
+import copy
+import io
+import json
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import config
+import core.daemon
+from tests.helpers import make_address
+
+REQUESTS = 200
+
+
+def rss() -> int:
+    """Returns the resident memory of this process in bytes."""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Client:
+    """A control socket client."""
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(str(path))
+        self.file = self.socket.makefile('rb')
+        self.next_id = 0
+
+    def request(self, command: str, **arguments):
+        self.next_id += 1
+        line = json.dumps({'id': self.next_id, 'command': command, **arguments}).encode('utf-8') + b'\n'
+        self.socket.sendall(line)
+        response = json.loads(self.file.readline())
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response['result']
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+async def peer(count: int):
+    """The other end of all connections, runs in its own process."""
+    connections = []
+
+    async def on_socks(reader, writer):
+        try:
+            await reader.readexactly(8)
+            await reader.readuntil(b'\x00')  # user id
+            await reader.readuntil(b'\x00')  # hostname
+            writer.write(b'\x00\x5a' + bytes(6))
+            connections.append(writer)
+            while await reader.read(65536):
+                pass
+        except (asyncio.CancelledError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+    server = await asyncio.start_server(on_socks, '127.0.0.1', 0, backlog=1024)
+    print(server.sockets[0].getsockname()[1], flush=True)
+    loop = asyncio.get_running_loop()
+    listen_port = int(await loop.run_in_executor(None, sys.stdin.readline))
+    for first in range(0, count, 256):
+        opened = await asyncio.gather(*(asyncio.open_connection('127.0.0.1', listen_port)
+                                        for _ in range(first, min(count, first + 256))))
+        connections.extend(writer for _, writer in opened)
+    print('ready', flush=True)
+    await loop.run_in_executor(None, sys.stdin.read)
+
+
+def wait_for(client: Client, check, timeout: float = 60) -> float:
+    start = time.perf_counter()
+    while not check(client.request('status')):
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError('the connections were not established')
+        time.sleep(0.05)
+    return time.perf_counter() - start
+
+
+def latency(client: Client, command: str) -> tuple[float, float]:
+    times = []
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        client.request(command)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.99)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    out = sys.stdout
+
+    proc = subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_daemon', '--peer', str(count)],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    config.ini = copy.deepcopy(config.config_defaults)
+    config.ini['tor']['socks_port'] = int(proc.stdout.readline())
+    config.ini['client']['listen_backlog'] = 1024
+    config.ini['limits']['max_unauthenticated_connections'] = count + 16
+    config.ini['connections']['max_connecting'] = 64
+    listen_socket = socket.socket()
+    listen_socket.bind(('127.0.0.1', 0))
+
+    threads_before = threading.active_count()
+    rss_before = rss()
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        daemon = core.daemon.Daemon(os.path.join(directory, 'control.sock'), os.path.join(directory, 'profile'),
+                                    listen_socket, os.path.join(directory, 'identities'))
+        daemon.start()
+        client = Client(daemon.socket_path)
+        try:
+            rss_started = rss()
+            start = time.perf_counter()
+            client.request('add_buddies', buddies=[{'address': make_address()} for _ in range(count)])
+            added = time.perf_counter() - start
+            outgoing = wait_for(client, lambda status: status['outgoing']['connected'] == count)
+            proc.stdin.write(f'{listen_socket.getsockname()[1]}\n')
+            proc.stdin.flush()
+            proc.stdout.readline()
+            incoming = wait_for(client, lambda status: status['incoming_connections'] == count)
+            status = client.request('status')
+            rss_connected = rss()
+            status_latency = latency(client, 'status')
+            buddies_latency = latency(client, 'buddies')
+        finally:
+            client.close()
+            proc.stdin.close()
+            proc.wait()
+            # the incoming connections close in the event loop, not while printing the results
+            deadline = time.monotonic() + 10
+            while daemon.bl.get_stats()['incoming'] and time.monotonic() < deadline:
+                time.sleep(0.05)
+            daemon.stop()
+
+    print(f'add_buddies: {count} buddies added in {added * 1000:.0f} ms', file=out)
+    print(f'connections: {count} outgoing after {outgoing:.2f} s, {count} incoming after {incoming:.2f} s',
+          file=out)
+    print(f'threads: {threads_before} before, {status["threads"]} with {2 * count} connections', file=out)
+    print(f'memory: {(rss_started - rss_before) / 2 ** 20:.1f} MiB to start, '
+          f'{(rss_connected - rss_started) / count / 1024:.1f} KiB per buddy', file=out)
+    for command, (median, p99) in (('status', status_latency), ('buddies', buddies_latency)):
+        print(f'{command:>11}: median {median * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms per request', file=out)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--peer':
+        asyncio.run(peer(int(sys.argv[2])))
+    else:
+        main()
@@ -0,0 +1,149 @@
+"""Measures file transfer throughput and memory over local TCP connections.
+
+Two loopback connections stand in for the two Tor connections between
+buddies: the file data goes one way, the acknowledgements the other way.
+Both are compared with sending the raw file over a plain socket, once with
+TorChat lines and once after the features message switched to binary frames.
+
+Run from the repository root:
+    python -m benchmarks.bench_filetransfer [megabytes]
+"""
+import asyncio
+import copy
+import hashlib
+import os
+import pathlib
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import config
+import core.events
+import core.filetransfer
+import core.framing
+import core.protocol
+import core.transport
+
+
+class Buddy:
+    def __init__(self, address: str):
+        self.address = address
+        self.conn_out = None
+
+
+class Pipe(core.transport.Connection):
+    """One direction: the send path of core.transport on one end, a line reader on the other."""
+    def __init__(self, sender_buddy, receiver_buddy):
+        core.transport.Connection.__init__(self, None, core.transport.get_event_loop())
+        self.buddy = receiver_buddy  # the buddy who sent what the reader receives
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.out_socket = socket.create_connection(listener.getsockname())
+        self.in_socket, _ = listener.accept()
+        listener.close()
+        self.loop.submit(self.open()).result()
+        sender_buddy.conn_out = self
+        threading.Thread(target=self.read, daemon=True).start()
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(sock=self.out_socket)
+        self.started = True
+        self.start_sending()
+
+    def on_line(self, line):
+        core.protocol.protocol_msg_from_item(None, self, line).execute()
+
+    def read(self):
+        decoder = core.framing.WireDecoder()
+        while True:
+            data = self.in_socket.recv(262144)
+            if not data:
+                break
+            for line in decoder.feed(data):
+                self.on_line(line)
+
+
+def file_md5(path) -> str:
+    digest = hashlib.md5()
+    with open(path, 'rb') as file:
+        while block := file.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def raw_throughput(path, size: int) -> float:
+    listener = socket.create_server(('127.0.0.1', 0))
+    out_socket = socket.create_connection(listener.getsockname())
+    in_socket, _ = listener.accept()
+    listener.close()
+
+    def drain():
+        received = 0
+        while received < size:
+            received += len(in_socket.recv(262144))
+
+    reader = threading.Thread(target=drain)
+    start = time.perf_counter()
+    reader.start()
+    with open(path, 'rb') as file:
+        while block := file.read(config.FILE_BLOCK_SIZE):
+            out_socket.sendall(block)
+    reader.join()
+    elapsed = time.perf_counter() - start
+    out_socket.close()
+    in_socket.close()
+    return size / elapsed
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    size = megabytes * 1024 * 1024
+    with tempfile.TemporaryDirectory() as directory:
+        config.ini = copy.deepcopy(config.config_defaults)
+        config.ini['files']['temp_files_custom_dir'] = directory + '/in'
+        path = directory + '/random.bin'
+        with open(path, 'wb') as file:
+            for _ in range(megabytes):
+                file.write(os.urandom(1024 * 1024))
+        source_md5 = file_md5(path)
+
+        raw = raw_throughput(path, size)
+        print(f'{"raw socket":>22}: {raw / 1024 / 1024:8.1f} MiB/s')
+
+        for binary in (False, True):
+            alice, bob = Buddy('alice'), Buddy('bob')  # each as seen by the other
+            Pipe(bob, alice)  # alice -> bob, read by bob, sent by alice
+            Pipe(alice, bob)  # bob -> alice
+            if binary:
+                core.protocol.send_features(alice)
+                core.protocol.send_features(bob)
+                time.sleep(0.1)
+            done = threading.Event()
+            callback = (lambda _: done.set() if not core.filetransfer.receivers
+                        and not core.filetransfer.senders else None)
+            core.events.subscribe(core.events.TRANSFERS_CHANGED, callback)
+
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.perf_counter()
+            sender = core.filetransfer.FileSender(bob, path)
+            done.wait()
+            elapsed = time.perf_counter() - start
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            core.events.unsubscribe(core.events.TRANSFERS_CHANGED, callback)
+
+            received = pathlib.Path(directory, 'in', 'random.bin')
+            name = 'binary frames' if binary else 'torchat lines'
+            print(f'{name:>22}: {size / elapsed / 1024 / 1024:8.1f} MiB/s '
+                  f'({size / elapsed / raw * 100:.0f} % of raw), '
+                  f'window {config.FILE_WINDOW} x {config.FILE_BLOCK_SIZE // 1024} KiB')
+            print(f'{"peak memory growth":>22}: {(rss_after - rss_before) / 1024:8.1f} MiB '
+                  f'for a {megabytes} MiB file')
+            print(f'{"checksum":>22}: {"ok" if file_md5(received) == source_md5 else "MISMATCH"}, '
+                  f'sender {"closed" if not sender.running else "running"}')
+            received.unlink()
+
+
+if __name__ == '__main__':
+    main()
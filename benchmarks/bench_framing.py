@@ -0,0 +1,61 @@
+"""Feeds multi-megabyte streams through the line framer in 4 KiB chunks.
+
+Compares core.framing.LineFramer with the previous Receiver approach
+(concatenate the whole buffer and split it again on every chunk).
+
+Run from the repository root:
+    python -m benchmarks.bench_framing [megabytes]
+"""
+import sys
+import time
+
+import core.framing
+
+CHUNK_SIZE = 4096
+
+
+def old_framing(stream: bytes) -> int:
+    read_buffer = b''
+    count = 0
+    for i in range(0, len(stream), CHUNK_SIZE):
+        read_buffer = read_buffer + stream[i:i + CHUNK_SIZE]
+        temp = read_buffer.split(b'\n')
+        read_buffer = temp.pop()
+        count += len(temp)
+    return count
+
+
+def new_framing(stream: bytes) -> int:
+    framer = core.framing.LineFramer(max_line_length=len(stream))
+    count = 0
+    with memoryview(stream) as view:
+        for i in range(0, len(stream), CHUNK_SIZE):
+            count += len(framer.feed(view[i:i + CHUNK_SIZE]))
+    return count
+
+
+def bench(name: str, stream: bytes, function) -> float:
+    start = time.perf_counter()
+    lines = function(stream)
+    elapsed = time.perf_counter() - start
+    print(f'  {name:>13}: {lines:7d} lines in {elapsed:8.4f} s ({len(stream) / elapsed / 2 ** 20:9.1f} MiB/s)')
+    return elapsed
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    size = megabytes * 2 ** 20
+    streams = {
+        'short lines (100 B)': (b'message ' + b'x' * 91 + b'\n') * (size // 100),
+        'file chunks (64 KiB)': (b'filedata ' + b'x' * (65536 - 10) + b'\n') * (size // 65536),
+        f'one {megabytes} MiB line': b'x' * size + b'\n',
+    }
+    for name, stream in streams.items():
+        print(f'{name}:')
+        bench('LineFramer', stream, new_framing)
+        if len(stream) <= 8 * 2 ** 20 or 'short' in name:
+            bench('concat + split', stream, old_framing)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Measures what every further identity costs in a process that hosts many.
+
+The identities are added to one IdentityHost, each with its own onion
+service on a fake Tor control port (benchmarks.fake_tor_control), its own
+listening port and a profile with some buddies and messages. The memory
+of the first identity includes everything shared (imports, the event
+loop, the caches), the memory per further identity is what hosting one
+more bot costs. For comparison the same identity is started alone in a
+fresh process, which is what a process per identity costs.
+
+Run from the repository root:
+    python -m benchmarks.bench_identities [identities] [buddies]
+"""
+import contextlib
+import copy
+import io
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import config
+import core.identity
+import core.torcontrol
+import core.transport
+from benchmarks.bench_daemon import rss
+from benchmarks.fake_tor_control import FakeTorControl
+from tests.helpers import make_address
+
+MESSAGES = 5  # per buddy
+BARE_RSS = '''
+for line in open('/proc/self/status'):
+    if line.startswith('VmRSS:'):
+        print(int(line.split()[1]) * 1024)
+'''
+
+
+def setup(server: FakeTorControl):
+    config.ini = copy.deepcopy(config.config_defaults)
+    config.ini['tor']['control_port'] = server.port
+    config.ini['tor']['socks_port'] = 1  # connects fail at once and back off
+
+
+def connect() -> core.torcontrol.TorController:
+    """Connects to the fake Tor, its port opens a moment after start()."""
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            return core.torcontrol.connect_controller('tor')
+        except core.torcontrol.ControlError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+def add_identity(host: core.identity.IdentityHost, number: int, buddies: int):
+    identity = host.add(f'bot{number}')
+    addresses = [make_address() for _ in range(buddies)]
+    identity.add_buddies([(address, '') for address in addresses])
+    for address in addresses:
+        for message in range(MESSAGES):
+            identity.profile.add_message(address, f'message {message} from bot {number} to {address[:8]}')
+
+
+def single(buddies: int):
+    """Starts one identity in this (fresh) process and prints its memory."""
+    server = FakeTorControl(bootstrap_time=0.01, descriptor_time=0.01)
+    server.start()
+    setup(server)
+    before = rss()
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        controller = connect()
+        host = core.identity.IdentityHost(directory, controller=controller)
+        add_identity(host, 0, buddies)
+        after = rss()
+        host.stop()
+        controller.close()
+    server.stop()
+    print(before, after)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    buddies = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    out = sys.stdout
+
+    server = FakeTorControl(bootstrap_time=0.01, descriptor_time=0.01)
+    server.start()
+    setup(server)
+    core.transport.get_event_loop()
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        controller = connect()
+        host = core.identity.IdentityHost(directory, controller=controller)
+        memory_before, rss_before = tracemalloc.get_traced_memory()[0], rss()
+        add_identity(host, 0, buddies)
+        memory_first, rss_first = tracemalloc.get_traced_memory()[0], rss()
+        start = time.perf_counter()
+        for number in range(1, count):
+            add_identity(host, number, buddies)
+        elapsed = time.perf_counter() - start
+        memory_all, rss_all = tracemalloc.get_traced_memory()[0], rss()
+        threads = threading.active_count()
+        services = sum(identity.service_id is not None for identity in host.identities.values())
+        host.stop()
+        controller.close()
+    tracemalloc.stop()
+    server.stop()
+
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.bench_identities', '--single', str(buddies)],
+                            capture_output=True, text=True, check=True)
+    alone_before, alone_after = map(int, result.stdout.split())
+    interpreter = subprocess.run([sys.executable, '-c', BARE_RSS], capture_output=True, text=True, check=True)
+
+    extra = count - 1
+    print(f'{count} identities with {buddies} buddies and {buddies * MESSAGES} messages each, '
+          f'{services} onion services, {threads} threads', file=out)
+    print(f'first identity: {(memory_first - memory_before) / 1024:8.1f} KiB traced, '
+          f'{(rss_first - rss_before) / 1024:8.1f} KiB RSS', file=out)
+    print(f'  per further:  {(memory_all - memory_first) / extra / 1024:8.1f} KiB traced, '
+          f'{(rss_all - rss_first) / extra / 1024:8.1f} KiB RSS, '
+          f'{elapsed / extra * 1000:.1f} ms to add', file=out)
+    print(f'process per identity: {alone_after / 1024:8.1f} KiB RSS '
+          f'({int(interpreter.stdout) / 1024:.1f} KiB of it a bare interpreter)', file=out)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--single':
+        single(int(sys.argv[2]))
+    else:
+        main()
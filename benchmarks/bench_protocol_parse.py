@@ -0,0 +1,36 @@
+"""Measures how many incoming protocol lines are parsed per second on one core.
+
+Run from the repository root:
+    python -m benchmarks.bench_protocol_parse [lines]
+"""
+import sys
+import time
+
+import core.protocol
+
+
+class DummyConnection:
+    buddy = None
+
+
+def bench(name: str, lines: list, count: int):
+    conn = DummyConnection()
+    from_line = core.protocol.protocol_msg_from_line
+    repeat = count // len(lines)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            from_line(None, conn, line)
+    elapsed = time.perf_counter() - start
+    print(f'{name:>18}: {repeat * len(lines) / elapsed:12,.0f} messages/s')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    bench('known command', [b'not_implemented ping'], count)
+    bench('unknown command', [b'some_future_command foo bar'], count)
+    bench('escaped blob', [b'not_implemented ' + b'line\\none\\/two ' * 20], count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Measures recovery after a Tor restart with and without the connection manager.
+
+A simulated Tor client stands in for SOCKS connects: it refuses every
+connect until it is up again, and the time to build a circuit grows with
+the number of circuits being built at once. A connect that takes longer
+than the circuit timeout fails, like Tor's own timeout. All buddies lose
+their connection at the same moment, then the time until all of them (and
+until the ten most active ones) are connected again is measured.
+
+"storm" retries every buddy at once at a fixed interval. This is what
+happens without a retry policy. "managed" uses the configured
+core.connections settings at the same time scale.
+
+Run from the repository root:
+    python -m benchmarks.bench_reconnect [buddies]
+"""
+import asyncio
+import copy
+import random
+import sys
+import time
+
+import config
+import core.connections
+import core.transport
+
+CIRCUIT_TIME = 0.02  # seconds to build one circuit on an idle Tor client
+CIRCUITS_IN_PARALLEL = 8  # circuits Tor builds without slowing down
+CIRCUIT_TIMEOUT = 0.5
+TOR_DOWN = 0.3  # seconds until the restarted Tor client accepts connects
+
+
+class Buddy:
+    def __init__(self, address: str):
+        self.address = address
+        self.conn_out = None
+
+
+class Tor:
+    def __init__(self, loop: core.transport.EventLoop):
+        self.loop = loop
+        self.up_at = time.monotonic() + TOR_DOWN
+        self.building = 0
+        self.peak = 0
+        self.attempts = 0
+
+
+class FakeConnection:
+    def __init__(self, tor: Tor, manager, buddy):
+        self.address = buddy.address
+        self.manager = manager
+        tor.attempts += 1
+        if time.monotonic() < tor.up_at:
+            tor.loop.loop.call_later(0.001, manager.closed, self)
+            return
+        tor.building += 1
+        tor.peak = max(tor.peak, tor.building)
+        duration = CIRCUIT_TIME * max(1.0, tor.building / CIRCUITS_IN_PARALLEL) * random.uniform(0.8, 1.2)
+
+        def done():
+            tor.building -= 1
+            if duration > CIRCUIT_TIMEOUT:
+                manager.closed(self)
+            else:
+                manager.connected(self)
+
+        tor.loop.loop.call_later(min(duration, CIRCUIT_TIMEOUT), done)
+
+
+async def wait_connected(manager, buddies: list, active: list) -> tuple[float, float]:
+    start = time.monotonic()
+    active_done = None
+    while True:
+        if active_done is None and all(manager.entries[buddy.address].state == core.connections.CONNECTED
+                                       for buddy in active):
+            active_done = time.monotonic() - start
+        if all(manager.entries[buddy.address].state == core.connections.CONNECTED for buddy in buddies):
+            return time.monotonic() - start, active_done
+        await asyncio.sleep(0.002)
+
+
+def run(count: int, **settings) -> tuple[float, float, int, int]:
+    loop = core.transport.get_event_loop()
+    tor = Tor(loop)
+    manager = core.connections.ConnectionManager(None, loop, lambda buddy: FakeConnection(tor, manager, buddy),
+                                                 **settings)
+    now = time.time()
+    buddies = [Buddy(f'{number:016x}') for number in range(count)]
+    # the last buddies were the most active ones
+    for number, buddy in enumerate(buddies):
+        manager.want(buddy, now - (count - number))
+    elapsed, active_elapsed = loop.submit(wait_connected(manager, buddies, buddies[-10:])).result()
+    manager.stop()
+    return elapsed, active_elapsed, tor.attempts, tor.peak
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    random.seed(1)
+    config.ini = copy.deepcopy(config.config_defaults)
+    settings = config.ini['connections']
+    # the simulated Tor is about 50 times faster than a real one
+    scale = CIRCUIT_TIME / 1.0
+    variants = {
+        'storm': {'max_connecting': count, 'backoff_min': 0.1, 'backoff_max': 0.1},
+        'managed': {'max_connecting': settings['max_connecting'],
+                    'backoff_min': settings['backoff_min'] * scale,
+                    'backoff_max': settings['backoff_max'] * scale},
+    }
+    for name, variant in variants.items():
+        elapsed, active_elapsed, attempts, peak = run(count, **variant)
+        print(f'{name:>8}: all {count} buddies connected after {elapsed:6.2f} s, '
+              f'10 most active after {active_elapsed:6.2f} s, '
+              f'{attempts:6d} connects, at most {peak:4d} circuits building')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Measures chat latency during file transfers and the sharing of the upload limit.
+
+Uses the loopback stand-ins for Tor connections of bench_filetransfer. The
+upload limit stands in for the bandwidth of the Tor circuit: file data
+queues up in front of it, like it does in front of a slow link, and chat
+lines have to get past that queue.
+
+Run from the repository root:
+    python -m benchmarks.bench_scheduler [megabytes per file]
+"""
+import copy
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import config
+import core.filetransfer
+import core.scheduler
+from benchmarks.bench_filetransfer import Buddy, Pipe
+
+
+class ChatPipe(Pipe):
+    """Records the latency of 'chat <perf_counter>' lines."""
+    def __init__(self, sender_buddy, receiver_buddy):
+        self.latencies = []
+        super().__init__(sender_buddy, receiver_buddy)
+
+    def on_line(self, line: bytes):
+        if line.startswith(b'chat '):
+            self.latencies.append(time.perf_counter() - float(line[5:]))
+        else:
+            super().on_line(line)
+
+
+def connect(a: Buddy, b: Buddy) -> ChatPipe:
+    pipe = ChatPipe(b, a)  # a -> b
+    Pipe(a, b)  # b -> a, the acknowledgements
+    return pipe
+
+
+def chat_latency(path: str, transfers: int, limit: int, fifo: bool = False):
+    core.scheduler.upload_limiter = core.scheduler.UploadLimiter(limit)
+    alice, bob = Buddy('alice'), Buddy('bob')
+    pipe = connect(alice, bob)
+    senders = [core.filetransfer.FileSender(bob, path) for _ in range(transfers)]
+    for _ in range(200):
+        bob.conn_out.send(b'chat %f\n' % time.perf_counter())
+        time.sleep(0.005)
+    for sender in senders:
+        sender.cancel()
+    time.sleep(0.2)
+    latencies = sorted(pipe.latencies)
+    name = f'chat with {transfers} transfers' + (' (fifo)' if fifo else '')
+    print(f'{name:>34}: median {statistics.median(latencies) * 1000:7.3f} ms, '
+          f'p99 {latencies[len(latencies) * 99 // 100] * 1000:7.3f} ms')
+
+
+def fair_share(path: str, limit: int):
+    core.scheduler.upload_limiter = core.scheduler.UploadLimiter(limit)
+    bob, carol = Buddy('bob'), Buddy('carol')
+    # bob and carol each see us as their own buddy object
+    connect(Buddy('alice'), bob)
+    connect(Buddy('alice'), carol)
+    senders = [core.filetransfer.FileSender(bob, path)] + [core.filetransfer.FileSender(carol, path)
+                                                           for _ in range(3)]
+    time.sleep(1)  # let the burst pass
+    before = [sender.bytes_done for sender in senders]
+    start = time.perf_counter()
+    time.sleep(4)
+    elapsed = time.perf_counter() - start
+    rates = [(sender.bytes_done - done) / elapsed for sender, done in zip(senders, before)]
+    for sender in senders:
+        sender.cancel()
+    print(f'{"upload limit":>34}: {limit / 1024 / 1024:.1f} MiB/s, total {sum(rates) / 1024 / 1024:.1f} MiB/s')
+    for sender, rate in zip(senders, rates):
+        eta = sender.eta
+        print(f'{"to " + sender.buddy.address:>34}: {rate / 1024 / 1024:7.2f} MiB/s, '
+              f'reported {sender.rate / 1024 / 1024:7.2f} MiB/s, eta {eta or 0:6.0f} s')
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    with tempfile.TemporaryDirectory() as directory:
+        config.ini = copy.deepcopy(config.config_defaults)
+        config.ini['files']['temp_files_custom_dir'] = directory + '/in'
+        path = directory + '/random.bin'
+        with open(path, 'wb') as file:
+            for _ in range(megabytes):
+                file.write(os.urandom(1024 * 1024))
+        limit = 4 * 1024 * 1024
+        for transfers in (0, 1, 3):
+            chat_latency(path, transfers, limit)
+        # for comparison: chat lines queued in line with the file data
+        add = core.scheduler.LineScheduler.add
+        core.scheduler.LineScheduler.add = lambda self, data, stream=None: add(self, data, 'fifo')
+        chat_latency(path, 3, limit, fifo=True)
+        core.scheduler.LineScheduler.add = add
+        fair_share(path, 8 * 1024 * 1024)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Measures indexing and querying the full-text search index.
+
+Run from the repository root:
+    python -m benchmarks.bench_search [messages]
+"""
+import itertools
+import random
+import sys
+import tempfile
+import time
+
+import core.search
+
+
+def make_vocabulary(size: int) -> list[str]:
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(random.choice(letters) for _ in range(random.randint(3, 9))) for _ in range(size)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    random.seed(1)
+    vocabulary = make_vocabulary(20000)
+    # zipf-like: few words are very common, most are rare
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    texts = {}
+    buddies = [f'buddy{i}' for i in range(200)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = core.search.SearchIndex(directory, fetch_text=lambda buddy_id, number: texts[buddy_id, number])
+        for i in range(count):
+            texts[random.choice(buddies), i] = ' '.join(
+                random.choices(vocabulary, cum_weights=weights, k=random.randint(3, 15)))
+        start = time.perf_counter()
+        for (buddy_id, i), text in texts.items():
+            index.add(buddy_id, i, text)
+        elapsed = time.perf_counter() - start
+        print(f'{"index":>22}: {count / elapsed:10.0f} messages/s')
+
+        common, medium, rare = vocabulary[0], vocabulary[50], vocabulary[5000]
+        queries = {
+            'common word': common,
+            'rare word': rare,
+            'two words': f'{common} {medium}',
+            'common + rare': f'{common} {rare}',
+            'prefix': vocabulary[100][:3] + '*',
+            'phrase': f'"{common} {vocabulary[1]}"',
+            'no match': 'zzzzzzzzzzzz',
+        }
+        for name, query in queries.items():
+            times = []
+            for _ in range(20):
+                start = time.perf_counter()
+                result = index.search(query, 50)
+                times.append(time.perf_counter() - start)
+            times.sort()
+            print(f'{name:>22}: median {times[10] * 1000:7.3f} ms, worst {times[-1] * 1000:7.3f} ms, '
+                  f'{len(result)} hits')
+
+        start = time.perf_counter()
+        index.close()
+        print(f'{"save":>22}: {time.perf_counter() - start:7.3f} s')
+        start = time.perf_counter()
+        index = core.search.SearchIndex(directory)
+        print(f'{"load":>22}: {time.perf_counter() - start:7.3f} s, {len(index)} messages')
+        index.close()
+
+
+if __name__ == '__main__':
+    main()
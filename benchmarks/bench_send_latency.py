@@ -0,0 +1,81 @@
+"""Measures the latency between queueing a protocol line and it arriving at the peer.
+
+Sends through the send path of core.transport.Connection (its
+LineScheduler and send_lines() on the event loop) on a local socket pair.
+
+Run from the repository root:
+    python -m benchmarks.bench_send_latency [messages]
+"""
+import asyncio
+import copy
+import socket
+import statistics
+import sys
+import threading
+import time
+
+import config
+import core.transport
+
+
+class SocketConnection(core.transport.Connection):
+    """The sending end of a connection on a connected socket."""
+    def __init__(self, sock: socket.socket):
+        core.transport.Connection.__init__(self, None, core.transport.get_event_loop())
+        self.loop.submit(self.open(sock)).result()
+
+    async def open(self, sock: socket.socket):
+        self.reader, self.writer = await asyncio.open_connection(sock=sock)
+        self.started = True
+        self.start_sending()
+
+    def close(self):
+        self.loop.call(self.close_transport)
+
+
+def reader(sock, count: int, latencies: list):
+    buffer = b''
+    while len(latencies) < count:
+        data = sock.recv(65536)
+        if not data:
+            break
+        now = time.perf_counter()
+        buffer += data
+        lines = buffer.split(b'\n')
+        buffer = lines.pop()
+        for line in lines:
+            latencies.append(now - float(line.split(b' ')[1]))
+
+
+def bench(count: int, burst: int):
+    writer_sock, reader_sock = socket.socketpair()
+    conn = SocketConnection(writer_sock)
+    latencies = []
+    receiver = threading.Thread(target=reader, args=(reader_sock, count, latencies), daemon=True)
+    receiver.start()
+
+    for i in range(count // burst):
+        for _ in range(burst):
+            conn.send(f'message {time.perf_counter()!r}\n'.encode())
+        # give the writer a chance to go idle again between bursts
+        time.sleep(0.0005)
+    receiver.join(10)
+    conn.close()
+    reader_sock.close()
+
+    latencies = sorted(latencies)
+    median = statistics.median(latencies) * 1e6
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1e6
+    print(f'burst {burst:4d}: {len(latencies)} messages, median {median:8.1f} us, p99 {p99:8.1f} us')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    config.ini = copy.deepcopy(config.config_defaults)
+    print('Previous implementation: up to 200000 us per message (time.sleep(0.2) polling)')
+    for burst in (1, 10, 100):
+        bench(count, burst)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Measures how many protocol lines per second incoming connections get through.
+
+An identity listens with its connections served in this process
+(workers 0) and sharded across 1, 2, ... worker processes. A load process
+opens many incoming connections and sends lines on all of them at once:
+"features" lines (parsed and executed, no answer on a connection without
+a buddy) and at the end an unknown command, on which the connection is
+closed. When every connection is closed all lines were processed. The
+rate limits are lifted for the measurement.
+
+The workers only help with more than one core: on a single core the
+numbers show what the hand-off and the processes cost.
+
+Run from the repository root:
+    python -m benchmarks.bench_sharding [connections] [lines per connection] [max workers]
+"""
+import asyncio
+import contextlib
+import copy
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import config
+import core.contacts
+import core.identity
+import core.transport
+
+LINE = b'features binary zlib lzma\n'
+LAST_LINE = b'bench_done\n'
+WARM_UP = (8, 10)  # connections and lines before every measurement
+
+
+async def load(port: int, connections: int, lines: int) -> float:
+    """The other end of the connections, runs in its own process."""
+    data = LINE * lines + LAST_LINE
+
+    async def connection():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(data)
+        while await reader.read(65536):
+            pass
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connection() for _ in range(connections)))
+    return time.perf_counter() - start
+
+
+def run_load(port: int, connections: int, lines: int) -> float:
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.bench_sharding', '--load', str(port),
+                             str(connections), str(lines)], capture_output=True, text=True, check=True)
+    return float(result.stdout)
+
+
+@contextlib.contextmanager
+def silenced():
+    """Sends the output of this process and of the workers to /dev/null."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def measure(workers: int, connections: int, lines: int) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        identity = core.identity.Identity('', directory, core.transport.get_event_loop(),
+                                          core.contacts.Profile(), workers=workers)
+        listen_socket = socket.socket()
+        listen_socket.bind(('127.0.0.1', 0))
+        identity.start(listen_socket)
+        try:
+            run_load(identity.listen_port, *WARM_UP)
+            return run_load(identity.listen_port, connections, lines)
+        finally:
+            identity.stop()
+
+
+def main():
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    lines = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else max(2, os.cpu_count() or 1)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    config.ini = copy.deepcopy(config.config_defaults)
+    config.ini['client']['listen_backlog'] = 1024
+    limits = config.ini['limits']
+    limits['max_unauthenticated_connections'] = connections + 16
+    for key in ('connection_lines_per_sec', 'connection_bytes_per_sec', 'global_lines_per_sec',
+                'global_bytes_per_sec'):
+        limits[key] = 10 ** 12
+
+    total = connections * (lines + 1)
+    print(f'{connections} incoming connections with {lines + 1} lines each, {os.cpu_count()} cores')
+    baseline = None
+    worker_counts = [0] + [count for count in (1, 2, 4, 8, 16) if count <= max_workers]
+    for workers in worker_counts:
+        with silenced():
+            elapsed = measure(workers, connections, lines)
+        rate = total / elapsed
+        baseline = baseline or rate
+        name = 'in process' if workers == 0 else f'{workers} workers'
+        print(f'{name:>11}: {elapsed:6.2f} s, {rate:9.0f} lines/s ({rate / baseline:.2f}x)')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 4 and sys.argv[1] == '--load':
+        print(asyncio.run(load(*map(int, sys.argv[2:5]))))
+    else:
+        main()
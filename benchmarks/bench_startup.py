@@ -0,0 +1,88 @@
+"""Measures cold start: importing the core without Qt and the time to the first window.
+
+Every measurement runs in a fresh interpreter. The core modules must not
+import PyQt5, the import of PyQt5.QtWidgets is measured separately to show
+what headless code saves. If PyQt5 is installed, onionchat-gui.py is started
+with ONIONCHAT_PROFILE_STARTUP=exit on the offscreen platform (with a
+temporary home directory for the profile) and its phases are reported.
+
+Run from the repository root:
+    python -m benchmarks.bench_startup [runs]
+"""
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+MODULES = ('config', 'core.utils', 'core.contacts', 'core.transport', 'core.network')
+PHASE = re.compile(r'^\(1\) startup: (.+?) +([\d.]+) ms', re.MULTILINE)
+IMPORT = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, 'PyQt5' in sys.modules)
+'''
+
+
+def import_time(module: str, runs: int) -> tuple[float, bool]:
+    """Returns the median seconds to import a module and whether it pulled in PyQt5."""
+    times = []
+    qt = False
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', IMPORT.format(module=module)],
+                                capture_output=True, text=True, check=True)
+        seconds, imported = result.stdout.split()
+        times.append(float(seconds))
+        qt = qt or imported == 'True'
+    return statistics.median(times), qt
+
+
+def first_window(runs: int) -> list[dict[str, float]] | None:
+    """Returns the startup phases of every run, None if the GUI cannot be started."""
+    results = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as home:
+            env = dict(os.environ, HOME=home, ONIONCHAT_PROFILE_STARTUP='exit', QT_QPA_PLATFORM='offscreen')
+            try:
+                result = subprocess.run([sys.executable, 'onionchat-gui.py'], capture_output=True, text=True,
+                                        env=env, timeout=60)
+            except subprocess.TimeoutExpired:
+                return None
+            phases = {}
+            for name, milliseconds in PHASE.findall(result.stdout):
+                phases[name] = float(milliseconds)
+            if 'first window' not in phases:
+                return None
+            results.append(phases)
+    return results
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for module in MODULES:
+        try:
+            seconds, qt = import_time(module, runs)
+        except subprocess.CalledProcessError as err:
+            print(f'{"import " + module:>22}: cannot be imported here ({err.stderr.strip().splitlines()[-1]})')
+            continue
+        print(f'{"import " + module:>22}: {seconds * 1000:7.1f} ms{", imports PyQt5!" if qt else ", without Qt"}')
+    try:
+        seconds, _ = import_time('PyQt5.QtWidgets', runs)
+        print(f'{"import PyQt5.QtWidgets":>22}: {seconds * 1000:7.1f} ms, saved by every headless start')
+    except subprocess.CalledProcessError:
+        print(f'{"import PyQt5.QtWidgets":>22}: PyQt5 is not installed, no GUI measurement')
+        return
+
+    results = first_window(runs)
+    if results is None:
+        print(f'{"first window":>22}: the GUI could not be started')
+        return
+    for name in results[0]:
+        median = statistics.median(phases.get(name, 0.0) for phases in results)
+        print(f'{name:>22}: {median:7.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
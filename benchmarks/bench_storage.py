@@ -0,0 +1,46 @@
+"""Measures the message store: appends and random page reads of a long history.
+
+Run from the repository root:
+    python -m benchmarks.bench_storage [messages]
+"""
+import random
+import sys
+import tempfile
+import time
+
+import core.storage
+
+PAGE_SIZE = 50
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    with tempfile.TemporaryDirectory() as directory:
+        store = core.storage.MessageStore(directory)
+        text = 'Hello, this is a fairly typical chat message of moderate length.'
+
+        start = time.perf_counter()
+        for i in range(count):
+            store.append('buddy', text)
+        store.sync()
+        elapsed = time.perf_counter() - start
+        print(f'append: {count / elapsed:12,.0f} messages/s ({count} messages, synced)')
+
+        reads = 10000
+        start = time.perf_counter()
+        for _ in range(reads):
+            page = store.read('buddy', random.randrange(count - PAGE_SIZE), PAGE_SIZE)
+            assert len(page) == PAGE_SIZE
+        elapsed = time.perf_counter() - start
+        print(f'random page ({PAGE_SIZE} messages): {elapsed / reads * 1e6:8.1f} us per page')
+        store.close()
+
+        start = time.perf_counter()
+        store = core.storage.MessageStore(directory)
+        assert store.count('buddy') == count
+        print(f'reopen and recover: {(time.perf_counter() - start) * 1000:8.1f} ms')
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Measures how soon OnionChat knows its address and is reachable after Tor starts.
+
+A FakeTorControl stands in for a starting Tor client: its control port
+opens after OPEN_DELAY, it bootstraps in BOOTSTRAP_TIME and uploads the
+descriptor of our service DESCRIPTOR_TIME later. The hostname file of the
+old startup appears at the same moment the control port opens.
+
+  - hostname polling: the old loop, one try to read hidden_service/hostname
+    per second. It never learns whether the service is reachable.
+  - control port: core.network.connect_tor_control() with ADD_ONION, then
+    the HS_DESC event.
+
+Also measured: how long it takes to notice that the Tor process exited.
+The old timer checked every 10 seconds.
+
+Run from the repository root:
+    python -m benchmarks.bench_tor_startup
+"""
+import copy
+import pathlib
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import config
+import core.network
+import core.torcontrol
+from benchmarks.fake_tor_control import FakeTorControl
+
+OPEN_DELAY = 0.3
+BOOTSTRAP_TIME = 0.8
+DESCRIPTOR_TIME = 0.2
+
+
+def hostname_polling(directory: pathlib.Path) -> float:
+    hostname = directory / 'hidden_service' / 'hostname'
+
+    def write_hostname():
+        time.sleep(OPEN_DELAY)
+        hostname.parent.mkdir(exist_ok=True)
+        hostname.write_text('m' * 56 + '.onion\n')
+
+    start = time.monotonic()
+    threading.Thread(target=write_hostname).start()
+    for _ in range(11):
+        try:
+            hostname.read_text()
+            break
+        except FileNotFoundError:
+            time.sleep(1)
+    return time.monotonic() - start
+
+
+def control_port(directory: pathlib.Path, auth: str) -> tuple[float, float]:
+    server = FakeTorControl(auth, directory, bootstrap_time=BOOTSTRAP_TIME, descriptor_time=DESCRIPTOR_TIME,
+                            open_delay=OPEN_DELAY)
+    config.ini['tor_portable']['control_port'] = server.port
+    start = time.monotonic()
+    server.start()
+    hostname = core.network.connect_tor_control('tor_portable', directory)
+    known = time.monotonic() - start
+    controller = core.network.tor_controller
+    controller.wait_published(hostname, 10)
+    reachable = time.monotonic() - start
+    controller.close()
+    server.stop()
+    return known, reachable
+
+
+def exit_detection() -> float:
+    # the process prints the time right before it exits
+    proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(0.2); print(time.time())'],
+                            stdout=subprocess.PIPE)
+    noticed = []
+
+    def watch():
+        proc.wait()
+        noticed.append(time.time())
+
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    watcher.join()
+    return noticed[0] - float(proc.stdout.read())
+
+
+def main():
+    config.ini = copy.deepcopy(config.config_defaults)
+    print(f'simulated Tor: control port after {OPEN_DELAY} s, bootstrapped after {BOOTSTRAP_TIME} s, '
+          f'descriptor uploaded {DESCRIPTOR_TIME} s later')
+    with tempfile.TemporaryDirectory() as directory:
+        elapsed = hostname_polling(pathlib.Path(directory))
+        print(f'{"hostname polling":>26}: address known after {elapsed:5.2f} s, reachable unknown')
+    for auth in ('null', 'safecookie'):
+        with tempfile.TemporaryDirectory() as directory:
+            known, reachable = control_port(pathlib.Path(directory), auth)
+            print(f'{"control port (" + auth + ")":>26}: address known after {known:5.2f} s, '
+                  f'reachable after {reachable:5.2f} s '
+                  f'(Tor itself: {BOOTSTRAP_TIME + DESCRIPTOR_TIME:.2f} s)')
+    print(f'{"Tor exit noticed":>26}: after {exit_detection() * 1000:5.2f} ms (timer: up to 10 s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Compares the asyncio listener (core.transport) with a thread per connection.
+
+Opens N idle loopback connections to each listener and reports how long it
+took to accept them, how many OS threads were needed and the memory growth.
+The threaded listener is the design core.network had before: an accept
+thread and one receiving thread per connection.
+
+Run from the repository root:
+    python -m benchmarks.bench_transport [connections]
+"""
+import contextlib
+import copy
+import gc
+import io
+import socket
+import sys
+import threading
+import time
+
+import config
+import core.network
+import core.transport
+
+
+class DummyBuddyList:
+    def onConnected(self, conn):
+        pass
+
+    def onAuthenticated(self, conn):
+        pass
+
+    def onErrorIn(self, conn):
+        pass
+
+    def onErrorOut(self, conn):
+        pass
+
+
+class ThreadedListener(threading.Thread):
+    """Accepts connections and reads each of them in its own thread."""
+    def __init__(self, sock):
+        threading.Thread.__init__(self, daemon=True)
+        self.socket = sock
+        self.conns = set()
+        self.running = True
+        self.start()
+
+    def run(self):
+        while self.running:
+            try:
+                conn, address = self.socket.accept()
+            except OSError:
+                return
+            self.conns.add(conn)
+            threading.Thread(target=self.receive, args=(conn,), daemon=True).start()
+
+    def receive(self, conn):
+        with contextlib.suppress(OSError):
+            while conn.recv(4096):
+                pass
+        conn.close()
+
+    def close(self):
+        self.running = False
+        self.socket.close()
+
+
+def get_rss_kb() -> int:
+    """Returns the resident set size of this process in KiB (Linux only)."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def open_clients(listener, port: int, count: int) -> list:
+    # Connect one by one and wait for each accept, otherwise the small
+    # listen() backlog makes the kernel drop SYNs and we only measure retries.
+    clients = []
+    for i in range(count):
+        clients.append(socket.create_connection(('127.0.0.1', port)))
+        while len(listener.conns) <= i:
+            time.sleep(0)
+    return clients
+
+
+def bench(name: str, make_listener, count: int):
+    gc.collect()
+    rss_before = get_rss_kb()
+    threads_before = threading.active_count()
+    sock = core.network.try_bind_port('127.0.0.1', 0)
+    sock.listen(1024)
+    port = sock.getsockname()[1]
+    with contextlib.redirect_stdout(io.StringIO()):
+        listener = make_listener(sock)
+        start = time.perf_counter()
+        clients = open_clients(listener, port, count)
+        elapsed = time.perf_counter() - start
+    threads = threading.active_count() - threads_before
+    rss = get_rss_kb() - rss_before
+    print(f'{name:>9}: {len(listener.conns):6d} connections accepted in {elapsed:7.3f} s, '
+          f'{threads:6d} extra threads, {rss / 1024:8.1f} MiB extra RSS')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for client in clients:
+            client.close()
+        # wake up a thread blocked in accept()
+        listener.running = False
+        with contextlib.suppress(OSError):
+            sock.shutdown(socket.SHUT_RDWR)
+        listener.close()
+        time.sleep(0.5)
+
+
+def threaded_listener(sock):
+    return ThreadedListener(sock)
+
+
+def async_listener(sock):
+    return core.transport.Listener(DummyBuddyList(), sock)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    config.ini = copy.deepcopy(config.config_defaults)
+    # nobody completes a handshake here
+    config.ini['limits']['max_unauthenticated_connections'] = count
+    print(f'Holding {count} idle loopback connections:')
+    bench('asyncio', async_listener, count)
+    bench('threaded', threaded_listener, count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Compares the TorChat line encoding with binary frames.
+
+Every message is encoded, the stream is fed to the decoder in 64 KiB reads
+(as from a socket) and the message objects are created, like the receiver
+does before execute().
+
+Run from the repository root:
+    python -m benchmarks.bench_wire [messages]
+"""
+import os
+import sys
+import time
+
+import core.framing
+import core.protocol
+
+
+def run(messages: list, binary: bool) -> tuple[float, float, int]:
+    """Returns CPU seconds for encoding, for decoding and the size of the stream."""
+    start = time.process_time()
+    encoded = [message.encode(binary) for message in messages]
+    encode_time = time.process_time() - start
+    stream = b''.join(encoded)
+    if binary:
+        stream = core.framing.SWITCH_LINE + b'\n' + stream
+
+    start = time.process_time()
+    decoder = core.framing.WireDecoder()
+    count = 0
+    for position in range(0, len(stream), 65536):
+        for item in decoder.feed(stream[position:position + 65536]):
+            core.protocol.protocol_msg_from_item(None, None, item)
+            count += 1
+    decode_time = time.process_time() - start
+    assert count == len(messages)
+    return encode_time, decode_time, len(stream)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    chat = 'Hello! How are you doing today? \\o/ Let\'s meet at 5.\n' * 2
+    payloads = {
+        'chat message': [core.protocol.ProtocolNotImplemented(blob=chat) for _ in range(count)],
+        '64 KiB file block': [core.protocol.ProtocolFiledata(blob=b'0123456789abcdef 0 %s ' % (b'0' * 32)
+                                                             + os.urandom(65536))
+                              for _ in range(max(1, count // 20))],
+    }
+    for name, messages in payloads.items():
+        raw = sum(len(message.blob) for message in messages)
+        for binary in (False, True):
+            encode_time, decode_time, size = run(messages, binary)
+            total = encode_time + decode_time
+            label = f'{name} ({"binary" if binary else "lines"})'
+            print(f'{label:>28}: {total / len(messages) * 1e6:8.2f} us CPU/message '
+                  f'(encode {encode_time / len(messages) * 1e6:7.2f}, decode {decode_time / len(messages) * 1e6:7.2f}), '
+                  f'{raw / total / 1024 / 1024:8.1f} MiB/s, {size / raw * 100 - 100:+5.1f} % on the wire')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""A local stand-in for the control port of a Tor client.
+
+It speaks enough of the control protocol for core.torcontrol: PROTOCOLINFO,
+AUTHCHALLENGE and AUTHENTICATE (none, COOKIE, SAFECOOKIE or a password), GETINFO
+status/bootstrap-phase, SETEVENTS, ADD_ONION, DEL_ONION and QUIT. The
+bootstrap runs in bootstrap_time seconds after start() and is reported as
+STATUS_CLIENT events, followed by CIRC events. The descriptor of an onion
+service is "uploaded" (HS_DESC UPLOADED) descriptor_time after it was
+added, but never before the bootstrap is done.
+
+    server = FakeTorControl(auth='safecookie', cookie_dir=directory)
+    server.start()
+    ... TorController('127.0.0.1', server.port) ...
+    server.stop()
+"""
+import base64
+import hashlib
+import hmac
+import os
+import pathlib
+import socket
+import threading
+import time
+
+import core.torcontrol
+
+BOOTSTRAP_STEPS = (0, 5, 10, 14, 15, 75, 90, 95, 100)
+
+
+class FakeTorControl:
+    def __init__(self, auth: str = 'null', cookie_dir: str | pathlib.Path = None, password: str = '',
+                 bootstrap_time: float = 0.5, descriptor_time: float = 0.2, port: int = 0,
+                 open_delay: float = 0, server_cookie: bytes = None):
+        """
+        :param auth: 'null', 'cookie' or 'safecookie' (both need cookie_dir) or 'password'.
+        :param open_delay: Seconds until the port accepts connections, like
+            a Tor process that is still starting.
+        :param server_cookie: The cookie the SAFECOOKIE server hash is made
+            with, by default the one in the cookie file. Another one is a
+            control port that does not know our cookie.
+        """
+        self.auth = auth
+        self.password = password
+        self.cookie_path = None
+        if auth in ('cookie', 'safecookie'):
+            self.cookie_path = pathlib.Path(cookie_dir, 'control_auth_cookie')
+            self.cookie_path.write_bytes(os.urandom(32))
+        self.server_cookie = server_cookie
+        self.bootstrap_time = bootstrap_time
+        self.descriptor_time = descriptor_time
+        self.open_delay = open_delay
+        if not port:
+            with socket.create_server(('127.0.0.1', 0)) as probe:
+                port = probe.getsockname()[1]
+        self.port = port
+        self.server = None
+        self.started = 0.0
+        self.running = False
+        self.clients = []
+        self.services: dict[str, float] = {}  # service id -> time it was added
+
+    def start(self):
+        self.started = time.monotonic()
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        time.sleep(self.open_delay)
+        self.server = socket.create_server(('127.0.0.1', self.port))
+        while self.running:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                break
+            client = Client(self, sock)
+            self.clients.append(client)
+            threading.Thread(target=client.run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.server is not None:
+            self.server.close()
+        for client in self.clients:
+            client.close()
+
+    def progress(self) -> int:
+        elapsed = time.monotonic() - self.started
+        index = min(int(elapsed / self.bootstrap_time * (len(BOOTSTRAP_STEPS) - 1)), len(BOOTSTRAP_STEPS) - 1)
+        return BOOTSTRAP_STEPS[index]
+
+    def step_time(self, index: int) -> float:
+        return self.started + self.bootstrap_time * index / (len(BOOTSTRAP_STEPS) - 1)
+
+
+def bootstrap_line(progress: int) -> str:
+    tag = 'done' if progress == 100 else 'conn'
+    return f'NOTICE BOOTSTRAP PROGRESS={progress} TAG={tag} SUMMARY="{"Done" if progress == 100 else "Connecting"}"'
+
+
+class Client:
+    def __init__(self, server: FakeTorControl, sock: socket.socket):
+        self.server = server
+        self.socket = sock
+        self.lock = threading.Lock()
+        self.authenticated = False
+        self.events = set()
+        self.client_nonce = self.server_nonce = None
+        self.services = set()  # removed with the connection, like services without Flags=Detach
+        self.running = True
+
+    def send(self, *lines: str):
+        with self.lock:
+            try:
+                self.socket.sendall(''.join(line + '\r\n' for line in lines).encode('utf-8'))
+            except OSError:
+                self.running = False
+
+    def event(self, name: str, text: str):
+        if name in self.events and self.running:
+            self.send(f'650 {name} {text}')
+
+    def close(self):
+        self.running = False
+        for service_id in self.services:
+            self.server.services.pop(service_id, None)
+        self.services.clear()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def run(self):
+        threading.Thread(target=self.bootstrap, daemon=True).start()
+        try:
+            with self.socket.makefile('rb') as file:
+                for line in file:
+                    if not self.running:
+                        break
+                    self.handle(line.decode('utf-8').rstrip('\r\n'))
+        except OSError:
+            pass  # the client went away
+        self.close()
+
+    def bootstrap(self):
+        server = self.server
+        if server.step_time(len(BOOTSTRAP_STEPS) - 1) <= time.monotonic():
+            return  # bootstrapped before this client connected
+        for index, progress in enumerate(BOOTSTRAP_STEPS):
+            time.sleep(max(0.0, server.step_time(index) - time.monotonic()))
+            if not self.running:
+                return
+            self.event('STATUS_CLIENT', bootstrap_line(progress))
+        self.event('STATUS_CLIENT', 'NOTICE CIRCUIT_ESTABLISHED')
+        for number in range(1, 4):
+            self.event('CIRC', f'{number} BUILT $AAAA~relay,$BBBB~relay PURPOSE=GENERAL')
+
+    def handle(self, line: str):
+        command, _, arguments = line.partition(' ')
+        command = command.upper()
+        if command == 'PROTOCOLINFO':
+            methods = {'null': 'NULL', 'cookie': 'COOKIE', 'safecookie': 'COOKIE,SAFECOOKIE',
+                       'password': 'HASHEDPASSWORD'}
+            cookie = f' COOKIEFILE={core.torcontrol.quote(str(self.server.cookie_path))}' if self.server.cookie_path else ''
+            self.send('250-PROTOCOLINFO 1', f'250-AUTH METHODS={methods[self.server.auth]}{cookie}',
+                      '250-VERSION Tor="0.4.8.10"', '250 OK')
+        elif command == 'AUTHCHALLENGE':
+            _, nonce = arguments.split()
+            self.client_nonce = bytes.fromhex(nonce)
+            self.server_nonce = os.urandom(32)
+            cookie = self.server.server_cookie or self.server.cookie_path.read_bytes()
+            message = cookie + self.client_nonce + self.server_nonce
+            server_hash = hmac.new(core.torcontrol.SAFECOOKIE_SERVER_KEY, message, hashlib.sha256).hexdigest()
+            self.send(f'250 AUTHCHALLENGE SERVERHASH={server_hash.upper()} SERVERNONCE={self.server_nonce.hex().upper()}')
+        elif command == 'AUTHENTICATE':
+            if self.check_authentication(arguments):
+                self.authenticated = True
+                self.send('250 OK')
+            else:
+                self.send('515 Authentication failed')
+                self.close()
+        elif command == 'QUIT':
+            self.send('250 closing connection')
+            self.close()
+        elif not self.authenticated:
+            self.send('514 Authentication required.')
+            self.close()
+        elif command == 'GETINFO':
+            if arguments != 'status/bootstrap-phase':
+                self.send(f'552 Unrecognized key "{arguments}"')
+            else:
+                self.send(f'250-status/bootstrap-phase={bootstrap_line(self.server.progress())}', '250 OK')
+        elif command == 'SETEVENTS':
+            self.events = set(arguments.split())
+            self.send('250 OK')
+        elif command == 'ADD_ONION':
+            self.add_onion(arguments.split())
+        elif command == 'DEL_ONION':
+            self.services.discard(arguments.strip())
+            if self.server.services.pop(arguments.strip(), None) is None:
+                self.send('552 Unknown Onion Service id')
+            else:
+                self.send('250 OK')
+        else:
+            self.send(f'510 Unrecognized command "{command}"')
+
+    def check_authentication(self, arguments: str) -> bool:
+        auth = self.server.auth
+        if auth == 'null':
+            return True
+        if auth == 'password':
+            return core.torcontrol.unquote(arguments) == self.server.password
+        if self.server_nonce is None:
+            return arguments == self.server.cookie_path.read_bytes().hex()
+        message = self.server.cookie_path.read_bytes() + self.client_nonce + self.server_nonce
+        expected = hmac.new(core.torcontrol.SAFECOOKIE_CLIENT_KEY, message, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(arguments.lower(), expected)
+
+    def add_onion(self, arguments: list[str]):
+        key = arguments[0]
+        if key == 'NEW:ED25519-V3':
+            private_key = os.urandom(64)
+        elif key.startswith('ED25519-V3:'):
+            private_key = base64.b64decode(key[len('ED25519-V3:'):])
+        else:
+            self.send('513 Invalid key type')
+            return
+        if not any(argument.startswith('Port=') for argument in arguments[1:]):
+            self.send('512 Missing \'Port\' argument')
+            return
+        # not the real derivation of the address, but stable for a key
+        service_id = base64.b32encode(hashlib.sha3_256(private_key).digest() + b'\x03' * 3).decode('ascii').lower()[:56]
+        if service_id in self.server.services:
+            self.send('550 Onion address collision')
+            return
+        self.server.services[service_id] = time.monotonic()
+        self.services.add(service_id)
+        lines = [f'250-ServiceID={service_id}']
+        if key.startswith('NEW:') and 'Flags=DiscardPK' not in arguments:
+            lines.append(f'250-PrivateKey=ED25519-V3:{base64.b64encode(private_key).decode("ascii")}')
+        self.send(*lines, '250 OK')
+        threading.Thread(target=self.publish, args=(service_id,), daemon=True).start()
+
+    def publish(self, service_id: str):
+        server = self.server
+        ready = max(server.step_time(len(BOOTSTRAP_STEPS) - 1), time.monotonic()) + server.descriptor_time
+        time.sleep(max(0.0, ready - time.monotonic()))
+        self.event('HS_DESC', f'UPLOAD {service_id} UNKNOWN $CCCC~hsdir')
+        self.event('HS_DESC', f'UPLOADED {service_id} UNKNOWN $CCCC~hsdir')
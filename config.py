@@ -2,10 +2,15 @@ import pathlib
 import os.path
 import sys
 import json
-from PyQt5.QtCore import QSize
 
 ONIONCHAT_PORT = 11009  # Do NOT change this.
 DEAD_CONNECTION_TIMEOUT = 240
+MAX_LINE_LENGTH = 4 * 1024 * 1024  # Longest protocol line (bytes) we accept from a peer
+VALID_ADDRESS_CACHE_SIZE = 65536  # Number of verified onion addresses to remember
+FILE_BLOCK_SIZE = 64 * 1024  # Bytes of file data per filedata message
+FILE_WINDOW = 16  # Unacknowledged filedata messages in flight per transfer
+FILE_RETRANSMIT_TIMEOUT = 30  # Seconds without an acknowledged block before the window is sent again
+TRANSFER_PROGRESS_INTERVAL = 0.5  # Seconds between progress events of a transfer
 
 SCRIPT_DIR = pathlib.Path(sys.argv[0]).parent.resolve()
 
@@ -25,24 +30,63 @@ config_defaults = {
         'address': '127.0.0.1',
         'socks_port': 9050,
         'control_port': 9051,
+        'control_password': '',  # only needed if Tor offers neither cookie authentication nor none
     },
     'tor_portable': {
         'address': '127.0.0.1',
         'socks_port': 11109,
         'control_port': 11119,
+        'control_password': '',
     },
     'client': {
         'hostname': 'm' * 56,
         'listen_interface': '127.0.0.1',
         'listen_port': 11009,
+        'listen_backlog': 5,
+    },
+    'limits': {
+        'connection_lines_per_sec': 200,
+        'connection_bytes_per_sec': 1024 * 1024,
+        'global_lines_per_sec': 10000,
+        'global_bytes_per_sec': 64 * 1024 * 1024,
+        # all connections that did not complete the handshake together, apart from the buddies
+        'unauthenticated_lines_per_sec': 1000,
+        'unauthenticated_bytes_per_sec': 1024 * 1024,
+        'max_unauthenticated_connections': 16,
     },
     'logging': {
         'log_file': '',
         'log_level': 0,
     },
+    'storage': {
+        'history_max_messages': 0,  # 0 keeps the whole history
+    },
     'files': {
         'temp_files_data_dir': True,
         'temp_files_custom_dir': '',
+        'upload_limit': 0,  # bytes per second for all file transfers together, 0 = no limit
+    },
+    'connections': {
+        'max_connecting': 8,  # outgoing connects in progress at the same time
+        'backoff_min': 1.0,  # seconds before the first retry of a failed connect
+        'backoff_max': 300.0,  # seconds, the longest delay between retries
+    },
+    'compression': {
+        'enabled': True,  # compress frames to peers that can decompress them
+        'algorithm': 'zlib',  # for file data, 'zlib' or 'lzma' (slower, smaller)
+        'level': 6,
+        'min_size': 256,  # bytes, smaller messages are sent as they are
+    },
+    'daemon': {
+        'control_socket': '',  # unix socket of the control API, empty = onionchat.sock in the data dir
+        'identities_dir': '',  # one directory per hosted identity, empty = identities in the data dir
+    },
+    'metrics': {
+        'port': 0,  # serve the metrics in the Prometheus text format on /metrics, 0 = off
+        'address': '127.0.0.1',
+    },
+    'sharding': {
+        'workers': 0,  # processes serving the connections of the daemon's own identity, 0 = this process
     },
     'gui': {
         'language': 'en',
@@ -125,12 +169,14 @@ def load_from_json(filename: str = 'onionchat.json.ini') -> bool:
 
         # Section: check each of its keys to exist
         # Load key from config_defaults if not found
+        ini[section] = {}
         for key in config_defaults[section].keys():
             key_json = section_json.get(key)
             if key_json is None:
                 print(f"Could not find '{key}', section '{section}' in JSON ini '{filename}'.")
                 print('Loading value from ini defaults.')
-        ini[section] = config_defaults[section]
+                key_json = config_defaults[section][key]
+            ini[section][key] = key_json
 
     return True
 
@@ -155,7 +201,8 @@ class Login:
 
 
 class Gui:
-    WINDOW_MIN_SIZE = QSize(690, 500)
+    # sizes are (width, height), the GUI makes QSize of them, so the core does not need Qt
+    WINDOW_MIN_SIZE = (690, 500)
     TOOLBAR_MAX_WIDTH = 420
     CHAT_LIST_MAX_WIDTH = TOOLBAR_MAX_WIDTH
     MESSAGE_LIST_MIN_WIDTH = 540
@@ -168,14 +215,21 @@ class Gui:
     ICON_SETTINGS = os.path.join(App.ICON_DIR, 'settings.png')
 
     statusbar_welcome_msec = 3000
-    statusbar_icon_size = QSize(20, 20)
+    statusbar_icon_size = (20, 20)
+
+    event_coalesce_ms = 16  # Merge core events into at most one GUI update per frame
 
-    chat_list_update_ms = 100
+    message_page_size = 50
+    message_list_max_rows = 500
+    search_delay_ms = 200  # wait after the last key press in the search box
+    search_results = 100
+    chat_list_icon_size = (32, 32)
+    chat_list_row_margin = 6
 
-    settings_dialog_size = QSize(320, 400)
+    settings_dialog_size = (320, 400)
 
-    about_dialog_size = QSize(200, 300)
+    about_dialog_size = (200, 300)
 
-    donate_dialog_size = QSize(450, 300)
-    donate_icon_size = QSize(20, 20)
+    donate_dialog_size = (450, 300)
+    donate_icon_size = (20, 20)
     donate_address_copied_msec = 2000
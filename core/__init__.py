@@ -1,3 +0,0 @@
-import core.contacts
-import core.protocol
-import core.utils
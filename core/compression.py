@@ -0,0 +1,169 @@
+"""Compression of binary frames.
+
+Only connections that switched to binary frames (see core.framing) are
+compressed, the flags of a frame tell the receiver how:
+
+    FLAG_DEFLATE_STREAM  deflate with the context of the connection, every
+                         frame ends with a sync flush. Used for chat and
+                         other lines without a stream, which are sent in
+                         order, so small messages profit from the history.
+    FLAG_DEFLATE         a complete zlib stream of its own
+    FLAG_LZMA            a complete xz stream of its own
+
+File data is queued per transfer and the scheduler may reorder it, so it
+is always compressed on its own, with the algorithm from the
+[compression] settings if the peer supports it. A peer tells which ones
+it can decode in its features message.
+
+Blobs that look compressed already (a sample does not shrink) are sent as
+they are. For file data the result is remembered for a few blocks.
+"""
+import lzma
+import threading
+import time
+import zlib
+
+import config
+import core.framing
+import core.metrics
+
+FLAG_DEFLATE_STREAM = 1
+FLAG_DEFLATE = 2
+FLAG_LZMA = 4
+
+SAMPLE_SIZE = 4096
+SAMPLE_RATIO = 0.9  # a sample compressed to more than this is considered incompressible
+SKIP_BLOCKS = 16  # blocks of a stream sent uncompressed after an incompressible sample
+
+stats_lock = threading.Lock()
+stats = {
+    'bytes_in': 0,  # blob bytes that were compressed
+    'bytes_out': 0,  # their compressed size
+    'skipped_bytes': 0,  # blob bytes not compressed, they looked compressed already
+    'compress_seconds': 0.0,  # CPU time
+    'decompress_seconds': 0.0,
+}
+
+
+def count(name: str, amount):
+    with stats_lock:
+        stats[name] += amount
+
+
+def get_stats() -> dict:
+    """Returns a copy of the counters, with bytes_saved added.
+
+    :return: Counter name -> value.
+    :rtype: dict
+    """
+    with stats_lock:
+        result = dict(stats)
+    result['bytes_saved'] = result['bytes_in'] - result['bytes_out']
+    return result
+
+
+def collect_metrics() -> dict:
+    with stats_lock:
+        counters = dict(stats)  # without bytes_saved, it is bytes_in - bytes_out
+    return core.metrics.from_stats('compression', 'Compressed blobs of core.compression, bytes and CPU seconds.',
+                                   counters)
+
+
+core.metrics.add_collector(collect_metrics)
+
+
+def looks_compressed(blob: bytes) -> bool:
+    start = max(0, len(blob) // 2 - SAMPLE_SIZE // 2)
+    sample = blob[start:start + SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) > len(sample) * SAMPLE_RATIO
+
+
+class Compressor:
+    """Compresses the frames of one outgoing connection (not thread-safe)."""
+    def __init__(self, features: set):
+        settings = config.ini.get('compression', config.config_defaults['compression'])
+        self.min_size = settings['min_size']
+        self.level = settings['level']
+        self.use_lzma = settings['algorithm'] == 'lzma' and b'lzma' in features
+        self.deflater = zlib.compressobj(self.level)
+        self.skip: dict = {}  # stream -> blocks to send uncompressed
+
+    @classmethod
+    def for_features(cls, features: set):
+        """Returns a compressor if we and the peer want it, else None."""
+        settings = config.ini.get('compression', config.config_defaults['compression'])
+        if not settings['enabled'] or b'deflate' not in features:
+            return None
+        return cls(features)
+
+    def encode(self, message) -> bytes:
+        """Encodes a message as a frame, compressed if worthwhile."""
+        blob = message.blob
+        if len(blob) < self.min_size:
+            return message.get_frame()
+        stream = message.stream
+        if stream is not None and self.skip.get(stream):
+            self.skip[stream] -= 1
+            count('skipped_bytes', len(blob))
+            return message.get_frame()
+
+        start = time.thread_time()
+        if looks_compressed(blob):
+            if stream is not None:
+                self.skip[stream] = SKIP_BLOCKS
+            count('compress_seconds', time.thread_time() - start)
+            count('skipped_bytes', len(blob))
+            return message.get_frame()
+        if stream is None:
+            # must be sent, the context of the peer has to see it too
+            flags = FLAG_DEFLATE_STREAM
+            payload = self.deflater.compress(blob) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        elif self.use_lzma:
+            flags = FLAG_LZMA
+            payload = lzma.compress(blob, preset=min(self.level, 9))
+        else:
+            flags = FLAG_DEFLATE
+            payload = zlib.compress(blob, self.level)
+        count('compress_seconds', time.thread_time() - start)
+        if flags != FLAG_DEFLATE_STREAM and len(payload) >= len(blob):
+            count('skipped_bytes', len(blob))
+            return message.get_frame()
+        count('bytes_in', len(blob))
+        count('bytes_out', len(payload))
+        return core.framing.encode_frame(message.command_id, flags, payload)
+
+    def forget(self, stream):
+        self.skip.pop(stream, None)
+
+
+class Decompressor:
+    """Decompresses the frames received on one connection."""
+    def __init__(self, max_length: int):
+        self.max_length = max_length
+        self.inflater = zlib.decompressobj()
+
+    def decompress(self, flags: int, payload: bytes) -> bytes:
+        """
+        :raises core.framing.LineTooLongError: If the result would be too long.
+        :raises ValueError: If the payload is damaged or the flags are unknown.
+        """
+        start = time.thread_time()
+        try:
+            if flags == FLAG_DEFLATE_STREAM:
+                inflater = self.inflater
+            elif flags == FLAG_DEFLATE:
+                inflater = zlib.decompressobj()
+            elif flags == FLAG_LZMA:
+                inflater = lzma.LZMADecompressor()
+            else:
+                raise ValueError(f'unknown frame flags {flags}')
+            try:
+                # never inflate more than allowed, the peer could send a bomb
+                blob = inflater.decompress(payload, self.max_length + 1)
+            except (zlib.error, lzma.LZMAError) as err:
+                raise ValueError(f'damaged compressed frame: {err}')
+            if len(blob) > self.max_length:
+                raise core.framing.LineTooLongError(f'frame longer than {self.max_length} bytes')
+            return blob
+        finally:
+            count('decompress_seconds', time.thread_time() - start)
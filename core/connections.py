@@ -0,0 +1,329 @@
+"""Keeps one outgoing connection open to every active buddy.
+
+The ConnectionManager opens the OutConnection of a buddy as soon as the
+buddy is wanted and opens it again whenever it fails or closes:
+
+  - Failed connects are retried with exponential backoff between
+    [connections] backoff_min and backoff_max seconds. The delay is
+    jittered (between half and all of it), so buddies that failed together
+    do not retry together.
+  - At most [connections] max_connecting connects are in progress at any
+    time, the others wait their turn. A restarted Tor client does not get
+    hundreds of circuits to build at once.
+  - A connection that closes within STABLE_TIME after it was established
+    counts as another failure, a peer that drops us at once is not
+    hammered either.
+  - Waiting buddies take turns by their last activity (touch()), the
+    buddies we talk to are connected first.
+  - Managers that share Slots (the identities of one daemon) start no more
+    connects together than the Slots allow, and take turns for them.
+
+Everything runs on the event loop of core.transport, the public methods
+are thread-safe.
+"""
+import heapq
+import itertools
+import random
+import time
+import weakref
+
+import config
+import core.metrics
+import core.transport
+
+STABLE_TIME = 60  # seconds a connection must stay open to reset the backoff
+
+WANTED, WAITING, READY, CONNECTING, CONNECTED = 'wanted', 'waiting', 'ready', 'connecting', 'connected'
+
+
+class Entry:
+    """A buddy the manager keeps connected."""
+    __slots__ = ('buddy', 'state', 'attempts', 'last_active', 'conn', 'timer', 'priority', 'connected_at')
+
+    def __init__(self, buddy, last_active: float):
+        self.buddy = buddy
+        self.state = WANTED
+        self.attempts = 0  # failed connects since the connection was last stable
+        self.last_active = last_active
+        self.conn = None
+        self.timer = None  # of the next retry
+        self.priority = None  # last_active when it was queued
+        self.connected_at = 0.0
+
+
+def get_settings() -> dict:
+    return config.ini.get('connections', config.config_defaults['connections'])
+
+
+managers = weakref.WeakSet()  # of this process, for the metrics
+
+
+def collect_metrics() -> dict:
+    counts = dict.fromkeys((WAITING, READY, CONNECTING, CONNECTED), 0)
+    for manager in list(managers):
+        for state, number in manager.get_stats().items():
+            counts[state] = counts.get(state, 0) + number
+    return {core.metrics.PREFIX + 'buddies': {
+        'type': 'gauge', 'help': 'Buddies of the connection managers by state.',
+        'samples': [{'labels': {'state': state}, 'value': number} for state, number in counts.items()]}}
+
+
+core.metrics.add_collector(collect_metrics)
+
+
+class Slots:
+    """Connect slots shared by the managers of one event loop.
+
+    Every manager still has its own max_connecting, together they never
+    have more than `limit` connects in progress. Free slots go to the
+    managers in turn, one identity with many waiting buddies does not keep
+    the others waiting. Used in the event loop thread only.
+    """
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.used = 0
+        self.managers: list[ConnectionManager] = []  # the next one to get a slot first
+
+    def add(self, manager: 'ConnectionManager'):
+        if manager.slots is self:
+            return
+        if manager.slots is not None:
+            manager.slots.remove(manager)
+        manager.slots = self
+        self.used += manager.connecting
+        self.managers.append(manager)
+
+    def remove(self, manager: 'ConnectionManager'):
+        if manager.slots is not self:
+            return
+        manager.slots = None
+        self.managers.remove(manager)
+        self.used -= manager.connecting
+        self.dispatch()
+
+    def dispatch(self):
+        """Hands out the free slots, one connect per manager in turn."""
+        while self.used < self.limit:
+            for _ in range(len(self.managers)):
+                manager = self.managers.pop(0)
+                self.managers.append(manager)
+                if manager.start_connect():
+                    break
+            else:
+                return  # nobody is ready to connect
+
+
+class ConnectionManager:
+    def __init__(self, buddy_list, loop: core.transport.EventLoop = None, connect=None,
+                 max_connecting: int = None, backoff_min: float = None, backoff_max: float = None,
+                 slots: Slots = None):
+        """
+        :param connect: Opens a connection for a buddy, by default a
+            core.transport.OutConnection. The connection must call
+            connected() and closed() of the manager.
+        :param slots: Shared with other managers from the start, before
+            the first buddy is wanted.
+        """
+        settings = get_settings()
+        self.bl = buddy_list
+        self.loop = loop or core.transport.get_event_loop()
+        self.connect = connect or self.open_connection
+        self.max_connecting = max_connecting or settings['max_connecting']
+        self.backoff_min = backoff_min if backoff_min is not None else settings['backoff_min']
+        self.backoff_max = backoff_max if backoff_max is not None else settings['backoff_max']
+        self.entries: dict[str, Entry] = {}  # address -> entry
+        self.ready = []  # (-priority, seq, address), lazily cleaned
+        self.sequence = itertools.count()
+        self.connecting = 0
+        self.slots: Slots | None = None  # shared with other managers, see Slots
+        self.running = True
+        managers.add(self)
+        if slots is not None:
+            # queued before any want(), the first connect already takes a shared slot
+            self.loop.call(slots.add, self)
+
+    def open_connection(self, buddy):
+        return core.transport.OutConnection(buddy.address, self.bl, buddy, self.loop, manager=self)
+
+    def backoff(self, attempts: int) -> float:
+        """Seconds to wait before the next connect after `attempts` failures."""
+        delay = min(self.backoff_max, self.backoff_min * 2 ** min(attempts - 1, 32)) if attempts else 0
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def want(self, buddy, last_active: float = 0):
+        """Keeps the buddy connected from now on (thread-safe)."""
+        self.loop.call(self._want, buddy, last_active)
+
+    def _want(self, buddy, last_active: float):
+        if not self.running or buddy.address in self.entries:
+            return
+        entry = self.entries[buddy.address] = Entry(buddy, last_active)
+        if getattr(buddy, 'conn_out', None) is not None:
+            entry.conn = buddy.conn_out
+            entry.state = CONNECTED
+        else:
+            self.queue(entry)
+
+    def forget(self, buddy):
+        """Stops reconnecting the buddy (thread-safe), its connection stays open."""
+        self.loop.call(self._forget, buddy.address)
+
+    def _forget(self, address: str):
+        entry = self.entries.pop(address, None)
+        if entry is None:
+            return
+        if entry.timer is not None:
+            entry.timer.cancel()
+        if entry.state == CONNECTING:
+            self.release()
+            self.dispatch()
+
+    def touch(self, address: str):
+        """Notes activity with a buddy (thread-safe), it is reconnected first."""
+        self.loop.call(self._touch, address)
+
+    def _touch(self, address: str):
+        entry = self.entries.get(address)
+        if entry is None:
+            return
+        entry.last_active = time.time()
+        if entry.state == READY:
+            # the old heap item is skipped as stale
+            self.push(entry)
+
+    def connected(self, conn):
+        """Called by a connection once it is established (thread-safe)."""
+        self.loop.call(self._connected, conn)
+
+    def _connected(self, conn):
+        entry = self.entries.get(conn.address)
+        if entry is None or entry.conn is not conn:
+            return
+        if entry.state == CONNECTING:
+            self.release()
+        entry.state = CONNECTED
+        entry.connected_at = time.monotonic()
+        self.dispatch()
+
+    def closed(self, conn):
+        """Called by a connection when it failed or closed (thread-safe)."""
+        self.loop.call(self._closed, conn)
+
+    def _closed(self, conn):
+        entry = self.entries.get(conn.address)
+        if entry is None or entry.conn is not conn:
+            return
+        entry.conn = None
+        if entry.state == CONNECTING:
+            self.release()
+            entry.attempts += 1
+            core.metrics.connect_failures.inc()
+        elif time.monotonic() - entry.connected_at >= STABLE_TIME:
+            entry.attempts = 1
+        else:
+            entry.attempts += 1
+        if self.running:
+            self.queue(entry)
+        self.dispatch()
+
+    def reset(self):
+        """Retries all waiting buddies now, e.g. when Tor is back (thread-safe)."""
+        self.loop.call(self._reset)
+
+    def _reset(self):
+        for entry in self.entries.values():
+            entry.attempts = 0
+            if entry.state == WAITING:
+                entry.timer.cancel()
+                self.queue(entry)
+
+    def queue(self, entry: Entry):
+        """Queues a connect, after the backoff if it failed before."""
+        delay = self.backoff(entry.attempts)
+        if delay:
+            entry.state = WAITING
+            entry.timer = self.loop.loop.call_later(delay, self.on_timer, entry)
+        else:
+            self.push(entry)
+            self.dispatch()
+
+    def on_timer(self, entry: Entry):
+        entry.timer = None
+        if self.entries.get(entry.buddy.address) is entry and entry.state == WAITING:
+            self.push(entry)
+            self.dispatch()
+
+    def push(self, entry: Entry):
+        entry.state = READY
+        entry.priority = entry.last_active
+        heapq.heappush(self.ready, (-entry.priority, next(self.sequence), entry.buddy.address))
+
+    def release(self):
+        """Gives back the slot of a connect that is no longer in progress."""
+        self.connecting -= 1
+        if self.slots is not None:
+            self.slots.used -= 1
+
+    def dispatch(self):
+        """Starts connects while there are free slots."""
+        if self.slots is not None:
+            self.slots.dispatch()
+            return
+        while self.start_connect():
+            pass
+
+    def start_connect(self) -> bool:
+        """Connects the buddy that is next in turn, if this manager has a free slot.
+
+        :return: Whether a connect was started.
+        :rtype: bool
+        """
+        while self.running and self.connecting < self.max_connecting and self.ready:
+            priority, _, address = heapq.heappop(self.ready)
+            entry = self.entries.get(address)
+            if entry is None or entry.state != READY or entry.priority != -priority:
+                continue
+            entry.state = CONNECTING
+            self.connecting += 1
+            if self.slots is not None:
+                self.slots.used += 1
+            core.metrics.connect_attempts.inc()
+            if entry.attempts or entry.connected_at:
+                core.metrics.reconnects.inc()
+            entry.conn = entry.buddy.conn_out = self.connect(entry.buddy)
+            return True
+        return False
+
+    def get_stats(self) -> dict:
+        """Returns the number of buddies in every state."""
+        counts = dict.fromkeys((WAITING, READY, CONNECTING, CONNECTED), 0)
+        for entry in list(self.entries.values()):
+            counts[entry.state] = counts.get(entry.state, 0) + 1
+        return counts
+
+    def stop(self):
+        """Stops connecting (thread-safe), open connections stay open."""
+        self.running = False
+        self.loop.call(self._stop)
+
+    def _stop(self):
+        for entry in self.entries.values():
+            if entry.timer is not None:
+                entry.timer.cancel()
+        self.entries.clear()
+        self.ready.clear()
+        if self.slots is not None:
+            self.slots.remove(self)  # the others get the slots
+        self.connecting = 0
+
+
+global manager
+manager: ConnectionManager | None = None
+
+
+def get_manager(buddy_list=None) -> ConnectionManager:
+    """Returns the shared connection manager, creating it on first use."""
+    global manager
+    if manager is None:
+        manager = ConnectionManager(buddy_list)
+    return manager
@@ -1,8 +1,13 @@
 import copy
-
-from PyQt5.QtGui import QPixmap
+import pathlib
+import time
 
 import config
+import core.events
+import core.profiling
+import core.search
+import core.storage
+import core.utils
 
 
 buddies = [
@@ -33,36 +38,343 @@ def shorten_hostname(hostname: str, length: int = 10):
     return hostname[:length] + '…' + hostname[-length:]
 
 
-def get_buddies(group: int = 0, status: int = config.STATUS_ALL) -> list:
-    buddies_list = copy.deepcopy(buddies)
-    # Filter groups
-    # For 0 is for Everyone group, we filter 'Not-Everyone'
-    if group:
-        buddies_filtered = []
-        for buddy in buddies_list:
-            if buddy['group'] == group:
-                buddies_filtered.append(buddy)
-        buddies_list = buddies_filtered
+class ContactStore:
+    """Buddies indexed by group and status.
 
-    # Now check buddies status
-    # If All selected then do not filter the results
-    if status == config.STATUS_ALL:
+    Every buddy is kept in four buckets of the index: its (group, status),
+    (0, status) for the Everyone group, (group, STATUS_ALL) and
+    (0, STATUS_ALL). So every filter of the chat list is answered by a
+    single dict lookup. The sorted list of a bucket is built once and kept
+    until the bucket changes.
+    """
+    def __init__(self, buddies_list: list = ()):
+        self.buddies: dict[str, dict] = {}
+        self.index: dict[tuple[int, int], dict[str, dict]] = {}
+        self.sorted_cache: dict[tuple[int, int], list] = {}
         for buddy in buddies_list:
-            buddy['icon'] = QPixmap(buddy['icon'])
-        return buddies_list
-    # If status selected (other than All), then filter the results accordingly
-    else:
-        buddies_result = []
-        for buddy in buddies_list:
-            if buddy['status'] == status:
-                buddy['icon'] = QPixmap(buddy['icon'])
-                buddies_result.append(buddy)
-        return buddies_result
+            self.add(buddy)
+
+    def __len__(self):
+        return len(self.buddies)
+
+    @staticmethod
+    def index_keys(buddy: dict) -> tuple:
+        group, status = buddy['group'], buddy['status']
+        # a buddy of the Everyone group (0) has only two buckets
+        return tuple(dict.fromkeys(((group, status), (0, status), (group, config.STATUS_ALL),
+                                    (0, config.STATUS_ALL))))
+
+    def add(self, buddy: dict):
+        if buddy['id'] in self.buddies:
+            self.unindex(self.buddies.pop(buddy['id']))
+        self.buddies[buddy['id']] = buddy
+        self.reindex(buddy)
+        core.events.publish(core.events.CONTACTS_CHANGED)
+
+    def remove(self, buddy_id: str):
+        self.unindex(self.buddies.pop(buddy_id))
+        core.events.publish(core.events.CONTACTS_CHANGED)
+
+    def reindex(self, buddy: dict):
+        for key in self.index_keys(buddy):
+            self.index.setdefault(key, {})[buddy['id']] = buddy
+            self.sorted_cache.pop(key, None)
+
+    def unindex(self, buddy: dict):
+        for key in self.index_keys(buddy):
+            del self.index[key][buddy['id']]
+            self.sorted_cache.pop(key, None)
+
+    def update(self, buddy_id: str, **fields):
+        """Changes fields of a buddy, e.g. update('1', status=config.STATUS_OFFLINE)."""
+        buddy = self.buddies[buddy_id]
+        if 'group' in fields or 'status' in fields:
+            self.unindex(buddy)
+            buddy.update(fields)
+            self.reindex(buddy)
+        else:
+            buddy.update(fields)
+            if 'position' in fields:
+                for key in self.index_keys(buddy):
+                    self.sorted_cache.pop(key, None)
+        core.events.publish(core.events.CONTACTS_CHANGED)
+
+    def get(self, group: int = 0, status: int = config.STATUS_ALL) -> list:
+        """Returns the buddies matching the filter, sorted by position.
+
+        The returned list is shared, callers must not modify it.
+        """
+        key = (group, status)
+        try:
+            return self.sorted_cache[key]
+        except KeyError:
+            pass
+        result = sorted(self.index.get(key, {}).values(), key=lambda buddy: buddy['position'])
+        self.sorted_cache[key] = result
+        return result
+
+
+# icon file name -> QPixmap, every file is decoded only once
+icon_cache: dict = {}
+
+
+def get_icon(filename: str):
+    """Returns the QPixmap of an icon file.
+
+    Qt is only imported here, the rest of the module works without it.
+    """
+    try:
+        return icon_cache[filename]
+    except KeyError:
+        from PyQt5.QtGui import QPixmap
+        with core.profiling.phase('pixmaps'):
+            icon = icon_cache[filename] = QPixmap(filename)
+        return icon
+
+
+def get_buddies(group: int = 0, status: int = config.STATUS_ALL) -> list:
+    """Returns the buddies to show in the chat list.
+
+    For 0 is for Everyone group, STATUS_ALL does not filter by status.
+    The buddies are not copied: use get_icon(buddy['icon']) for the pixmap.
+    """
+    return profile.store.get(group, status)
+
+
+class Profile:
+    """The buddy list and the message history of one identity.
+
+    The functions of this module work on the default profile, the one of
+    the GUI. core.identity opens a Profile for every further identity.
+    """
+    def __init__(self, seed: bool = False):
+        """
+        :param seed: Start with the built-in buddies and messages, they are
+            written to the store when it is opened for the first time.
+        """
+        # copies, every seeded profile changes its own
+        self.store = ContactStore(copy.deepcopy(buddies) if seed else ())
+        self.messages = copy.deepcopy(messages) if seed else {}  # history until the store is opened
+        self.message_store: core.storage.MessageStore | None = None
+        self.search_index = self.build_memory_index()
+        self.activity_callbacks = []
+        self.activity_changed = False  # last_active of a buddy not saved yet
+
+    def open(self, path: str | pathlib.Path = None):
+        """Opens the message store of the profile and loads the buddy list from it."""
+        if path is None:
+            path = pathlib.Path(core.utils.get_data_dir(), config.App.PROFILE_DIR)
+        self.message_store = core.storage.MessageStore(path, config.ini['storage']['history_max_messages'])
+        self.search_index = core.search.SearchIndex(pathlib.Path(path, 'search'), self.fetch_message)
+        self.message_store.add_sync_callback(self.search_index.flush)
+        self.message_store.add_sync_callback(self.save_activity)
+        saved_buddies = self.message_store.load_buddies()
+        if saved_buddies is None:
+            self.save_buddies()
+            for buddy_id, history in self.messages.items():
+                for message in history:
+                    self.search_index.add(buddy_id, self.message_store.append(buddy_id, message), message)
+        else:
+            if not self.search_index_matches():
+                self.rebuild_search_index()
+            self.store = ContactStore(saved_buddies)
+            core.events.publish(core.events.CONTACTS_CHANGED)
+
+    def close(self):
+        if self.message_store is None:
+            return
+        self.save_buddies()
+        self.message_store.close()
+        self.message_store = None
+        self.search_index.close()
+        self.search_index = self.build_memory_index()
+
+    def save_buddies(self):
+        if self.message_store is not None:
+            self.activity_changed = False
+            self.message_store.save_buddies(sorted(self.store.buddies.values(), key=lambda buddy: buddy['position']))
+
+    def save_activity(self):
+        """Saves the buddy list if a last_active changed, called after the messages were synced."""
+        if self.activity_changed:
+            self.save_buddies()
+
+    def add_activity_callback(self, callback):
+        """Adds a function that is called with the buddy id of every added message."""
+        self.activity_callbacks.append(callback)
+
+    def add_buddy(self, buddy: dict):
+        self.store.add(buddy)
+        self.save_buddies()
+
+    def remove_buddy(self, buddy_id: str):
+        self.store.remove(buddy_id)
+        self.save_buddies()
+
+    def read_messages(self, buddy_id, start: int, end: int) -> tuple[int, list]:
+        """Reads messages start..end-1 of a conversation.
+
+        :return: Number of the first returned message and the messages.
+        :rtype: tuple[int, list]
+        """
+        if self.message_store is None:
+            return start, self.messages.get(buddy_id, [])[start:end]
+        if start >= end:
+            return start, []
+        first = max(start, self.message_store.base(buddy_id))
+        return first, self.message_store.read(buddy_id, start, end - start)
+
+    def count_messages(self, buddy_id) -> int:
+        if self.message_store is None:
+            return len(self.messages.get(buddy_id, ()))
+        return self.message_store.count(buddy_id)
+
+    def get_messages_page(self, buddy_id, anchor: int = None, count: int = 50,
+                          newer: bool = False) -> tuple[int, list]:
+        """Returns a window of a conversation.
+
+        Messages are numbered from 0 (the oldest). Without an anchor the
+        newest messages are returned. With an anchor the `count` messages
+        before it are returned, or after it if `newer` is set. The anchor
+        itself is never included.
+
+        :return: Number of the first returned message and the messages.
+        :rtype: tuple[int, list]
+        """
+        total = self.count_messages(buddy_id)
+        if anchor is None:
+            start = max(0, total - count)
+            return self.read_messages(buddy_id, start, total)
+        elif newer:
+            start = min(anchor + 1, total)
+            return self.read_messages(buddy_id, start, min(start + count, total))
+        else:
+            end = min(anchor, total)
+            return self.read_messages(buddy_id, max(0, end - count), end)
+
+    def add_message(self, buddy_id, message: str):
+        if self.message_store is None:
+            history = self.messages.setdefault(buddy_id, [])
+            history.append(message)
+            number = len(history) - 1
+        else:
+            number = self.message_store.append(buddy_id, message)
+        self.search_index.add(buddy_id, number, message)
+        buddy = self.store.buddies.get(buddy_id)
+        if buddy is not None:
+            # not an update(), the chat list does not show it
+            buddy['last_active'] = time.time()
+            self.activity_changed = True
+        for callback in list(self.activity_callbacks):
+            callback(buddy_id)
+        core.events.publish(core.events.MESSAGES_CHANGED, buddy_id)
+
+    def fetch_message(self, buddy_id, number: int) -> str | None:
+        result = self.read_messages(buddy_id, number, number + 1)[1]
+        return result[0] if result else None
+
+    def search_messages(self, query: str, limit: int = 50) -> list[tuple[str, int, str]]:
+        """Searches all conversations, see core.search for the query syntax.
+
+        :return: (buddy_id, message number, text) of the matching messages, the most recent first.
+        :rtype: list[tuple[str, int, str]]
+        """
+        result = []
+        for buddy_id, number in self.search_index.search(query, limit):
+            text = self.fetch_message(buddy_id, number)
+            # None if the message was dropped by compaction
+            if text is not None:
+                result.append((buddy_id, number, text))
+        return result
+
+    def build_memory_index(self) -> core.search.SearchIndex:
+        index = core.search.SearchIndex(fetch_text=self.fetch_message)
+        for buddy_id, history in self.messages.items():
+            for number, message in enumerate(history):
+                index.add(buddy_id, number, message)
+        return index
+
+    def search_index_matches(self) -> bool:
+        """Checks whether the last indexed message of every conversation is its last stored one.
+
+        After a crash the journal of the index may miss messages the store
+        has, or the other way round.
+        """
+        indexed = self.search_index.last_numbers()
+        stored = {buddy_id: self.message_store.count(buddy_id) for buddy_id in self.message_store.buddy_ids()}
+        return indexed == {buddy_id: count for buddy_id, count in stored.items() if count}
+
+    def rebuild_search_index(self):
+        """Indexes the whole message store, oldest messages first."""
+        self.search_index.clear()
+        records = []
+        for buddy_id in self.message_store.buddy_ids():
+            conversation = self.message_store.conversation(buddy_id)
+            start = conversation.base
+            for number, (timestamp, text) in enumerate(conversation.read(start, conversation.count - start), start):
+                records.append((timestamp, buddy_id, number, text))
+        records.sort(key=lambda record: record[0])
+        for _, buddy_id, number, text in records:
+            self.search_index.add(buddy_id, number, text)
+        self.search_index.save()
+
+
+global profile
+profile: Profile = Profile(seed=True)
+
+
+def open_store(path: str | pathlib.Path = None):
+    """Opens the message store of the profile and loads the buddy list from it.
+
+    On the first start the built-in buddies and messages are written to it.
+    """
+    profile.open(path)
+
+
+def close_store():
+    profile.close()
+
+
+def save_buddies():
+    profile.save_buddies()
+
+
+def add_buddy(buddy: dict):
+    profile.add_buddy(buddy)
+
+
+def remove_buddy(buddy_id: str):
+    profile.remove_buddy(buddy_id)
+
+
+def read_messages(buddy_id, start: int, end: int) -> tuple[int, list]:
+    return profile.read_messages(buddy_id, start, end)
 
 
 def get_messages(buddy_id) -> list:
-    return messages[buddy_id]
+    return read_messages(buddy_id, 0, count_messages(buddy_id))[1]
+
+
+def count_messages(buddy_id) -> int:
+    return profile.count_messages(buddy_id)
+
+
+def get_messages_page(buddy_id, anchor: int = None, count: int = 50, newer: bool = False) -> tuple[int, list]:
+    return profile.get_messages_page(buddy_id, anchor, count, newer)
+
+
+def add_message(buddy_id, message: str):
+    profile.add_message(buddy_id, message)
+
+
+def fetch_message(buddy_id, number: int) -> str | None:
+    return profile.fetch_message(buddy_id, number)
+
+
+def search_messages(query: str, limit: int = 50) -> list[tuple[str, int, str]]:
+    return profile.search_messages(query, limit)
 
 
 def get_groups() -> list:
     return groups
+
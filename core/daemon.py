@@ -0,0 +1,373 @@
+"""Headless OnionChat node, started by onionchat-daemon.py.
+
+Everything runs on the event loop of core.transport: the Listener, the
+connections of the ConnectionManager and the control server. The thread
+count does not grow with the number of buddies: the event loop, the sync
+thread of the message store, the thread of the control commands that
+touch the disk and the reader of the Tor control connection (with a
+portable Tor) are all there is.
+
+The control server listens on a unix socket (only the user can connect,
+it is created with mode 0600). A client sends one JSON object per line
+and gets one JSON object per line back:
+
+    {"id": 1, "command": "add_buddy", "address": "...", "name": "Bot"}
+    {"id": 1, "ok": true, "result": {...}}
+    {"id": 2, "ok": false, "error": "unknown command 'foo'"}
+
+After "subscribe" the client also gets {"event": name, "args": [...]} for
+every core.events notification. See Daemon.commands for all commands.
+
+Besides its own identity the daemon hosts the identities of
+core.identity. The buddy and message commands take an "identity" (the
+name, "" or none for the daemon's own) to work on one of them.
+
+With [sharding] workers the connections of the daemon's own identity are
+served by worker processes (core.sharding), the control server, the
+profile and the hosted identities stay in the daemon.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import json
+import os
+import pathlib
+import signal
+import threading
+import time
+
+import config
+import core.compression
+import core.contacts
+import core.events
+import core.filetransfer
+import core.identity
+import core.metrics
+import core.ratelimit
+import core.sharding
+import core.torcontrol
+import core.transport
+import core.utils
+
+EVENTS = (core.events.CONTACTS_CHANGED, core.events.MESSAGES_CHANGED, core.events.CONNECTIONS_CHANGED,
+          core.events.TRANSFERS_CHANGED, core.events.TOR_STATUS_CHANGED)
+MAX_REQUEST_LENGTH = 1024 * 1024
+INLINE = ('status', 'buddies', 'transfers', 'identities', 'metrics', 'shutdown')  # answered from memory
+BLOCKING = ('add_identity', 'remove_identity')
+
+
+class ControlError(Exception):
+    """A control command failed, the message is sent to the client."""
+
+
+def get_settings() -> dict:
+    return config.ini.get('daemon', config.config_defaults['daemon'])
+
+
+def get_socket_path() -> pathlib.Path:
+    path = get_settings()['control_socket']
+    return pathlib.Path(path) if path else pathlib.Path(core.utils.get_data_dir(), 'onionchat.sock')
+
+
+def get_identities_dir() -> pathlib.Path:
+    path = get_settings()['identities_dir']
+    return pathlib.Path(path) if path else pathlib.Path(core.utils.get_data_dir(), 'identities')
+
+
+class Daemon:
+    def __init__(self, socket_path: str | pathlib.Path = None, store_path: str | pathlib.Path = None,
+                 listen_socket=None, identities_dir: str | pathlib.Path = None,
+                 controller: core.torcontrol.TorController = None):
+        """
+        :param listen_socket: A bound socket for the Listener, by default the
+            [client] listen_interface and listen_port are used.
+        :param controller: Creates the onion services of the hosted
+            identities, without one they only listen locally.
+        """
+        self.socket_path = pathlib.Path(socket_path) if socket_path else get_socket_path()
+        self.store_path = store_path
+        self.listen_socket = listen_socket
+        self.loop = core.transport.get_event_loop()
+        # a profile of its own, the module profile of core.contacts has the built-in demo buddies
+        self.main = core.identity.Identity('', core.utils.get_data_dir() if store_path is None else store_path,
+                                           self.loop, core.contacts.Profile(), shared_manager=True,
+                                           workers=core.sharding.get_workers())
+        self.bl = self.main.bl
+        self.host = core.identity.IdentityHost(identities_dir or get_identities_dir(), self.loop, controller,
+                                               self.main)
+        self.server = None
+        self.started = time.time()
+        self.stopped = threading.Event()
+        self.subscribers = set()  # writers of the clients that get events
+        # one command at a time, as if they ran in the loop, but without stalling the connections
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='onionchat-control')
+        self.commands = {
+            'status': self.status,
+            'buddies': self.buddies,
+            'add_buddy': self.add_buddy,
+            'add_buddies': self.add_buddies,
+            'remove_buddy': self.remove_buddy,
+            'messages': self.messages,
+            'search': self.search,
+            'send_file': self.send_file,
+            'transfers': self.transfers,
+            'identities': self.identities,
+            'metrics': self.metrics,
+            'add_identity': self.add_identity,
+            'remove_identity': self.remove_identity,
+            'subscribe': None,  # handled by the connection
+            'shutdown': self.shutdown,
+        }
+
+    def start(self):
+        listen_socket = self.listen_socket or core.identity.bind_listen_socket(config.ini['client']['listen_port'])
+        self.main.start(listen_socket, self.store_path)
+        self.main.hostname = config.ini['client']['hostname']
+        self.host.load()
+        for event in EVENTS:
+            core.events.subscribe(event, self.make_publisher(event))
+        self.loop.submit(self.start_server()).result()
+        core.metrics.start_server()
+        print(f'(1) daemon running, control socket {self.socket_path}')
+
+    async def start_server(self):
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        # the socket is created with these permissions, there is no moment it is open for others
+        umask = os.umask(0o177)
+        try:
+            self.server = await asyncio.start_unix_server(self.on_client, str(self.socket_path),
+                                                          limit=MAX_REQUEST_LENGTH)
+        finally:
+            os.umask(umask)
+
+    def run(self):
+        """Starts the daemon and blocks until it is shut down (by command or SIGTERM)."""
+        self.start()
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda *_: self.stopped.set())
+        try:
+            while not self.stopped.wait(1):
+                pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.loop.call(self.server.close)
+            self.server = None
+        core.metrics.stop_server()
+        self.executor.shutdown()
+        self.host.stop()
+        self.main.stop()
+        self.socket_path.unlink(missing_ok=True)
+        print('(1) daemon stopped')
+
+    def make_publisher(self, event: str):
+        def publish(*args):
+            # called in the publishing thread, the writers belong to the loop
+            if self.subscribers:
+                line = json.dumps({'event': event, 'args': [sorted(arg) if isinstance(arg, set) else arg
+                                                            for arg in args]}).encode('utf-8') + b'\n'
+                self.loop.call(self.write_event, line)
+        return publish
+
+    def write_event(self, line: bytes):
+        for writer in list(self.subscribers):
+            if writer.is_closing():
+                self.subscribers.discard(writer)
+            elif writer.transport.get_write_buffer_size() < MAX_REQUEST_LENGTH:
+                # a client that does not read its events misses some
+                writer.write(line)
+
+    async def on_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                response = await self.handle(line, writer)
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+    async def handle(self, line: bytes, writer) -> dict:
+        """Executes one request and returns the response.
+
+        Only the INLINE commands run in the event loop thread, the others
+        read or write files and would stall every connection meanwhile.
+        They run one after the other in the thread of self.executor,
+        except the BLOCKING ones: they wait for Tor or for the event loop
+        itself and run in the default executor.
+        """
+        request_id = None
+        try:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                raise ControlError('request is not JSON')
+            if not isinstance(request, dict):
+                raise ControlError('request is not an object')
+            request_id = request.get('id')
+            name = request.get('command')
+            if name not in self.commands:
+                raise ControlError(f'unknown command {name!r}')
+            if name == 'subscribe':
+                self.subscribers.add(writer)
+                result = list(EVENTS)
+            else:
+                arguments = {key: value for key, value in request.items() if key not in ('id', 'command')}
+                try:
+                    inspect.signature(self.commands[name]).bind(**arguments)
+                except TypeError as err:
+                    raise ControlError(f'bad arguments for {name}: {err}')
+                command = functools.partial(self.commands[name], **arguments)
+                if name in INLINE:
+                    result = command()
+                else:
+                    executor = None if name in BLOCKING else self.executor
+                    result = await asyncio.get_running_loop().run_in_executor(executor, command)
+        except ControlError as err:
+            return {'id': request_id, 'ok': False, 'error': str(err)}
+        except Exception as err:
+            print(f'(1) control command failed: {err!r}')
+            return {'id': request_id, 'ok': False, 'error': f'internal error: {err!r}'}
+        return {'id': request_id, 'ok': True, 'result': result}
+
+    @staticmethod
+    def check_address(address) -> str:
+        if not isinstance(address, str) or not core.utils.is_valid_address(address):
+            raise ControlError(f'invalid onion address {address!r}')
+        return address
+
+    def get_identity(self, name) -> core.identity.Identity:
+        try:
+            return self.host.get(name or '')
+        except (KeyError, TypeError):
+            raise ControlError(f'no identity {name!r}')
+
+    def status(self) -> dict:
+        identities = list(self.host.identities.values())
+        incoming = 0
+        outgoing = {}
+        for identity in identities:
+            stats = identity.bl.get_stats()
+            incoming += stats['incoming']
+            for state, number in stats['outgoing'].items():
+                outgoing[state] = outgoing.get(state, 0) + number
+        return {
+            'hostname': self.main.hostname,
+            'uptime': time.time() - self.started,
+            'identities': len(identities),
+            'buddies': sum(len(identity.bl.buddies) for identity in identities),
+            'incoming_connections': incoming,
+            'outgoing': outgoing,
+            'transfers': len(core.filetransfer.get_transfers()),
+            'threads': threading.active_count(),
+            'compression': core.compression.get_stats(),
+            'limits': core.ratelimit.get_stats(),
+        }
+
+    def buddies(self, identity: str = '') -> list[dict]:
+        selected = self.get_identity(identity)
+        result = []
+        for buddy in selected.profile.store.get():
+            network = selected.bl.buddies.get(buddy['id'])
+            result.append({
+                'address': buddy['id'],
+                'name': buddy['name'],
+                'connected_out': network is not None and network.conn_out is not None
+                and network.conn_out.writer is not None,
+                'connected_in': network is not None and network.conn_in is not None,
+            })
+        return result
+
+    def add_buddy(self, address: str, name: str = '', identity: str = '') -> dict:
+        return self.add_buddies([{'address': address, 'name': name}], identity)[0]
+
+    def add_buddies(self, buddies: list, identity: str = '') -> list[dict]:
+        """Adds many buddies and saves the buddy list once."""
+        selected = self.get_identity(identity)
+        entries = []
+        for buddy in buddies:
+            if not isinstance(buddy, dict):
+                raise ControlError('every buddy must be an object')
+            address = buddy.get('address')
+            if not isinstance(address, str):
+                raise ControlError(f'invalid onion address {address!r}')
+            entries.append((address, str(buddy.get('name', ''))))
+        valid = core.utils.validate_addresses(address for address, _ in entries)
+        for address, _ in entries:
+            if not valid[address]:
+                raise ControlError(f'invalid onion address {address!r}')
+        selected.add_buddies(entries)
+        return [{'address': address} for address, _ in entries]
+
+    def remove_buddy(self, address: str, identity: str = '') -> dict:
+        selected = self.get_identity(identity)
+        if address not in selected.profile.store.buddies:
+            raise ControlError(f'no buddy {address!r}')
+        selected.remove_buddy(address)
+        return {'address': address}
+
+    def messages(self, address: str, count: int = 50, before: int = None, identity: str = '') -> dict:
+        selected = self.get_identity(identity)
+        if self.check_address(address) not in selected.profile.store.buddies:
+            raise ControlError(f'no buddy {address!r}')
+        first, texts = selected.profile.get_messages_page(address, before, int(count))
+        return {'first': first, 'messages': texts}
+
+    def search(self, query: str, limit: int = 50, identity: str = '') -> list[dict]:
+        return [{'address': buddy_id, 'number': number, 'text': text}
+                for buddy_id, number, text in self.get_identity(identity).profile.search_messages(str(query),
+                                                                                                  int(limit))]
+
+    def send_file(self, address: str, path: str, identity: str = '') -> dict:
+        buddy = self.get_identity(identity).bl.buddies.get(address)
+        if buddy is None or buddy.conn_out is None:
+            raise ControlError(f'{address!r} is not connected')
+        try:
+            sender = core.filetransfer.FileSender(buddy, path)
+        except OSError as err:
+            raise ControlError(f'cannot send {path}: {err}')
+        return {'transfer': sender.id}
+
+    def transfers(self) -> list[dict]:
+        return [{'id': transfer.id, 'address': transfer.buddy.address, 'filename': transfer.filename,
+                 'size': transfer.size, 'done': transfer.bytes_done, 'rate': transfer.rate,
+                 'outgoing': isinstance(transfer, core.filetransfer.FileSender)}
+                for transfer in core.filetransfer.get_transfers()]
+
+    def identities(self) -> list[dict]:
+        return [{'name': identity.name, 'hostname': identity.hostname, 'listen_port': identity.listen_port,
+                 'buddies': len(identity.bl.buddies), **identity.bl.get_stats()}
+                for identity in list(self.host.identities.values())]
+
+    def metrics(self) -> dict:
+        """The snapshot of core.metrics, the same values as on the metrics port."""
+        return core.metrics.snapshot()
+
+    def add_identity(self, name: str) -> dict:
+        try:
+            identity = self.host.add(name)
+        except ValueError as err:
+            raise ControlError(str(err))
+        return {'name': identity.name, 'hostname': identity.hostname, 'listen_port': identity.listen_port}
+
+    def remove_identity(self, name: str) -> dict:
+        try:
+            self.host.remove(name)
+        except KeyError:
+            raise ControlError(f'no identity {name!r}')
+        except ValueError as err:
+            raise ControlError(str(err))
+        return {'name': name}
+
+    def shutdown(self) -> dict:
+        # stop() waits for the event loop, it must not run in it
+        self.loop.loop.call_soon(self.stopped.set)
+        return {}
@@ -0,0 +1,36 @@
+"""Notifications from the core to whoever is interested (usually the GUI).
+
+Core modules publish an event whenever something changes, subscribers are
+called right away in the publishing thread. The core does not know about
+Qt; gui.events forwards these events into the GUI thread.
+"""
+import threading
+
+CONTACTS_CHANGED = 'contacts_changed'  # no arguments
+MESSAGES_CHANGED = 'messages_changed'  # buddy_id
+CONNECTIONS_CHANGED = 'connections_changed'  # no arguments
+TRANSFERS_CHANGED = 'transfers_changed'  # transfer id
+TOR_STATUS_CHANGED = 'tor_status_changed'  # no arguments, see core.torcontrol
+
+subscribers: dict[str, list] = {}
+subscribers_lock = threading.Lock()
+
+
+def subscribe(event: str, callback):
+    with subscribers_lock:
+        # copy on write, so publish() can iterate without the lock
+        subscribers[event] = subscribers.get(event, []) + [callback]
+
+
+def unsubscribe(event: str, callback):
+    with subscribers_lock:
+        callbacks = list(subscribers.get(event, []))
+        if callback in callbacks:
+            callbacks.remove(callback)
+        subscribers[event] = callbacks
+
+
+def publish(event: str, *args):
+    """Calls all subscribers of an event in the calling thread."""
+    for callback in subscribers.get(event, ()):
+        callback(*args)
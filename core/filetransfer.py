@@ -0,0 +1,469 @@
+"""Streaming file transfers, the engine behind the file* protocol messages.
+
+A FileSender reads the file block by block into one reusable buffer, so
+memory use does not depend on the file size: at most config.FILE_WINDOW
+blocks are unacknowledged at any time and nothing else is kept.
+
+A FileReceiver writes every verified block at its offset into a .part file
+in the temp directory and remembers how far the file is complete in a
+small .offset file next to it. When the same buddy offers the same file
+again after an interruption, the receiver asks the sender to continue at
+that offset instead of starting over.
+
+Both ends track their progress as a watermark (everything before it is
+done) plus the blocks done beyond it, which arrive out of order only
+after a retransmission. Blocks get lost when the outgoing connection
+closes, so the sender sends everything from the watermark on again when
+the handshake with the buddy is complete again (resend()) and when no
+block was acknowledged for config.FILE_RETRANSMIT_TIMEOUT (the Retransmitter
+checks the senders on the event loop while there are any). Throughput and
+ETA are published with TRANSFERS_CHANGED at most every
+config.TRANSFER_PROGRESS_INTERVAL.
+
+The filedata lines of a transfer are a stream for core.scheduler, so they
+never delay chat lines and share the upload limit fairly.
+
+The name of a received file is whatever the sender offered,
+safe_filename() turns it into a plain file name in the temp directory.
+"""
+import hashlib
+import os
+import pathlib
+import re
+import tempfile
+import threading
+import time
+
+import config
+import core.events
+import core.protocol
+import core.transport
+import core.utils
+
+# transfer id -> transfer, the protocol messages look them up here
+senders: dict[str, 'FileSender'] = {}
+receivers: dict[str, 'FileReceiver'] = {}
+
+RETRANSMIT_CHECK_INTERVAL = 1.0  # seconds
+MAX_FILENAME_BYTES = 200  # leaves room for " (n)" below the usual limit of 255
+UNSAFE_CHARACTERS = re.compile(r'[\x00-\x1f\x7f<>:"/\\|?*]')
+
+
+def get_temp_dir() -> pathlib.Path:
+    """Returns the directory for incoming files, see the 'files' settings."""
+    settings = config.ini.get('files', config.config_defaults['files'])
+    if settings['temp_files_custom_dir']:
+        path = pathlib.Path(settings['temp_files_custom_dir'])
+    elif settings['temp_files_data_dir']:
+        path = pathlib.Path(core.utils.get_data_dir(), 'tmp')
+    else:
+        path = pathlib.Path(tempfile.gettempdir(), 'onionchat')
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def safe_filename(filename: str) -> str:
+    """Turns a file name offered by a buddy into one that can be created in the temp directory.
+
+    Directories (of any platform) are cut off, characters that are not
+    allowed in file names on Windows are replaced, names that are empty
+    or only dots get a generated name.
+    """
+    name = filename.replace('\\', '/').rsplit('/', 1)[-1]
+    name = UNSAFE_CHARACTERS.sub('_', name).strip(' .')
+    if not name:
+        return f'file-{os.urandom(4).hex()}'
+    if len(name.encode('utf-8')) > MAX_FILENAME_BYTES:
+        suffix = pathlib.PurePath(name).suffix[:16]
+        stem = name[:len(name) - len(suffix)]
+        while len((stem + suffix).encode('utf-8')) > MAX_FILENAME_BYTES:
+            stem = stem[:-1]
+        name = stem + suffix
+    return name
+
+
+class Watermark:
+    """Tracks which blocks of a file are done."""
+    def __init__(self, size: int, block_size: int, start: int = 0):
+        self.size = size
+        self.block_size = block_size
+        self.position = start  # everything before is done
+        self.beyond: set[int] = set()
+
+    def valid(self, start: int) -> bool:
+        return 0 <= start < self.size and start % self.block_size == 0
+
+    def done(self, start: int) -> bool:
+        return start < self.position or start in self.beyond
+
+    def add(self, start: int):
+        if start < self.position:
+            return
+        self.beyond.add(start)
+        while self.position in self.beyond:
+            self.beyond.remove(self.position)
+            self.position = min(self.position + self.block_size, self.size)
+
+    def advance(self, position: int):
+        """Marks everything before position as done."""
+        if position > self.position:
+            self.position = position
+            self.beyond = {start for start in self.beyond if start >= position}
+            while self.position in self.beyond:
+                self.beyond.remove(self.position)
+                self.position = min(self.position + self.block_size, self.size)
+
+    @property
+    def complete(self) -> bool:
+        return self.position >= self.size
+
+    def block_length(self, start: int) -> int:
+        return min(self.block_size, self.size - start)
+
+
+class Transfer:
+    """What senders and receivers have in common."""
+    def __init__(self, buddy, transfer_id: str, filename: str, size: int, block_size: int):
+        self.buddy = buddy
+        self.id = transfer_id
+        self.filename = filename
+        self.size = size
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.progress = Watermark(size, block_size)
+        self.started = time.time()
+        self.running = True
+        self.reason = None  # why it was stopped
+        self.rate = 0.0  # bytes per second, smoothed
+        self.sample_time = time.monotonic()
+        self.sample_bytes = 0
+
+    @property
+    def bytes_done(self) -> int:
+        # blocks beyond the watermark are counted as full, close enough
+        return min(self.progress.position + len(self.progress.beyond) * self.block_size, self.size)
+
+    @property
+    def eta(self) -> float | None:
+        """Seconds until the transfer is complete, None if unknown."""
+        if not self.rate:
+            return None
+        return (self.size - self.bytes_done) / self.rate
+
+    def progressed(self):
+        """Updates the throughput and publishes it, but not for every block."""
+        now = time.monotonic()
+        elapsed = now - self.sample_time
+        if elapsed < config.TRANSFER_PROGRESS_INTERVAL:
+            return
+        done = self.bytes_done
+        rate = max(0, done - self.sample_bytes) / elapsed
+        self.rate = rate if not self.rate else 0.7 * self.rate + 0.3 * rate
+        self.sample_time = now
+        self.sample_bytes = done
+        self.changed()
+
+    def changed(self):
+        core.events.publish(core.events.TRANSFERS_CHANGED, self.id)
+
+
+class FileSender(Transfer):
+    def __init__(self, buddy, path: str | pathlib.Path, block_size: int = config.FILE_BLOCK_SIZE,
+                 window: int = config.FILE_WINDOW):
+        self.path = pathlib.Path(path)
+        self.file = open(self.path, 'rb')
+        super().__init__(buddy, os.urandom(8).hex(), self.path.name, os.fstat(self.file.fileno()).st_size,
+                         block_size)
+        self.window = window
+        self.buffer = bytearray(block_size)
+        self.view = memoryview(self.buffer)
+        self.next_start = 0
+        self.in_flight: set[int] = set()
+        self.last_ack = time.monotonic()  # or the last retransmission
+        senders[self.id] = self
+        get_retransmitter().schedule()
+        self.offer()
+        if self.size:
+            with self.lock:
+                self.fill()
+        else:
+            self.finish()
+
+    def offer(self):
+        core.protocol.ProtocolFilename(self.buddy, blob=(self.id, self.size, self.block_size, self.filename)).send()
+
+    def fill(self):
+        """Sends blocks until the window is full, call with the lock held."""
+        while self.running and len(self.in_flight) < self.window and self.next_start < self.size:
+            start = self.next_start
+            if not self.progress.done(start) and not self.send_block(start):
+                # not connected, resend() or the Retransmitter continue here
+                return
+            self.next_start += self.block_size
+
+    def send_block(self, start: int) -> bool:
+        """Sends a block over the outgoing connection.
+
+        :return: False if the buddy has no outgoing connection.
+        :rtype: bool
+        """
+        conn = self.buddy.conn_out
+        if conn is None:
+            return False
+        self.file.seek(start)
+        data = self.view[:self.file.readinto(self.buffer)]
+        header = b'%s %d %s ' % (self.id.encode('ascii'), start, hashlib.md5(data).hexdigest().encode('ascii'))
+        self.in_flight.add(start)
+        # the only copy of the data, the buffer is reused for the next block
+        message = core.protocol.ProtocolFiledata(self.buddy, conn, blob=header + data)
+        message.stream = self.id
+        message.send()
+        return True
+
+    def retransmit(self):
+        """Sends everything that was not acknowledged again, from the watermark on."""
+        with self.lock:
+            if not self.running or self.progress.complete:
+                return
+            self.last_ack = time.monotonic()
+            conn = self.buddy.conn_out
+            if conn is None:
+                return
+            # blocks still queued would be sent twice
+            conn.discard(self.id)
+            if not self.progress.position and not self.progress.beyond:
+                # maybe the offer was lost too, the receiver ignores it if not
+                self.offer()
+            self.in_flight.clear()
+            self.next_start = self.progress.position
+            self.fill()
+
+    def check(self, now: float):
+        """Called by the Retransmitter, without a connection resend() does it later."""
+        if now - self.last_ack >= config.FILE_RETRANSMIT_TIMEOUT and self.buddy.conn_out is not None:
+            print(f'(2) no block of {self.filename} acknowledged for {config.FILE_RETRANSMIT_TIMEOUT} s, '
+                  f'sending again')
+            self.retransmit()
+
+    def ok(self, start: int):
+        if not self.progress.valid(start):
+            return
+        with self.lock:
+            self.last_ack = time.monotonic()
+            self.in_flight.discard(start)
+            self.progress.add(start)
+            if not self.progress.complete:
+                self.fill()
+        if self.progress.complete:
+            self.finish()
+        else:
+            self.progressed()
+
+    def error(self, start: int):
+        """The receiver has everything before start, continue there."""
+        if not (self.progress.valid(start) or start == self.size):
+            return
+        with self.lock:
+            self.last_ack = time.monotonic()
+            # blocks in flight before start have arrived, the others are sent again
+            self.in_flight.clear()
+            # a resumed transfer skips data, that's not throughput
+            self.sample_bytes += max(0, start - self.progress.position)
+            self.progress.advance(start)
+            self.next_start = start
+            if not self.progress.complete:
+                self.fill()
+        if self.progress.complete:
+            self.finish()
+        else:
+            self.changed()
+
+    def finish(self):
+        if self.close():
+            print(f'(2) file {self.filename} sent')
+
+    def cancel(self):
+        core.protocol.ProtocolFileStopReceiving(self.buddy, blob=self.id).send()
+        self.close()
+
+    def stop(self):
+        """The receiver does not want the file (anymore)."""
+        self.reason = 'cancelled by receiver'
+        self.close()
+
+    def close(self) -> bool:
+        """Returns False if the transfer was closed already."""
+        with self.lock:
+            if not self.running:
+                return False
+            self.running = False
+            self.file.close()
+        senders.pop(self.id, None)
+        if self.buddy.conn_out is not None:
+            # blocks still queued behind chat lines are not needed anymore
+            self.buddy.conn_out.discard(self.id)
+        self.changed()
+        return True
+
+
+class FileReceiver(Transfer):
+    def __init__(self, buddy, transfer_id: str, size: int, block_size: int, filename: str):
+        super().__init__(buddy, transfer_id, safe_filename(filename), size, block_size)
+        self.path = None  # of the complete file
+        if block_size <= 0 or size < 0 or transfer_id in receivers:
+            core.protocol.ProtocolFileStopSending(buddy, blob=transfer_id).send()
+            self.running = False
+            return
+        # the same file from the same buddy always gets the same .part file
+        key = hashlib.md5(f'{getattr(buddy, "address", "")}\0{self.filename}\0{size}'.encode('utf-8')).hexdigest()
+        if any(receiver.part_path.stem == key for receiver in receivers.values()):
+            # the same file is being received already, this one cannot be resumed
+            key += transfer_id
+        temp_dir = get_temp_dir()
+        self.part_path = temp_dir / f'{key}.part'
+        self.offset_path = temp_dir / f'{key}.offset'
+        self.saved_position = 0
+        resume = self.read_offset()
+        self.file = open(self.part_path, 'r+b' if resume else 'wb')
+        receivers[self.id] = self
+        self.changed()
+        if resume:
+            print(f'(2) resuming {self.filename} at {resume} of {size} bytes')
+            self.progress.advance(resume)
+            self.saved_position = resume
+            self.sample_bytes = resume
+            core.protocol.ProtocolFiledataError(buddy, blob=(self.id, resume)).send()
+        if self.progress.complete:
+            self.finish()
+
+    def read_offset(self) -> int:
+        try:
+            position = int(self.offset_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+        if not self.part_path.exists() or not 0 < position <= self.size:
+            return 0
+        # the sender may use another block size this time
+        return position - position % self.block_size if position < self.size else position
+
+    def save_offset(self):
+        """Remembers the watermark for resuming, call with the lock held."""
+        self.file.flush()
+        self.offset_path.write_text(str(self.progress.position))
+        self.saved_position = self.progress.position
+
+    def data(self, start: int, digest: str, data: bytes):
+        with self.lock:
+            if not self.running:
+                return
+            if not self.progress.valid(start) or len(data) != self.progress.block_length(start):
+                print(f'(2) invalid block {start} of {self.filename}')
+                return
+            if hashlib.md5(data).hexdigest() != digest:
+                print(f'(2) damaged block {start} of {self.filename}')
+                core.protocol.ProtocolFiledataError(self.buddy, blob=(self.id, self.progress.position)).send()
+                return
+            if not self.progress.done(start):
+                self.file.seek(start)
+                self.file.write(data)
+                self.progress.add(start)
+                if self.progress.position - self.saved_position >= 16 * self.block_size:
+                    self.save_offset()
+        core.protocol.ProtocolFiledataOk(self.buddy, blob=(self.id, start)).send()
+        if self.progress.complete:
+            self.finish()
+        else:
+            self.progressed()
+
+    def finish(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            self.file.close()
+            path = self.part_path.with_name(self.filename)
+            number = 1
+            while path.exists():
+                path = self.part_path.with_name(f'{pathlib.Path(self.filename).stem} ({number})'
+                                                f'{pathlib.Path(self.filename).suffix}')
+                number += 1
+            os.replace(self.part_path, path)
+            self.offset_path.unlink(missing_ok=True)
+            self.path = path
+        receivers.pop(self.id, None)
+        print(f'(2) file {self.filename} received')
+        self.changed()
+
+    def cancel(self):
+        """Aborts the transfer and deletes the partial file."""
+        core.protocol.ProtocolFileStopSending(self.buddy, blob=self.id).send()
+        self.close()
+        self.part_path.unlink(missing_ok=True)
+        self.offset_path.unlink(missing_ok=True)
+
+    def stop(self):
+        """The sender stopped, keep the partial file for resuming."""
+        self.reason = 'cancelled by sender'
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            self.save_offset()
+            self.file.close()
+        receivers.pop(self.id, None)
+        self.changed()
+
+
+class Retransmitter:
+    """Checks all senders every RETRANSMIT_CHECK_INTERVAL for blocks that were not acknowledged.
+
+    The checks are timers on the event loop of core.transport, they stop
+    when the last sender is gone and start again with the next one.
+    """
+    def __init__(self, loop: 'core.transport.EventLoop' = None):
+        self.loop = loop or core.transport.get_event_loop()
+        self.timer = None
+
+    def schedule(self):
+        """Starts the checks unless they are running (thread-safe)."""
+        self.loop.call(self._schedule)
+
+    def _schedule(self):
+        if self.timer is None and senders:
+            self.timer = self.loop.loop.call_later(RETRANSMIT_CHECK_INTERVAL, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        now = time.monotonic()
+        for sender in list(senders.values()):
+            sender.check(now)
+        self._schedule()
+
+
+global retransmitter
+retransmitter: Retransmitter | None = None
+retransmitter_lock = threading.Lock()
+
+
+def get_retransmitter() -> Retransmitter:
+    """Returns the shared retransmitter, starting it on first use."""
+    global retransmitter
+    with retransmitter_lock:
+        if retransmitter is None:
+            retransmitter = Retransmitter()
+        return retransmitter
+
+
+def resend(buddy):
+    """Called when the handshake with buddy is complete, blocks sent before are lost."""
+    for sender in list(senders.values()):
+        if sender.buddy is buddy:
+            sender.retransmit()
+
+
+def get_transfers() -> list[Transfer]:
+    """Returns the running transfers, outgoing first."""
+    return list(senders.values()) + list(receivers.values())
@@ -0,0 +1,162 @@
+"""Incremental framing of the byte stream received from a socket.
+
+Every protocol message is transmitted as one line terminated by 0x0a,
+see ProtocolMsg.get_line(). The framer collects received chunks and cuts
+them into complete lines.
+
+Two OnionChat peers can switch a connection to binary frames (see the
+features message in core.protocol): the sender writes SWITCH_LINE as its
+last line and from then on every message is a FRAME_HEADER followed by
+the raw blob. Nothing needs to be escaped in this format. The flags of a
+frame tell whether and how the blob is compressed, see core.compression.
+"""
+import struct
+
+import config
+import core.compression
+
+FRAME_HEADER = struct.Struct('>IHB')  # blob length, command id, flags
+SWITCH_LINE = b'begin_binary'
+
+
+class LineTooLongError(ValueError):
+    """Raised when the peer sends a line longer than allowed."""
+
+
+class LineFramer:
+    """Cuts a stream of received bytes into lines.
+
+    Received data is appended to a single bytearray and only the newly
+    received part is scanned for 0x0a. Complete lines are copied out of
+    the buffer once, so the cost of framing is linear in the amount of
+    received data, no matter how long the lines are.
+    """
+    def __init__(self, max_line_length: int = config.MAX_LINE_LENGTH):
+        self.max_line_length = max_line_length
+        self.buffer = bytearray()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """Appends received data and returns all lines completed by it.
+
+        :param: Received data.
+        :type: bytes
+        :return: Complete lines without the terminating 0x0a.
+        :rtype: list[bytes]
+        :raises LineTooLongError: If a line exceeds max_line_length.
+        """
+        buffer = self.buffer
+        # the buffered data was already scanned by previous calls,
+        # so we only look for the last 0x0a in the new data
+        scan_from = len(buffer)
+        buffer += data
+        end = buffer.rfind(b'\n', scan_from)
+        if end == -1:
+            if len(buffer) > self.max_line_length:
+                raise LineTooLongError(f'line longer than {self.max_line_length} bytes')
+            return []
+
+        with memoryview(buffer) as view:
+            lines = bytes(view[:end]).split(b'\n')
+        # deleting from the front of a bytearray does not move the remaining data
+        del buffer[:end + 1]
+        if len(buffer) > self.max_line_length or max(map(len, lines)) > self.max_line_length:
+            raise LineTooLongError(f'line longer than {self.max_line_length} bytes')
+        return lines
+
+
+class Frame:
+    """A received binary frame."""
+    __slots__ = ('command_id', 'flags', 'payload')
+
+    def __init__(self, command_id: int, flags: int, payload: bytes):
+        self.command_id = command_id
+        self.flags = flags
+        self.payload = payload
+
+    def __len__(self):
+        return len(self.payload)
+
+
+def encode_frame(command_id: int, flags: int, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload), command_id, flags) + payload
+
+
+class FrameDecoder:
+    """Cuts a stream of received bytes into binary frames and decompresses them."""
+    def __init__(self, max_length: int = config.MAX_LINE_LENGTH):
+        self.max_length = max_length
+        self.buffer = bytearray()
+        self.decompressor = core.compression.Decompressor(max_length)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def feed(self, data: bytes) -> list[Frame]:
+        """Appends received data and returns all frames completed by it.
+
+        :raises LineTooLongError: If a frame exceeds max_length.
+        :raises ValueError: If a compressed frame is damaged.
+        """
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        position = 0
+        size = len(buffer)
+        with memoryview(buffer) as view:
+            while size - position >= FRAME_HEADER.size:
+                length, command_id, flags = FRAME_HEADER.unpack_from(buffer, position)
+                if length > self.max_length:
+                    raise LineTooLongError(f'frame longer than {self.max_length} bytes')
+                end = position + FRAME_HEADER.size + length
+                if end > size:
+                    break
+                frames.append(Frame(command_id, flags, bytes(view[position + FRAME_HEADER.size:end])))
+                position = end
+        del buffer[:position]
+        for frame in frames:
+            if frame.flags:
+                frame.payload = self.decompressor.decompress(frame.flags, frame.payload)
+                frame.flags = 0
+        return frames
+
+
+class WireDecoder:
+    """Decodes lines until the peer sends SWITCH_LINE, binary frames after it.
+
+    feed() returns lines as bytes and frames as Frame objects.
+    """
+    def __init__(self, max_length: int = config.MAX_LINE_LENGTH):
+        self.max_length = max_length
+        self.lines = LineFramer(max_length)
+        self.frames = None
+
+    @property
+    def binary(self) -> bool:
+        return self.frames is not None
+
+    def feed(self, data: bytes) -> list:
+        if self.frames is not None:
+            return self.frames.feed(data)
+        # The switch line must be found before the data behind it is
+        # cut into lines, binary data has no line structure.
+        pattern = b'\n' + SWITCH_LINE + b'\n'
+        buffer = self.lines.buffer
+        # the buffer holds the incomplete last line, it has no 0x0a,
+        # so the switch line can only start in it if it starts a line
+        head = b'\n' + bytes(buffer) if len(buffer) <= len(SWITCH_LINE) else b''
+        position = (head + data[:len(pattern)]).find(pattern) if head else -1
+        if position != -1:
+            end = position + len(pattern) - len(head)
+        else:
+            position = data.find(pattern)
+            if position == -1:
+                return self.lines.feed(data)
+            end = position + len(pattern)
+        lines = self.lines.feed(data[:end])
+        lines.pop()  # the switch line
+        self.lines = None
+        self.frames = FrameDecoder(self.max_length)
+        return lines + self.frames.feed(data[end:])
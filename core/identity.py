@@ -0,0 +1,315 @@
+"""Hosting many onion identities in one process.
+
+Every Identity has its own buddy list, message store and search index
+(a core.contacts.Profile in its own directory), its own listening port and
+its own onion service. Everything else is shared by all identities of the
+process: the event loop of core.transport, one connection to the Tor
+control port (one ADD_ONION per identity), the sync thread of
+core.storage and the caches of core.utils and core.contacts.
+
+The IdentityHost keeps the identities of <data dir>/identities, one
+directory each. Their connection managers share the connect slots of
+[connections] max_connecting (core.connections.Slots), so more identities
+do not mean more circuits being built at once.
+
+core.events notifications do not tell which identity they are about.
+"""
+import pathlib
+import re
+import socket
+import threading
+import time
+
+import config
+import core.connections
+import core.contacts
+import core.filetransfer
+import core.protocol
+import core.sharding
+import core.torcontrol
+import core.transport
+import core.utils
+
+NAME = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+class Buddy:
+    """The network side of a buddy, its contact data is in the Profile."""
+    def __init__(self, address: str):
+        self.address = address
+        self.conn_in = None
+        self.conn_out = None
+        self.features = set()
+
+    def disconnect(self):
+        for conn in (self.conn_in, self.conn_out):
+            if conn is not None:
+                conn.close()
+
+
+class BuddyList:
+    """The buddies of one identity and the callbacks of their connections."""
+    def __init__(self, loop: core.transport.EventLoop, shared_manager: bool = False,
+                 slots: core.connections.Slots = None):
+        """
+        :param shared_manager: Use the connection manager of core.connections
+            (the one the Tor status resets) instead of an own one.
+        :param slots: The connect slots an own manager shares with other identities.
+        """
+        self.loop = loop
+        self.buddies: dict[str, Buddy] = {}
+        self.listener = None
+        if shared_manager:
+            self.manager = core.connections.get_manager(self)
+        else:
+            self.manager = core.connections.ConnectionManager(self, loop, slots=slots)
+
+    def add(self, address: str, last_active: float = 0) -> Buddy:
+        buddy = self.buddies.get(address)
+        if buddy is None:
+            buddy = self.buddies[address] = Buddy(address)
+            self.manager.want(buddy, last_active)
+        return buddy
+
+    def remove(self, address: str):
+        buddy = self.buddies.pop(address, None)
+        if buddy is not None:
+            self.manager.forget(buddy)
+            buddy.disconnect()
+
+    def touch(self, address: str):
+        """A message was received from or sent to the buddy, it is reconnected first."""
+        self.manager.touch(address)
+
+    @property
+    def listen_port(self) -> int | None:
+        if self.listener is None or self.listener.server is None:
+            return None
+        return self.listener.server.sockets[0].getsockname()[1]
+
+    def listen(self, listen_socket: socket.socket):
+        self.listener = core.transport.Listener(self, listen_socket, self.loop)
+
+    def close(self):
+        """Stops reconnecting and closes all connections."""
+        self.manager.stop()
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        for buddy in list(self.buddies.values()):
+            buddy.disconnect()
+
+    def get_stats(self) -> dict:
+        return {'incoming': len(self.listener.conns) if self.listener is not None else 0,
+                'outgoing': self.manager.get_stats()}
+
+    def onConnected(self, conn):
+        pass  # nothing may be sent before the handshake, see onAuthenticated()
+
+    def onAuthenticated(self, conn):
+        """The handshake is complete, conn is the authenticated incoming connection of the buddy."""
+        if conn.buddy.conn_out is not None:
+            core.protocol.send_features(conn.buddy)
+            core.filetransfer.resend(conn.buddy)
+
+    def onErrorIn(self, conn):
+        pass
+
+    def onErrorOut(self, conn):
+        pass
+
+
+def bind_listen_socket(port: int = 0) -> socket.socket:
+    """Binds a socket on the [client] listen_interface, port 0 takes a free port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((config.ini['client']['listen_interface'], port))
+    return sock
+
+
+class Identity:
+    def __init__(self, name: str, directory: str | pathlib.Path, loop: core.transport.EventLoop = None,
+                 profile: core.contacts.Profile = None, shared_manager: bool = False, workers: int = 0,
+                 slots: core.connections.Slots = None):
+        """
+        :param directory: Where the profile and the key of the onion service are kept.
+        :param profile: By default a new, empty Profile.
+        :param workers: Serve the connections in that many worker processes
+            (core.sharding), 0 serves them in this process.
+        :param slots: Connect slots shared with the other identities (IdentityHost).
+        """
+        self.name = name
+        self.directory = pathlib.Path(directory)
+        self.loop = loop or core.transport.get_event_loop()
+        self.profile = profile or core.contacts.Profile()
+        if workers:
+            self.bl = core.sharding.Coordinator(workers, self.loop, self.profile)
+        else:
+            self.bl = BuddyList(self.loop, shared_manager, slots)
+        self.profile.add_activity_callback(self.bl.touch)
+        self.hostname = None
+        self.service_id = None  # of the onion service we created
+
+    @property
+    def listen_port(self) -> int | None:
+        return self.bl.listen_port
+
+    def start(self, listen_socket: socket.socket = None, profile_path: str | pathlib.Path = None):
+        """Opens the profile, listens and keeps the stored buddies connected.
+
+        :param listen_socket: By default a free port of the listen_interface.
+        :param profile_path: By default the profile directory in the directory of the identity.
+        """
+        self.profile.open(profile_path or self.directory / config.App.PROFILE_DIR)
+        self.bl.listen(listen_socket or bind_listen_socket())
+        stored = self.profile.store.get()
+        valid = core.utils.validate_addresses(buddy['id'] for buddy in stored)
+        for buddy in stored:
+            if valid[buddy['id']]:
+                self.bl.add(buddy['id'], buddy.get('last_active', 0))
+
+    def publish(self, controller: core.torcontrol.TorController):
+        """Creates the onion service of the identity, forwarding to our listening port."""
+        key = core.torcontrol.load_onion_key(self.directory)
+        target = f'{config.ini["client"]["listen_interface"]}:{self.listen_port}'
+        self.service_id, new_key = controller.add_onion({config.ONIONCHAT_PORT: target}, key)
+        if new_key:
+            core.torcontrol.save_onion_key(self.directory, new_key)
+        self.hostname = self.service_id
+        print(f'(1) identity {self.name}: {self.hostname}')
+
+    def stop(self, controller: core.torcontrol.TorController = None):
+        self.bl.close()
+        if controller is not None and self.service_id is not None:
+            try:
+                controller.del_onion(self.service_id)
+            except core.torcontrol.ControlError as err:
+                print(f'(2) could not remove the onion service of {self.name}: {err}')
+            self.service_id = None
+        self.profile.close()
+
+    def add_buddies(self, entries: list[tuple[str, str]]):
+        """Adds (address, name) pairs and saves the buddy list once."""
+        store = self.profile.store
+        position = len(store)
+        now = time.time()
+        for address, name in entries:
+            if address not in store.buddies:
+                store.add({'id': address, 'position': position, 'icon': config.Gui.ICON_APP,
+                           'name': name or core.contacts.shorten_hostname(address), 'message': '',
+                           'group': 0, 'status': config.STATUS_OFFLINE, 'last_active': now})
+                position += 1
+            self.bl.add(address, now)
+        self.profile.save_buddies()
+
+    def remove_buddy(self, address: str):
+        self.profile.remove_buddy(address)
+        self.bl.remove(address)
+
+
+class IdentityHost:
+    def __init__(self, directory: str | pathlib.Path, loop: core.transport.EventLoop = None,
+                 controller: core.torcontrol.TorController = None, main: Identity = None):
+        """
+        :param directory: Holds one directory per identity.
+        :param controller: Creates the onion services, without one the
+            identities only listen locally.
+        :param main: The identity of the process (name ''), started by the caller.
+        """
+        self.directory = pathlib.Path(directory)
+        self.loop = loop or core.transport.get_event_loop()
+        self.controller = controller
+        self.identities: dict[str, Identity] = {}
+        self.lock = threading.Lock()
+        self.slots = core.connections.Slots(core.connections.get_settings()['max_connecting'])
+        if main is not None:
+            self.identities[main.name] = main
+            self.rebalance()
+        if controller is not None:
+            controller.subscribe('STATUS_CLIENT', self.on_tor_client_status)
+
+    def load(self):
+        """Starts every identity that has a directory."""
+        if self.directory.is_dir():
+            for path in sorted(self.directory.iterdir()):
+                if path.is_dir() and NAME.fullmatch(path.name):
+                    self.add(path.name)
+
+    def get(self, name: str) -> Identity:
+        """:raises KeyError: If there is no such identity."""
+        return self.identities[name]
+
+    def add(self, name: str) -> Identity:
+        """Starts an identity, a new one if its directory does not exist yet.
+
+        :raises ValueError: If the name cannot be a directory name or is taken.
+        """
+        if not NAME.fullmatch(name):
+            raise ValueError(f'invalid identity name {name!r}')
+        with self.lock:
+            if name in self.identities:
+                raise ValueError(f'identity {name!r} exists')
+            identity = self.identities[name] = Identity(name, self.directory / name, self.loop,
+                                                        slots=self.slots)
+        identity.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        identity.start()
+        if self.controller is not None:
+            try:
+                identity.publish(self.controller)
+            except core.torcontrol.ControlError as err:
+                print(f'(1) identity {name} has no onion service: {err}')
+        self.rebalance()
+        return identity
+
+    def remove(self, name: str):
+        """Stops an identity, its directory is kept.
+
+        :raises KeyError: If there is no such identity.
+        """
+        if name == '':
+            raise ValueError('the main identity cannot be removed')
+        with self.lock:
+            identity = self.identities.pop(name)
+        identity.stop(self.controller)
+        self.rebalance()
+
+    def stop(self):
+        """Stops all identities but the main one."""
+        for name in [name for name in self.identities if name]:
+            self.remove(name)
+
+    def rebalance(self):
+        """Shares the [connections] max_connecting slots between the identities.
+
+        The managers in this process take their connects from self.slots as
+        they need them, they join it when they are created (add()). A
+        sharded identity (core.sharding) connects in its workers, it gets a
+        fixed part of the slots for them, at least one for every worker.
+        """
+        managers = [identity.bl.manager for identity in list(self.identities.values())]
+        if not managers:
+            return
+        total = core.connections.get_settings()['max_connecting']
+        shared = total
+        for manager in managers:
+            if not isinstance(manager, core.connections.ConnectionManager):
+                # one slot for each of its workers at least
+                minimum = getattr(manager, 'min_connecting', 1)
+                manager.max_connecting = min(shared, max(minimum, total // len(managers)))
+                shared -= manager.max_connecting
+        self.loop.call(self.share_slots, [manager for manager in managers
+                                          if isinstance(manager, core.connections.ConnectionManager)], shared)
+
+    def share_slots(self, managers: list[core.connections.ConnectionManager], limit: int):
+        """Sets the shared slots, in the loop thread."""
+        self.slots.limit = limit
+        for manager in managers:
+            if manager.running:
+                self.slots.add(manager)
+        # more slots are used at once
+        self.slots.dispatch()
+
+    def on_tor_client_status(self, text: str, data: list):
+        if 'CIRCUIT_ESTABLISHED' in text.split():
+            for identity in list(self.identities.values()):
+                identity.bl.manager.reset()
@@ -0,0 +1,346 @@
+"""Counters, gauges and histograms of the network and protocol layers.
+
+The metrics are globals of this module, the code that does the work
+updates them:
+
+    core.metrics.bytes_received.labels('in').inc(len(data))
+
+An update is a dict lookup (cache the child of labels() where it is used
+often) and an addition, without a lock. Most updates run in the event
+loop thread, a rare lost increment when two threads race does not matter
+for statistics.
+
+Collectors add the counters other modules already keep (core.ratelimit,
+core.compression, the connection managers, the sharding workers) when a
+snapshot is taken. snapshot() returns everything as a dict (the
+daemon's "metrics" command), with [metrics] port set an HTTP server on
+[metrics] address serves it on /metrics in the Prometheus text format.
+"""
+import abc
+import bisect
+import threading
+
+import config
+
+PREFIX = 'onionchat_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def get(self) -> dict:
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            buckets[format_value(bound)] = total
+        return {'buckets': buckets, 'sum': self.sum, 'count': total}
+
+
+class Metric(abc.ABC):
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), registry: 'Registry' = None):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()  # only for creating children
+        if not self.label_names:
+            self.default = self.labels()
+        (registry or default_registry).register(self)
+
+    @abc.abstractmethod
+    def make_child(self):
+        """Returns a new value for one combination of label values."""
+
+    def labels(self, *values: str):
+        """Returns the value of one combination of label values, keep it for hot paths."""
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f'{self.name} has the labels {self.label_names}, got {values}')
+            with self.lock:
+                child = self.children.setdefault(values, self.make_child())
+        return child
+
+    def collect(self) -> dict:
+        return {'type': self.type, 'help': self.documentation,
+                'samples': [{'labels': dict(zip(self.label_names, values)), 'value': child.get()}
+                            for values, child in list(self.children.items())]}
+
+
+class Counter(Metric):
+    """Only goes up, the name gets a _total suffix."""
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), registry: 'Registry' = None):
+        Metric.__init__(self, name + '_total', documentation, labels, registry)
+
+    def make_child(self) -> CounterValue:
+        return CounterValue()
+
+    def inc(self, amount: float = 1):
+        self.default.value += amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def make_child(self) -> GaugeValue:
+        return GaugeValue()
+
+    def inc(self, amount: float = 1):
+        self.default.value += amount
+
+    def dec(self, amount: float = 1):
+        self.default.value -= amount
+
+    def set(self, value: float):
+        self.default.value = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: tuple, labels: tuple = (),
+                 registry: 'Registry' = None):
+        """:param buckets: Upper bounds, in ascending order."""
+        self.bounds = tuple(sorted(buckets))
+        Metric.__init__(self, name, documentation, labels, registry)
+
+    def make_child(self) -> HistogramValue:
+        return HistogramValue(self.bounds)
+
+    def observe(self, value: float):
+        self.default.observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f'metric {metric.name} exists')
+            self.metrics[metric.name] = metric
+
+    def add_collector(self, collector):
+        """Adds a function that returns more metrics in the format of snapshot()."""
+        with self.lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def snapshot(self) -> dict:
+        """Returns the current values of all metrics.
+
+        :return: Name -> {'type', 'help', 'samples': [{'labels', 'value'}]},
+            the value of a histogram is {'buckets', 'sum', 'count'}.
+        :rtype: dict
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+            collectors = list(self.collectors)
+        result = {metric.name: metric.collect() for metric in metrics}
+        for collector in collectors:
+            try:
+                collected = collector()
+            except Exception as err:
+                print(f'(1) metrics collector {collector!r} failed: {err!r}')
+                continue
+            merge(result, collected)
+        return result
+
+
+def merge(result: dict, metrics: dict, labels: dict = None) -> dict:
+    """Adds the samples of a snapshot to another one, with extra labels if given."""
+    for name, metric in metrics.items():
+        target = result.setdefault(name, {'type': metric['type'], 'help': metric['help'], 'samples': []})
+        for sample in metric['samples']:
+            target['samples'].append({'labels': {**sample['labels'], **labels} if labels else sample['labels'],
+                                      'value': sample['value']})
+    return result
+
+
+def from_stats(prefix: str, documentation: str, stats: dict, kind: str = 'counter') -> dict:
+    """Turns a dict of numbers (the get_stats() of a module) into metrics for a collector.
+
+    {'throttled_lines': 3} with the prefix ratelimit is onionchat_ratelimit_throttled_lines_total.
+    """
+    suffix = '_total' if kind == 'counter' else ''
+    return {f'{PREFIX}{prefix}_{key}{suffix}': {'type': kind, 'help': documentation,
+                                                'samples': [{'labels': {}, 'value': value}]}
+            for key, value in stats.items()}
+
+
+def single(name: str, kind: str, documentation: str, value: float, labels: dict = None) -> dict:
+    """One metric with one sample, for a collector."""
+    return {PREFIX + name: {'type': kind, 'help': documentation,
+                            'samples': [{'labels': labels or {}, 'value': value}]}}
+
+
+def format_value(value) -> str:
+    if isinstance(value, str):
+        return value
+    if value == int(value) and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def render(snapshot: dict) -> str:
+    """Formats a snapshot in the Prometheus text format."""
+    lines = []
+    for name, metric in sorted(snapshot.items()):
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        for sample in metric['samples']:
+            labels, value = sample['labels'], sample['value']
+            if metric['type'] == 'histogram':
+                for bound, count in value['buckets'].items():
+                    lines.append(f'{name}_bucket{format_labels({**labels, "le": bound})} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(value["sum"])}')
+                lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+            else:
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+default_registry = Registry()
+
+
+def snapshot() -> dict:
+    return default_registry.snapshot()
+
+
+def add_collector(collector):
+    default_registry.add_collector(collector)
+
+
+def remove_collector(collector):
+    default_registry.remove_collector(collector)
+
+
+# the network and protocol layers, updated by core.transport
+
+connections_open = Gauge('connections_open', 'Open connections.', ('direction',))
+connections = Counter('connections', 'Connections established.', ('direction',))
+bytes_received = Counter('bytes_received', 'Bytes received from peers.', ('direction',))
+bytes_sent = Counter('bytes_sent', 'Bytes sent to peers.', ('direction',))
+messages_received = Counter('messages_received', 'Protocol messages parsed and executed.', ('command',))
+message_seconds = Histogram('message_seconds', 'Time to parse and execute a received message (a sample of them).',
+                            (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5))
+protocol_errors = Counter('protocol_errors', 'Received data that could not be handled: framing (a line '
+                          'or frame too long, damaged compression) or message (parse or execute failed).',
+                          ('stage',))
+send_queue_lines = Histogram('send_queue_lines', 'Lines queued on a connection when a batch is sent.',
+                             (0, 1, 2, 5, 10, 50, 100, 500, 1000, 5000))
+connect_attempts = Counter('connect_attempts', 'Outgoing connects started.')
+reconnects = Counter('reconnects', 'Outgoing connects to a buddy whose connection failed or closed before.')
+connect_failures = Counter('connect_failures', 'Outgoing connects that failed.')
+connect_seconds = Histogram('connect_seconds', 'Time to open an outgoing connection through Tor.',
+                            (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+
+def get_settings() -> dict:
+    return config.ini.get('metrics', config.config_defaults['metrics'])
+
+
+global server
+server = None
+
+
+def start_server(port: int = None) -> int | None:
+    """Serves /metrics on the [metrics] address.
+
+    :param port: By default [metrics] port, 0 there means no server.
+    :return: The port, None if there is no server.
+    :rtype: int | None
+    """
+    global server
+    settings = get_settings()
+    if port is None:
+        port = settings['port']
+        if not port:
+            return None
+    # imported only here, most runs do not serve metrics
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render(snapshot()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((settings['address'], port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics server', daemon=True).start()
+    port = server.server_address[1]
+    print(f'(1) metrics on http://{settings["address"]}:{port}/metrics')
+    return port
+
+
+def stop_server():
+    global server
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        server = None
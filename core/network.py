@@ -1,246 +1,22 @@
 import threading
 import time
-import sys
 import os
 import subprocess
 import socket
 
 import config
+import core.connections
+import core.torcontrol
 import core.utils
 import core.protocol
 
 
-class Receiver(threading.Thread):
-    def __init__(self, conn, is_incoming=False):
-        threading.Thread.__init__(self)
-        self.conn = conn
-        self.is_incoming = is_incoming
-        self.socket = conn.socket
-        self.running = True
-        self.start()
-
-    def run(self):
-        read_buffer = ''
-        # self.socket.settimeout(5)
-        while self.running:
-            try:
-                recv = self.socket.recv(4096)
-                if recv != '':
-                    read_buffer = read_buffer + recv
-                    temp = read_buffer.split('\n')
-                    read_buffer = temp.pop()
-
-                    for line in temp:
-                        if self.running:
-                            try:
-                                # on outgoing connections we do not allow any
-                                # incoming messages other than file*
-                                # this prevents an attacker from messaging
-                                # or sending commands before the handshake is
-                                # completed or pong on the wrong connection
-                                if self.is_incoming or line[:4] == 'file':
-                                    message = core.protocol.protocol_msg_from_line(
-                                        self.conn.bl, self.conn, line)
-                                    message.execute()
-                                else:
-                                    # this is an outgoing connection. Incoming protocol messages are ignored
-                                    print(f"Received unexpected '{line}' "
-                                          f"on outgoing connection to {self.conn.buddy.address}")
-                            except:
-                                pass
-                else:
-                    self.running = False
-                    self.conn.onReceiverError()
-
-            except socket.timeout:
-                self.running = False
-                self.conn.onReceiverError()
-
-            except socket.error:
-                self.running = False
-                self.conn.onReceiverError()
-
-
-class InConnection:
-    def __init__(self, socket, buddy_list):
-        self.buddy = None
-        self.bl = buddy_list
-        self.socket = socket
-        self.last_ping_address = ''  # used to detect mass pings with fake addresses
-        self.last_ping_cookie = ''  # used to detect pings with fake cookies
-        self.last_active = time.time()
-        self.started = True
-        self.receiver = Receiver(self, True)
-
-    def send(self, text):
-        try:
-            self.socket.send(text)
-        except:
-            print('(2) in-connection send error.')
-            self.bl.onErrorIn(self)
-            self.close()
-
-    def on_receiver_error(self):
-        if self.buddy:
-            addr = self.buddy.address
-        else:
-            addr = self.last_ping_address + ' (unverified)'
-        print(f'(2) in-connection receive error: {addr}')
-        self.bl.onErrorIn(self)
-        self.close()
-
-    def close(self):
-        print(f'(2) in-connection closing {self.last_ping_address}')
-
-        try:
-            self.socket.shutdown(socket.SHUT_RDWR)
-        except:
-            print(f'(3) socket.shutdown() {sys.exc_info()[1]}')
-        try:
-            self.socket.close()
-        except:
-            print(f'(3) socket.close() {sys.exc_info()[1]}')
-
-        self.started = False
-        if self in self.bl.listener.conns:
-            self.bl.listener.conns.remove(self)
-        if self.buddy:
-            self.buddy.conn_in = None
-
-
-class OutConnection(threading.Thread):
-    def __init__(self, address, buddy_list, buddy):
-        threading.Thread.__init__(self)
-        self.bl = buddy_list
-        self.buddy = buddy
-        self.address = address
-        self.pong_sent = False
-        self.send_buffer = []
-        self.running = False
-        self.socket = None
-        self.receiver = None
-        self.start()
-
-    def run(self):
-        self.running = True
-        try:
-            self.socket = socks.socksocket()
-            self.socket.setproxy(socks.PROXY_TYPE_SOCKS4,
-                                 config.ini['tor']['address'],
-                                 config.ini['tor']['socks_port'])
-            print(f"(2) trying to connect '{self.address}'")
-            self.socket.connect((str(self.address), config.ONIONCHAT_PORT))
-            print(f'(2) connected to {self.address}')
-            self.bl.onConnected(self)
-            self.receiver = Receiver(self, False)  # this Receiver will only accept file* messages
-            while self.running:
-                while len(self.send_buffer) > 0:
-                    text = self.send_buffer.pop(0)
-                    try:
-                        print(f'(2) {self.address} out-connection sending buffer')
-                        self.socket.send(text)
-                    except:
-                        print('(2) out-connection send error')
-                        self.bl.onErrorOut(self)
-                        self.close()
-
-                time.sleep(0.2)
-
-        except:
-            print(f'(2) out-connection to {self.address} failed: {sys.exc_info()[1]}')
-            self.bl.on_error_out(self)
-            self.close()
-
-    def send(self, text):
-        self.send_buffer.append(text)
-
-    def on_receiver_error(self):
-        print('(2) out-connection receiver error')
-        self.bl.onErrorOut(self)
-        self.close()
-
-    def close(self):
-        self.running = False
-        self.send_buffer = []
-        try:
-            self.socket.shutdown(socket.SHUT_RDWR)
-        except:
-            print(f'(3) socket.shutdown() {sys.exc_info()[1]}')
-        try:
-            self.socket.close()
-        except:
-            print(f'(3) socket.close() {sys.exc_info()[1]}')
-
-        if self.buddy:
-            self.buddy.conn_out = None
-            print(f'(2) out-connection closed ({self.buddy.address})')
-        else:
-            print(f'(2) out connection without buddy closed')  # happens after remove_buddy()
-
-
-class Listener(threading.Thread):
-    def __init__(self, buddy_list, socket=None):
-        threading.Thread.__init__(self)
-        self.buddy_list = buddy_list
-        self.conns = []
-        self.socket = socket
-        self.running = False
-        self.start()
-        self.start_timer()
-
-    def run(self):
-        self.running = True
-        if not self.socket:
-            interface = config.ini['client']['listen_interface']
-            port = config.ini['client']['listen_port']
-            self.socket = try_bind_port(interface, port)
-        self.socket.listen(5)
-        while self.running:
-            try:
-                conn, address = self.socket.accept()
-                self.conns.append(InConnection(conn, self.buddy_list))
-                print('(2) new incoming connection')
-                print(f'(2) have now {len(self.conns)} incoming connections')
-            except:
-                print('socket listener error!')
-                # self.running = False
-
-    def close(self):
-        self.running = False
-        try:
-            print(f'(2) closing listening socket {config.ini["client"]["listen_interface"]}'
-                  f':{config.ini["client"]["listen_port"]}.')
-
-            self.socket.close()
-            print('(2) success')
-        except:
-            print('(2) closing socket failed, traceback follows:')
-
-    def start_timer(self):
-        self.timer = threading.Timer(30, self.on_timer)
-        self.timer.start()
-
-    def on_timer(self):
-        for conn in self.conns:
-            if time.time() - conn.last_active > config.DEAD_CONNECTION_TIMEOUT:
-                if conn.buddy:
-                    print(f'(2) conn_in timeout: disconnecting {conn.buddy.address}')
-                    conn.buddy.disconnect()
-                else:
-                    print(f'(2) closing unused in-connection from {conn.last_ping_address}')
-                    conn.close()
-                if conn in self.conns:
-                    self.conns.remove(conn)
-                print(f'(2) have now {len(self.conns)} incoming connections')
-        self.start_timer()
-
-
 def try_bind_port(interface, port):
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((interface, port))
-        s.listen(5)
+        s.listen(config.ini['client']['listen_backlog'])
         return s
     except:
         return False
@@ -293,37 +69,22 @@ def start_portable_tor():
             # tor = subprocess.Popen("tor.exe -f torrc.txt".split(), creationflags=0x08000000)
             print(f'(1) successfully started Tor (pid={tor_pid})')
 
-            # we now assume the existence of our hostname file
-            # it WILL be created after the first start
-            # if not, something must be totally wrong.
-            cnt = 0
-            found = False
-            while cnt <= 10:
-                try:
-                    print(f'Trying to read hostname file (try {cnt + 1} of 10)')
-                    f = open(os.path.join('hidden_service', 'hostname'), 'r')
-                    hostname = f.read().rstrip()[:-6]
-                    print(f'(1) found hostname: {hostname}')
-                    print('(1) writing own_hostname to onionchat.ini')
-                    config.ini['client']['hostanme'] = hostname
-                    found = True
-                    f.close()
-                    break
-                except (FileNotFoundError, IOError):
-                    # We wait 10 seconds for the file to appear
-                    time.sleep(1)
-                    cnt += 1
-
-            if not found:
-                print('Very strange: portable tor started but hostname could not be read')
+            # Tor tells us through its control port when our onion service
+            # exists and when it is reachable, nothing needs to be polled
+            hostname = connect_tor_control('tor_portable', os.getcwd(), tor_proc)
+            if not hostname:
+                print('Very strange: portable tor started but its control port is not usable')
                 print('Using section [tor], not [tor_portable]')
             else:
+                print(f'(1) found hostname: {hostname}')
+                print('(1) writing own_hostname to onionchat.ini')
+                config.ini['client']['hostname'] = hostname
                 # in portable mode we run Tor on some non-standard ports:
                 # so we switch to the other set_option of config-options
                 print('Switching active config section from [tor] to [tor_portable]')
                 TOR_CONFIG = 'tor_portable'
-                # start the timer that will periodically check that tor is still running
-                start_portable_tor_timer()
+            # restart Tor as soon as it exits
+            threading.Thread(target=watch_portable_tor, args=(tor_proc,), daemon=True).start()
         else:
             print('No own Tor instance. Settings in [tor] will be used')
 
@@ -335,7 +96,45 @@ def start_portable_tor():
     print(f'Current working directory is {os.getcwd()}')
 
 
+def connect_tor_control(tor_section: str, tor_dir: str, proc: subprocess.Popen = None,
+                        timeout: float = 30) -> str | None:
+    """Creates our onion service through the control port of Tor.
+
+    A Tor that was just started opens its control port after a moment, so
+    connecting is retried until it works, proc exits or timeout passes.
+
+    :return: Our onion address without .onion, None if Tor could not be controlled.
+    :rtype: str | None
+    """
+    global tor_controller
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while True:
+        try:
+            tor_controller, hostname = core.torcontrol.start_onion_service(tor_section, tor_dir)
+            break
+        except core.torcontrol.ControlError as err:
+            if (proc is not None and proc.poll() is not None) or time.monotonic() + delay > deadline:
+                print(f'(1) Tor control failed: {err}')
+                return None
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    tor_controller.subscribe('STATUS_CLIENT', on_tor_client_status)
+    return hostname
+
+
+def on_tor_client_status(text: str, data: list):
+    """Called by the Tor controller for every STATUS_CLIENT event."""
+    if 'CIRCUIT_ESTABLISHED' in text.split() and core.connections.manager is not None:
+        # Tor can build circuits again, don't let the buddies wait for their backoff
+        core.connections.manager.reset()
+
+
 def stop_portable_tor():
+    global tor_stopping
+    tor_stopping = True
+    if tor_controller is not None:
+        tor_controller.close()
     if not tor_pid:
         return
     else:
@@ -343,15 +142,19 @@ def stop_portable_tor():
         core.utils.terminate_process(tor_pid)
 
 
-def start_portable_tor_timer():
-    global tor_timer
-    tor_timer = threading.Timer(10, on_portable_tor_timer)
-    tor_timer.start()
+def watch_portable_tor(proc: subprocess.Popen):
+    """Waits for the Tor process to exit and restarts it (runs in its own thread)."""
+    proc.wait()
+    if tor_stopping or proc is not tor_proc:
+        return
+    print(f'Tor stopped running. Will restart it now.')
+    if tor_controller is not None:
+        tor_controller.close()
+    start_portable_tor()
 
 
-def on_portable_tor_timer():
-    if tor_proc.poll() is not None:
-        print(f'Tor stopped running. Will restart it now.')
-        start_portable_tor()
-    else:
-        start_portable_tor_timer()
+global tor_pid, tor_proc, tor_controller, tor_stopping
+tor_pid: int | bool = False
+tor_proc: subprocess.Popen | None = None
+tor_controller: core.torcontrol.TorController | None = None
+tor_stopping = False
@@ -0,0 +1,56 @@
+"""Startup instrumentation.
+
+Run with the environment variable ONIONCHAT_PROFILE_STARTUP=1 to get the
+time spent in every startup phase (config load, Qt import, main window,
+pixmap loads, ...) once the first window is shown. With
+ONIONCHAT_PROFILE_STARTUP=exit OnionChat quits right after the report,
+for benchmarks/bench_startup.py.
+
+Without the variable phase() does nothing but a dict lookup.
+"""
+import contextlib
+import os
+import time
+
+MODE = os.environ.get('ONIONCHAT_PROFILE_STARTUP', '')
+ENABLED = bool(MODE) and MODE != '0'
+
+started = time.perf_counter()
+phases: dict[str, list] = {}  # name -> [seconds, count], in the order they first ran
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """Adds the time spent in the with block to a phase.
+
+    Phases may be nested, the outer phase includes the inner ones.
+    """
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = phases.setdefault(name, [0.0, 0])
+        entry[0] += time.perf_counter() - start
+        entry[1] += 1
+
+
+def report(label: str = 'first window') -> float:
+    """Prints every phase and the time since the start.
+
+    :return: Seconds since this module was imported.
+    :rtype: float
+    """
+    total = time.perf_counter() - started
+    if ENABLED:
+        for name, (seconds, count) in phases.items():
+            calls = f' ({count} calls)' if count > 1 else ''
+            print(f'(1) startup: {name:<16} {seconds * 1000:8.1f} ms{calls}')
+        print(f'(1) startup: {label:<16} {total * 1000:8.1f} ms after start')
+    return total
+
+
+def should_exit() -> bool:
+    return MODE == 'exit'
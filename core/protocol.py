@@ -1,8 +1,48 @@
-import core.network
+import re
+import time
+import zlib
+
+import core.compression
+import core.filetransfer
+import core.framing
+import core.metrics
 import core.utils
 
 
-def protocol_msg_from_line(bl, conn, line):
+# command (as received, bytes) -> ProtocolMsg subclass
+# filled by ProtocolMsg.__init_subclass__() when a message class is defined
+protocol_msg_classes: dict[bytes, type] = {}
+# command id of binary frames -> ProtocolMsg subclass
+protocol_msg_ids: dict[int, type] = {}
+
+# what we understand on incoming connections, sent in the features message
+SUPPORTED_FEATURES = [b'binary', b'deflate', b'lzma']  # we decompress both, see core.compression
+TIMING_SAMPLE = 16  # time one in that many received messages, see handle_item()
+
+
+def command_id(command: bytes) -> int:
+    """The id of a command in binary frames.
+
+    Derived from the command itself, so both peers agree on the ids
+    without exchanging a table. __init_subclass__ checks for collisions.
+    """
+    return zlib.crc32(command) & 0xffff
+
+
+def command_from_class_name(name: str) -> str:
+    """Derives the protocol command from a message class name.
+
+    ProtocolNotImplemented -> not_implemented
+
+    :param: Class name.
+    :type: str
+    :return: Protocol command.
+    :rtype: str
+    """
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name.removeprefix('Protocol')).lower()
+
+
+def protocol_msg_from_line(bl, conn, line: bytes):
     """
 
     This function is fhe factory for producing instances of ProtocolMsg classes
@@ -18,17 +58,115 @@ def protocol_msg_from_line(bl, conn, line):
     # future extensions to the protocol might define new commands
     # but <command> may only consist of characters [a-z] or _
     # we split it at the first space character (0x20)
-    command, encoded = core.utils.split_line(line)
+    command, _, encoded = line.partition(b' ')
 
-    # 'encoded' is a string of encoded binary data.
+    # 'encoded' is a bytes string of encoded binary data.
     # The constructor will decode and parse it, so we can return
     # a readily initialized message object.
+    msg = protocol_msg_classes.get(command)
+    if msg is None:
+        return ProtocolMsg.from_line(bl, conn, command.decode('ascii', 'replace'), encoded)
+    return msg.from_line(bl, conn, msg.command, encoded)
+
+
+def protocol_msg_from_frame(bl, conn, frame: core.framing.Frame):
+    """The factory for messages received as binary frames, see protocol_msg_from_line()."""
+    msg = protocol_msg_ids.get(frame.command_id)
+    if msg is None:
+        return ProtocolMsg.from_blob(bl, conn, f'#{frame.command_id}', frame.payload)
+    return msg.from_blob(bl, conn, msg.command, frame.payload)
+
+
+global handled
+handled: int = 0  # received messages, for TIMING_SAMPLE
+message_counters: dict[type, core.metrics.CounterValue] = {}  # message class -> its messages_received
+
+
+def handle_item(bl, conn, item):
+    """Parses and executes a received line or frame, counting it in core.metrics.
+
+    Only every TIMING_SAMPLE-th message is timed, timing all of them
+    would cost more than parsing a short message.
+
+    :raises Exception: Whatever parsing or executing raised.
+    """
+    global handled
+    handled += 1
+    timed = not handled % TIMING_SAMPLE
+    if timed:
+        start = time.perf_counter()
     try:
-        msg = globals()[f'Protocol{command}']
-    except KeyError:
-        msg = ProtocolMsg
+        message = protocol_msg_from_item(bl, conn, item)
+        message.execute()
+    except Exception:
+        core.metrics.protocol_errors.labels('message').inc()
+        raise
+    if timed:
+        core.metrics.message_seconds.observe(time.perf_counter() - start)
+    counter = message_counters.get(type(message))
+    if counter is None:
+        # the command of an unknown message is whatever the peer sent, not a label value
+        command = 'unknown' if type(message) is ProtocolMsg else message.command
+        counter = message_counters[type(message)] = core.metrics.messages_received.labels(command)
+    counter.value += 1
+
+
+def protocol_msg_from_item(bl, conn, item):
+    """Creates the message for a line or a frame from core.framing.WireDecoder."""
+    if type(item) is bytes:
+        return protocol_msg_from_line(bl, conn, item)
+    return protocol_msg_from_frame(bl, conn, item)
+
+
+def command_of(item) -> bytes:
+    """The command of a received line or frame, without parsing the message."""
+    if type(item) is bytes:
+        return item.partition(b' ')[0]
+    msg = protocol_msg_ids.get(item.command_id)
+    return msg.command.encode('ascii') if msg else b''
 
-    return msg(bl, conn, command, encoded)
+
+def line_to_frame(line: bytes) -> bytes:
+    """Converts an encoded line to a binary frame.
+
+    Used for lines that were queued before a connection switched to binary.
+    """
+    command, _, encoded = line.rstrip(b'\n').partition(b' ')
+    return core.framing.encode_frame(command_id(command), 0, decode_lf(encoded))
+
+
+def encode_lf(blob: bytes) -> bytes:
+    """Encodes binary data so that it does not contain any 0x0a bytes.
+
+    This is the TorChat line encoding: every backslash is replaced
+    by backslash + slash and then every 0x0a by backslash + n.
+    Both replacements run in C (bytes.replace), so even multi-megabyte
+    blobs are encoded at close to memory bandwidth.
+
+    :param: Raw binary data.
+    :type: bytes
+    :return: Encoded data without 0x0a.
+    :rtype: bytes
+    """
+    return blob.replace(b'\\', b'\\/').replace(b'\n', b'\\n')
+
+
+def decode_lf(encoded: bytes) -> bytes:
+    """Decodes data encoded with encode_lf().
+
+    The replacements must be done in the reverse order: after the first
+    step a backslash followed by n can only originate from an encoded 0x0a,
+    because every original backslash has been followed by a slash.
+
+    :param: Encoded data.
+    :type: bytes
+    :return: Raw binary data.
+    :rtype: bytes
+    """
+    if b'\\' not in encoded:
+        # nothing was escaped, this is a single memchr()
+        return encoded
+    return encoded.replace(b'\\n', b'\n').replace(b'\\/', b'\\')
 
 
 class ProtocolMsg:
@@ -39,69 +177,68 @@ class ProtocolMsg:
     this class is also instantiated for every unknown incoming message.
     In this case execute() will simply reply with not_implemented"""
 
-    def __init__(self, *args):
-        """ this is actually a few overloaded constructors,
-        depending on the types of arguments
+    command = ''
+    command_id = 0
+    stream = None  # outgoing lines of a stream (file data) are sent after all others
 
-        when receiving a message we instantiate it like this:
-        __init__(self, bl, connection, command, encoded)
+    def __init_subclass__(cls, command: str = None, **kwargs):
+        """Registers the message class for its command.
 
-        when preparing a message for sending we do it like this:
-        __init__(self, connection, blob)
-        __init__(self, buddy, blob)
+        The command is derived from the class name unless given explicitly:
+        class ProtocolFoo(ProtocolMsg, command='foo_bar')
+        """
+        super().__init_subclass__(**kwargs)
+        cls.command = command or command_from_class_name(cls.__name__)
+        cls.command_id = command_id(cls.command.encode('ascii'))
+        other = protocol_msg_ids.get(cls.command_id)
+        if other is not None and other.command != cls.command:
+            raise ValueError(f'commands {other.command} and {cls.command} have the same id')
+        protocol_msg_classes[cls.command.encode('ascii')] = cls
+        protocol_msg_ids[cls.command_id] = cls
 
-        blob is a string of raw binary 8-bit data, the contents
-        of chat messages, names, texts must be UTF-8 encoded"""
+    def __init__(self, buddy=None, connection=None, blob=b''):
+        """Constructor for outgoing messages.
 
+        ProtocolFoo(buddy, blob=...) sends over the buddy's outgoing connection,
+        ProtocolFoo(connection=conn, blob=...) sends over the given connection.
+
+        blob is a string of raw binary 8-bit data, the contents
+        of chat messages, names, texts must be UTF-8 encoded.
+        Lists and tuples are joined with spaces."""
+        if connection is None and buddy is not None:
+            connection = buddy.conn_out
+        elif buddy is None and connection is not None:
+            buddy = connection.buddy
         self.bl = None
-        self.buddy = None
-        self.connection = None
+        self.buddy = buddy
+        self.connection = connection
 
-        #
-        # incoming
-        #
-        # __init__(self, bl, connection, command, encoded)
-        if type(args[0]) == BuddyList:
-            self.bl = args[0]
-            self.connection = args[1]
-            if self.connection:
-                self.buddy = self.connection.buddy
-            self.command = args[2]
-
-            # decode from line format to raw binary
-            # and then let the message parse it
-            self.blob = decode_lf(args[3])
-            self.parse()
-
-            # the incoming message is now properly initialized and somebody
-            # could now call its execute() method to trigger its action
-            return
+        if type(blob) in (list, tuple):
+            blob = b' '.join(part if type(part) is bytes else str(part).encode('utf-8') for part in blob)
+        elif type(blob) is not bytes:
+            blob = str(blob).encode('utf-8')
+        self.blob = blob
 
-        #
-        # outgoing
-        #
-        # __init__(self, connection, blob)
-        # __init__(self, buddy, blob)
-        if type(args[0]) in [core.network.InConnection, core.network.OutConnection, Buddy]:
-            if type(args[0]) in [core.network.InConnection, core.network.OutConnection]:
-                self.connection = args[0]
-                if self.connection.buddy:
-                    self.buddy = self.connection.buddy
-
-            elif type(args[0]) == Buddy:
-                self.buddy = args[0]
-                self.connection = self.buddy.conn_out
-
-            if len(args) > 1:
-                blob = args[1]
-                if type(blob) in [list, tuple]:
-                    self.blob = ' '.join(str(part) for part in blob)
-                else:
-                    self.blob = str(blob)
-            else:
-                self.blob = ''
-
-            self.command = type(self).__name__[12:]
+    @classmethod
+    def from_line(cls, bl, connection, command: str, encoded: bytes):
+        """Constructor for incoming messages.
+
+        Decodes the line format to raw binary and lets the message parse it.
+        The returned message is properly initialized and somebody could
+        now call its execute() method to trigger its action."""
+        return cls.from_blob(bl, connection, command, decode_lf(encoded))
+
+    @classmethod
+    def from_blob(cls, bl, connection, command: str, blob: bytes):
+        """Constructor for incoming messages with raw binary data (from_line() or a frame)."""
+        self = cls.__new__(cls)
+        self.bl = bl
+        self.connection = connection
+        self.buddy = connection.buddy if connection else None
+        self.command = command
+        self.blob = blob
+        self.parse()
+        return self
 
     def parse(self):
         pass
@@ -112,19 +249,19 @@ class ProtocolMsg:
         # do nothing and just reply with "not_implemented"
         if self.buddy:
             print(f'(2) received unimplemented msg ({self.command}) from {self.buddy.address}')
-            message = ProtocolNotImplemented(self.buddy)
+            message = ProtocolNotImplemented(self.buddy, blob=self.command)
             message.send()
         else:
             print('(2) received unknown command on unknown connection. Closing.')
             print(f"(2) unknown connection had '{self.connection.last_ping_address}' in last ping. Closing.")
             self.connection.close()
 
-    def get_line(self) -> str:
-        """return the entire message readily encoded as a string of characters
+    def get_line(self) -> bytes:
+        """return the entire message readily encoded as a string of bytes
         that we can transmit over the socket, terminated by a 0x0a character
 
         :return: Encoded message.
-        :rtype: str
+        :rtype: bytes
         """
         # This is important:
         # The data that is transmitted over the socket (the entire contents
@@ -143,18 +280,56 @@ class ProtocolMsg:
         #
         # get_line() is called right before transmitting it over the socket
         # to produce the "line" and the exact inverse operation on the
-        # receiving side will happen in __init__() when a new message object
+        # receiving side will happen in from_line() when a new message object
         # is constructed from the incoming encoded line string.
-        return f'{self.command} {encode_lf(self.blob)}\n'
+        return b'%s %s\n' % (self.command.encode('ascii'), encode_lf(self.blob))
+
+    def get_frame(self) -> bytes:
+        """Returns the message as a binary frame, the blob is not escaped.
+
+        :return: Encoded message.
+        :rtype: bytes
+        """
+        return core.framing.encode_frame(self.command_id, 0, self.blob)
+
+    def encode(self, binary: bool) -> bytes:
+        return self.get_frame() if binary else self.get_line()
 
     def send(self):
-        """Sends the outgoing message."""
+        """Sends the outgoing message.
+
+        The connection encodes it, as a line or as a binary frame.
+        """
         if self.connection:
-            self.connection.send(self.get_line())
+            self.connection.send_msg(self)
         else:
             print('(0) message without connection could not be sent')
 
 
+class ProtocolFeatures(ProtocolMsg):
+    """Tells which protocol extensions we understand: <feature> <feature> ...
+
+    OnionChat sends this on its outgoing connection after the handshake.
+    A peer that understands binary frames on its incoming connection will
+    get them on ours from then on, compressed if it can decompress them.
+    TorChat clients answer not_implemented and everything stays as it was.
+    """
+    def parse(self):
+        self.features = set(self.blob.split())
+
+    def execute(self):
+        if self.buddy is None:
+            return
+        self.buddy.features = self.features
+        if b'binary' in self.features and self.buddy.conn_out is not None:
+            self.buddy.conn_out.switch_to_binary(core.compression.Compressor.for_features(self.features))
+
+
+def send_features(buddy):
+    """Offers our protocol extensions, call when the handshake is complete."""
+    ProtocolFeatures(buddy, blob=SUPPORTED_FEATURES).send()
+
+
 class ProtocolNotImplemented(ProtocolMsg):
     """This message is sent whenever we cannot understand the command.
 
@@ -168,3 +343,121 @@ class ProtocolNotImplemented(ProtocolMsg):
     def execute(self):
         if self.buddy:
             print(f"(2) {self.buddy.address} says it can't handle '{self.offending_command}'")
+
+
+# File transfer
+#
+# The sender offers a file with filename and then streams it in blocks with
+# filedata, each carrying the offset of the block and the md5 of its data.
+# The receiver acknowledges every block with filedata_ok. Up to
+# config.FILE_WINDOW blocks are in flight, so the sender never waits for a
+# round trip through Tor before sending the next block. filedata_error asks
+# the sender to continue at the given offset: all data before it has been
+# received. It is sent when a block is damaged and when the receiver
+# resumes an interrupted transfer. The engine is in core.filetransfer.
+#
+# Data messages go over the sender's outgoing connection, the replies over
+# the receiver's outgoing connection. That's why outgoing connections
+# accept file* messages.
+
+TRANSFER_ID = re.compile(rb'[A-Za-z0-9_-]{1,64}')
+
+
+def parse_transfer_id(transfer_id: bytes) -> str:
+    """Checks a transfer id received from a peer, it becomes part of local file names.
+
+    :raises ValueError: If it has other characters than letters, digits, _ and - or is too long.
+    """
+    if not TRANSFER_ID.fullmatch(transfer_id):
+        raise ValueError(f'invalid transfer id {transfer_id[:80]!r}')
+    return transfer_id.decode('ascii')
+
+
+class ProtocolFilename(ProtocolMsg):
+    """Offers a file: <id> <file size> <block size> <file name>"""
+    def parse(self):
+        try:
+            transfer_id, size, block_size, filename = self.blob.split(b' ', 3)
+            self.id = parse_transfer_id(transfer_id)
+            self.size = int(size)
+            self.block_size = int(block_size)
+            self.filename = filename.decode('utf-8')
+        except ValueError:
+            self.id = None
+
+    def execute(self):
+        if self.buddy is None or self.id is None:
+            return
+        receiver = core.filetransfer.receivers.get(self.id)
+        if receiver is not None and receiver.buddy is self.buddy:
+            # offered again by a sender that did not get an acknowledgement yet
+            return
+        core.filetransfer.FileReceiver(self.buddy, self.id, self.size, self.block_size, self.filename)
+
+
+class ProtocolFiledata(ProtocolMsg):
+    """A block of a file: <id> <offset> <md5 hex digest> <data>"""
+    def parse(self):
+        try:
+            transfer_id, start, digest, self.data = self.blob.split(b' ', 3)
+            self.id = parse_transfer_id(transfer_id)
+            self.start = int(start)
+            self.digest = digest.decode('ascii')
+        except ValueError:
+            self.id = None
+
+    def execute(self):
+        if self.buddy is None or self.id is None:
+            return
+        receiver = core.filetransfer.receivers.get(self.id)
+        if receiver is None or receiver.buddy is not self.buddy:
+            # e.g. we cancelled it, tell the sender once more
+            ProtocolFileStopSending(self.buddy, blob=self.id).send()
+        else:
+            receiver.data(self.start, self.digest, self.data)
+
+
+class ProtocolFiledataOk(ProtocolMsg):
+    """Acknowledges a block: <id> <offset>"""
+    def parse(self):
+        try:
+            transfer_id, start = self.blob.split(b' ', 1)
+            self.id = parse_transfer_id(transfer_id)
+            self.start = int(start)
+        except ValueError:
+            self.id = None
+
+    def execute(self):
+        sender = core.filetransfer.senders.get(self.id)
+        if sender is not None and sender.buddy is self.buddy:
+            sender.ok(self.start)
+
+
+class ProtocolFiledataError(ProtocolFiledataOk):
+    """Asks to continue at an offset: <id> <offset>"""
+    def execute(self):
+        sender = core.filetransfer.senders.get(self.id)
+        if sender is not None and sender.buddy is self.buddy:
+            sender.error(self.start)
+
+
+class ProtocolFileStopSending(ProtocolMsg):
+    """Sent by the receiver: <id>"""
+    def parse(self):
+        try:
+            self.id = parse_transfer_id(self.blob)
+        except ValueError:
+            self.id = None
+
+    def execute(self):
+        sender = core.filetransfer.senders.get(self.id)
+        if sender is not None and sender.buddy is self.buddy:
+            sender.stop()
+
+
+class ProtocolFileStopReceiving(ProtocolFileStopSending):
+    """Sent by the sender: <id>"""
+    def execute(self):
+        receiver = core.filetransfer.receivers.get(self.id)
+        if receiver is not None and receiver.buddy is self.buddy:
+            receiver.stop()
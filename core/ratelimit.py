@@ -0,0 +1,179 @@
+"""Token bucket rate limits for incoming traffic.
+
+Every connection has its own limits on received lines and bytes per second
+and all connections together share global limits. The limits are
+configured in the [limits] section of the ini.
+
+Connections that did not complete the handshake share smaller global
+limits of their own, so strangers cannot use up what the buddies get.
+Traffic above a connection's own limit is not counted in the global
+limits either: a flooding connection only waits for its own debt and
+does not make everybody else wait for it.
+
+Nothing above the limits is dropped, a dropped line could be a block of
+a file transfer or a chat message. Instead the receiver stops reading for
+a while, TCP flow control slows down the sender and a flooding peer gets
+no more lines parsed than its limit allows.
+"""
+import threading
+import time
+
+import config
+import core.metrics
+
+
+class TokenBucket:
+    """A thread-safe token bucket.
+
+    Tokens are refilled continuously with `rate` tokens per second up to
+    `burst` tokens, by default `rate` but at least 1 so that a rate below
+    1 lets anything through at all. A rate of 0 disables the limit.
+    """
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def consume(self, amount: float = 1) -> bool:
+        """Takes tokens if there are enough of them.
+
+        :return: Whether the tokens were available.
+        :rtype: bool
+        """
+        if not self.rate:
+            return True
+        with self.lock:
+            self.refill()
+            if self.tokens < amount:
+                return False
+            self.tokens -= amount
+            return True
+
+    def reserve(self, amount: float) -> float:
+        """Takes tokens even if there are not enough of them.
+
+        :return: Seconds to wait until the debt is paid off.
+        :rtype: float
+        """
+        if not self.rate:
+            return 0
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+global global_lines, global_bytes, unauthenticated_lines, unauthenticated_bytes
+global_lines: TokenBucket | None = None
+global_bytes: TokenBucket | None = None
+unauthenticated_lines: TokenBucket | None = None
+unauthenticated_bytes: TokenBucket | None = None
+
+stats_lock = threading.Lock()
+stats = {
+    'throttled_lines': 0,  # lines received above the limits, reading was paused
+    'throttled_bytes': 0,  # bytes received above the limits, reading was paused
+    'rejected_connections': 0,  # accepted and closed at once, too many unauthenticated
+}
+
+
+def count(name: str, amount: int = 1):
+    with stats_lock:
+        stats[name] += amount
+
+
+def get_stats() -> dict:
+    """Returns a copy of the throttled traffic counters.
+
+    :return: Counter name -> value.
+    :rtype: dict
+    """
+    with stats_lock:
+        return dict(stats)
+
+
+def collect_metrics() -> dict:
+    return core.metrics.from_stats('ratelimit', 'Traffic throttled or rejected by the limits of core.ratelimit.',
+                                   get_stats())
+
+
+core.metrics.add_collector(collect_metrics)
+
+
+def get_global_buckets(authenticated: bool = True) -> tuple[TokenBucket, TokenBucket]:
+    """Returns the shared line and byte buckets of authenticated or unauthenticated connections."""
+    global global_lines, global_bytes, unauthenticated_lines, unauthenticated_bytes
+    if global_lines is None:
+        limits = config.ini['limits']
+        global_lines = TokenBucket(limits['global_lines_per_sec'])
+        global_bytes = TokenBucket(limits['global_bytes_per_sec'])
+    if unauthenticated_lines is None:
+        limits = config.ini['limits']
+        unauthenticated_lines = TokenBucket(limits['unauthenticated_lines_per_sec'])
+        unauthenticated_bytes = TokenBucket(limits['unauthenticated_bytes_per_sec'])
+    if authenticated:
+        return global_lines, global_bytes
+    return unauthenticated_lines, unauthenticated_bytes
+
+
+class TrafficLimiter:
+    """Limits of one connection, checked together with the global limits."""
+    def __init__(self, authenticated: bool = True):
+        """
+        :param authenticated: False for an incoming connection until the
+            handshake is complete, see authenticate().
+        """
+        limits = config.ini['limits']
+        self.lines = TokenBucket(limits['connection_lines_per_sec'])
+        self.bytes = TokenBucket(limits['connection_bytes_per_sec'])
+        self.global_lines, self.global_bytes = get_global_buckets(authenticated)
+
+    def authenticate(self):
+        """The peer completed the handshake, its traffic counts in the limits of the buddies."""
+        self.global_lines, self.global_bytes = get_global_buckets()
+
+    def delay_for_line(self) -> float:
+        """Accounts a received line.
+
+        :return: Seconds the receiver should pause before processing it.
+        :rtype: float
+        """
+        # a line above the connection's own limit waits for that only
+        delay = self.lines.reserve(1) or self.global_lines.reserve(1)
+        if delay:
+            count('throttled_lines')
+        return delay
+
+    def delay_for(self, size: int) -> float:
+        """Accounts received bytes.
+
+        :return: Seconds the receiver should pause before reading again.
+        :rtype: float
+        """
+        delay = self.bytes.reserve(size) or self.global_bytes.reserve(size)
+        if delay:
+            count('throttled_bytes', size)
+        return delay
+
+
+def may_accept(unauthenticated: int) -> bool:
+    """Checks whether another unauthenticated connection may be accepted.
+
+    :param unauthenticated: Incoming connections that did not complete the
+        handshake yet, the Listener keeps count of them.
+    :return: False if the new connection must be closed at once.
+    :rtype: bool
+    """
+    if unauthenticated < config.ini['limits']['max_unauthenticated_connections']:
+        return True
+    count('rejected_connections')
+    return False
@@ -0,0 +1,194 @@
+"""Scheduling of outgoing lines: chat before file data, fair upload sharing.
+
+Every outgoing connection queues its lines in a LineScheduler. Lines without
+a stream (chat messages, status, pings) always go first. Lines of a stream
+(the filedata blocks of one file transfer) are bulk: they are only sent
+when no other line is waiting, one block at a time, taking turns with the
+other transfers to the same buddy.
+
+All bulk lines of all connections also pass the UploadLimiter, which
+enforces the files.upload_limit setting (bytes per second, 0 = no limit).
+It serves the waiting blocks in the order of their virtual finish time
+(self-clocked fair queueing), so every transfer gets the same share of the
+limit, no matter how many transfers the buddies have.
+"""
+import heapq
+import itertools
+import threading
+from collections import OrderedDict, deque
+
+import config
+import core.metrics
+import core.ratelimit
+
+
+class UploadLimiter:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.bucket = core.ratelimit.TokenBucket(rate)
+        self.lock = threading.Lock()
+        self.heap = []  # (finish, seq, stream), the waiting blocks
+        self.tags: dict = {}  # stream -> its heap entry
+        self.wakers: dict = {}  # stream -> called when it is its turn
+        self.last_finish: dict = {}  # stream -> finish time of its last block
+        self.virtual_time = 0.0
+        self.sequence = itertools.count()
+
+    def request(self, stream, size: int, wake) -> tuple[float | None, list]:
+        """Asks whether a block of a stream may be sent now.
+
+        Takes the tokens if it may. Otherwise the block keeps its place in
+        the queue until it is requested again or cancel()ed.
+
+        :param wake: Called (without any lock held) when the block is
+            first in the queue and was not allowed to be sent.
+        :return: 0 if the block may be sent, else the seconds to wait or
+            None to wait for wake(). Also the wakers the caller must call
+            once it released its own locks.
+        :rtype: tuple[float | None, list]
+        """
+        if not self.rate:
+            return 0, []
+        with self.lock:
+            tag = self.tags.get(stream)
+            if tag is None:
+                finish = max(self.last_finish.get(stream, 0.0), self.virtual_time) + size
+                tag = self.tags[stream] = (finish, next(self.sequence), stream)
+                heapq.heappush(self.heap, tag)
+            self.wakers[stream] = wake
+            self.drop_stale()
+            if self.heap[0] is not tag:
+                return None, []
+            self.bucket.refill()
+            needed = min(size, self.bucket.burst)
+            if self.bucket.tokens < needed:
+                return (needed - self.bucket.tokens) / self.rate, []
+            self.bucket.tokens -= size
+            heapq.heappop(self.heap)
+            del self.tags[stream]
+            del self.wakers[stream]
+            self.last_finish[stream] = tag[0]
+            self.virtual_time = tag[0]
+            if len(self.last_finish) > 1024:
+                # streams that are behind the virtual time have no advantage to remember
+                self.last_finish = {key: value for key, value in self.last_finish.items()
+                                    if value > self.virtual_time}
+            return 0, self.next_waker()
+
+    def cancel(self, stream) -> list:
+        """Forgets the waiting block of a stream.
+
+        :return: The wakers the caller must call once it released its locks.
+        :rtype: list
+        """
+        with self.lock:
+            if self.tags.pop(stream, None) is None:
+                return []
+            self.wakers.pop(stream, None)
+            self.drop_stale()
+            return self.next_waker()
+
+    def drop_stale(self):
+        while self.heap and self.tags.get(self.heap[0][2]) is not self.heap[0]:
+            heapq.heappop(self.heap)
+
+    def next_waker(self) -> list:
+        self.drop_stale()
+        if not self.heap:
+            return []
+        return [self.wakers[self.heap[0][2]]]
+
+
+global upload_limiter
+upload_limiter: UploadLimiter | None = None
+
+
+def get_upload_limiter() -> UploadLimiter:
+    global upload_limiter
+    if upload_limiter is None:
+        upload_limiter = UploadLimiter(config.ini.get('files', {}).get('upload_limit', 0))
+    return upload_limiter
+
+
+def collect_metrics() -> dict:
+    waiting = len(upload_limiter.tags) if upload_limiter is not None else 0
+    return core.metrics.single('upload_streams_waiting', 'gauge', 'File transfers waiting for the upload limit.',
+                               waiting)
+
+
+core.metrics.add_collector(collect_metrics)
+
+
+class LineScheduler:
+    """The outgoing lines of one connection, not thread-safe by itself."""
+    def __init__(self, limiter: UploadLimiter = None):
+        self.limiter = limiter or get_upload_limiter()
+        self.priority = deque()
+        self.streams: OrderedDict = OrderedDict()  # stream -> deque of lines, in turn order
+
+    def __len__(self):
+        return len(self.priority) + sum(map(len, self.streams.values()))
+
+    def add(self, data: bytes, stream=None):
+        if stream is None:
+            self.priority.append(data)
+        else:
+            self.streams.setdefault(stream, deque()).append(data)
+
+    def convert(self, function):
+        """Replaces every queued line with function(line)."""
+        self.priority = deque(map(function, self.priority))
+        for stream, lines in self.streams.items():
+            self.streams[stream] = deque(map(function, lines))
+
+    def push_front(self, data: bytes):
+        """Queues a line to be sent before everything else."""
+        self.priority.appendleft(data)
+
+    def discard(self, stream) -> list:
+        """Drops the queued lines of a stream, e.g. of a cancelled transfer.
+
+        :return: Wakers to call, see UploadLimiter.cancel().
+        :rtype: list
+        """
+        if self.streams.pop(stream, None) is None:
+            return []
+        return self.limiter.cancel(stream)
+
+    def clear(self) -> list:
+        wakers = []
+        for stream in list(self.streams):
+            wakers += self.discard(stream)
+        self.priority.clear()
+        return wakers
+
+    def take(self, max_size: int, wake) -> tuple[bytes | None, float | None, list]:
+        """Takes the lines to send next.
+
+        :return: The lines (None if nothing may be sent now), the seconds
+            to wait before asking again (None: until something is added
+            or wake() is called) and wakers to call, see UploadLimiter.
+        :rtype: tuple[bytes | None, float | None, list]
+        """
+        if self.priority:
+            batch = [self.priority.popleft()]
+            size = len(batch[0])
+            while self.priority and size + len(self.priority[0]) <= max_size:
+                data = self.priority.popleft()
+                batch.append(data)
+                size += len(data)
+            return b''.join(batch), 0, []
+
+        delay = None
+        for stream, lines in self.streams.items():
+            wait, wakers = self.limiter.request(stream, len(lines[0]), wake)
+            if wait == 0:
+                data = lines.popleft()
+                # next turn for the other streams of this connection
+                del self.streams[stream]
+                if lines:
+                    self.streams[stream] = lines
+                return data, 0, wakers
+            if wait is not None:
+                delay = wait if delay is None else min(delay, wait)
+        return None, delay, []
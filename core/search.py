@@ -0,0 +1,294 @@
+"""Full-text search over the chat history of all conversations.
+
+The index is an inverted index: every token maps to the sorted array of
+ids of the messages that contain it. Message ids are assigned in the order
+the messages are indexed, so a higher id is a more recent message and
+results are ranked by recency simply by walking the postings backwards.
+
+Query syntax, all parts must match:
+    hello world         messages containing both words
+    hel*                words starting with hel
+    "hello world"       the exact phrase
+
+The index lives next to the message store: a snapshot written by save()
+and a journal of the messages indexed since, which is replayed on load.
+The message store calls flush() after every sync of its messages, it
+makes the journal durable and replaces it by a snapshot once it grew
+past JOURNAL_MAX_SIZE. last_numbers() tells the profile whether the index
+still matches the store after a crash.
+
+Messages that compaction removes from the store stay in the index until
+it is rebuilt. Their text cannot be fetched anymore, so the profile drops
+them from the search results, but their postings take up memory.
+"""
+import bisect
+import heapq
+import os
+import pathlib
+import pickle
+import re
+import threading
+from array import array
+
+TOKEN_RE = re.compile(r'\w+')
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+MAX_PREFIX_EXPANSION = 100  # a prefix matching more tokens only uses the most frequent ones
+SNAPSHOT_VERSION = 2
+JOURNAL_MAX_SIZE = 16 * 1024 * 1024  # bytes, flush() writes a snapshot above
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+class SearchIndex:
+    def __init__(self, path: str | pathlib.Path = None, fetch_text=None):
+        """Creates or loads the index.
+
+        :param path: Directory of the index files, None for an in-memory index.
+        :param fetch_text: Callable (buddy_id, number) -> text or None,
+            used to verify phrases.
+        """
+        self.path = pathlib.Path(path) if path else None
+        self.fetch_text = fetch_text
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # one save() at a time
+        self.postings: dict[str, array] = {}
+        # per message id
+        self.doc_buddy = array('I')  # index into self.buddy_ids
+        self.doc_number = array('Q')  # message number in the conversation
+        self.buddy_ids: list[str] = []
+        self.buddy_numbers: dict[str, int] = {}
+        self.buddy_next: dict[str, int] = {}  # per buddy: the highest indexed number + 1
+        self.sorted_tokens: list[str] | None = None
+        self.journal = None
+        if self.path:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.load()
+            self.journal = open(self.path / 'search.journal', 'a', encoding='utf-8')
+
+    def __len__(self):
+        return len(self.doc_number)
+
+    def add(self, buddy_id: str, number: int, text: str):
+        """Indexes one message, called for every stored message."""
+        with self.lock:
+            self.add_unlocked(buddy_id, number, text)
+            if self.journal:
+                # tabs and newlines are tokenized away anyway
+                self.journal.write(f'{buddy_id}\t{number}\t{" ".join(tokenize(text))}\n')
+
+    def add_unlocked(self, buddy_id: str, number: int, text: str, tokens: list[str] = None):
+        doc = len(self.doc_number)
+        try:
+            buddy = self.buddy_numbers[buddy_id]
+        except KeyError:
+            buddy = self.buddy_numbers[buddy_id] = len(self.buddy_ids)
+            self.buddy_ids.append(buddy_id)
+        self.doc_buddy.append(buddy)
+        self.doc_number.append(number)
+        if number >= self.buddy_next.get(buddy_id, 0):
+            self.buddy_next[buddy_id] = number + 1
+        for token in set(tokenize(text) if tokens is None else tokens):
+            try:
+                self.postings[token].append(doc)
+            except KeyError:
+                self.postings[token] = array('I', (doc,))
+                self.sorted_tokens = None
+
+    def expand_prefix(self, prefix: str) -> list[array]:
+        if self.sorted_tokens is None:
+            self.sorted_tokens = sorted(self.postings)
+        tokens = self.sorted_tokens
+        start = bisect.bisect_left(tokens, prefix)
+        end = bisect.bisect_left(tokens, prefix + '\U0010ffff')
+        postings = [self.postings[token] for token in tokens[start:end]]
+        if len(postings) > MAX_PREFIX_EXPANSION:
+            postings = heapq.nlargest(MAX_PREFIX_EXPANSION, postings, key=len)
+        return postings
+
+    def parse_query(self, query: str) -> tuple[list[list[array]], list[str]]:
+        """Turns a query into clauses and phrases.
+
+        Every clause is a list of postings, a message matches a clause
+        if it is in any of them (more than one only for prefixes).
+        """
+        clauses = []
+        phrases = []
+        for phrase, word in QUERY_RE.findall(query.lower()):
+            if phrase:
+                tokens = tokenize(phrase)
+                if len(tokens) > 1:
+                    phrases.append(' '.join(tokens))
+                parts = [(token, False) for token in tokens]
+            else:
+                parts = [(token, word.endswith('*')) for token in tokenize(word)]
+            for token, is_prefix in parts:
+                if is_prefix:
+                    clauses.append(self.expand_prefix(token))
+                else:
+                    clauses.append([self.postings.get(token, array('I'))])
+        return clauses, phrases
+
+    @staticmethod
+    def contains(postings: list[array], doc: int) -> bool:
+        for posting in postings:
+            i = bisect.bisect_left(posting, doc)
+            if i < len(posting) and posting[i] == doc:
+                return True
+        return False
+
+    def search(self, query: str, limit: int = 50) -> list[tuple[str, int]]:
+        """Finds messages, the most recent first.
+
+        :return: (buddy_id, message number) of up to limit messages.
+        :rtype: list[tuple[str, int]]
+        """
+        with self.lock:
+            clauses, phrases = self.parse_query(query)
+            if not clauses:
+                return []
+            clauses.sort(key=lambda clause: sum(map(len, clause)))
+            smallest, others = clauses[0], clauses[1:]
+            if len(smallest) == 1:
+                candidates = reversed(smallest[0])
+            else:
+                candidates = heapq.merge(*(reversed(posting) for posting in smallest), reverse=True)
+
+            result = []
+            last = None
+            for doc in candidates:
+                if doc == last:
+                    # the same message can be in several postings of a prefix
+                    continue
+                last = doc
+                if not all(self.contains(clause, doc) for clause in others):
+                    continue
+                hit = (self.buddy_ids[self.doc_buddy[doc]], self.doc_number[doc])
+                if phrases and not self.has_phrases(hit, phrases):
+                    continue
+                result.append(hit)
+                if len(result) >= limit:
+                    break
+            return result
+
+    def has_phrases(self, hit: tuple[str, int], phrases: list[str]) -> bool:
+        if self.fetch_text is None:
+            return True
+        text = self.fetch_text(*hit)
+        if text is None:
+            return False
+        normalized = ' '.join(tokenize(text))
+        return all(re.search(rf'(?<!\w){re.escape(phrase)}(?!\w)', normalized) for phrase in phrases)
+
+    def load(self):
+        snapshot = self.path / 'search.idx'
+        if snapshot.exists():
+            with open(snapshot, 'rb') as file:
+                data = pickle.load(file)
+            if data.get('version') == SNAPSHOT_VERSION:
+                self.postings = data['postings']
+                self.doc_buddy = data['doc_buddy']
+                self.doc_number = data['doc_number']
+                self.buddy_ids = data['buddy_ids']
+                self.buddy_numbers = {buddy_id: i for i, buddy_id in enumerate(self.buddy_ids)}
+                self.buddy_next = data['buddy_next']
+        # the old journal is left by a save() that did not complete
+        for journal in (self.path / 'search.journal.old', self.path / 'search.journal'):
+            if journal.exists():
+                self.replay(journal)
+
+    def replay(self, journal: pathlib.Path):
+        """Indexes the journal entries the snapshot does not have."""
+        with open(journal, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    buddy_id, number, tokens = line.rstrip('\n').split('\t')
+                    number = int(number)
+                except ValueError:
+                    continue  # torn write of an entry
+                # every buddy's messages are indexed in order, older ones are in the snapshot
+                if number >= self.buddy_next.get(buddy_id, 0):
+                    self.add_unlocked(buddy_id, number, '', tokens.split())
+
+    def save(self):
+        """Writes a snapshot of the index and empties the journal.
+
+        Only copying the index holds the lock, adds and searches go on
+        while the copy is written. What they add goes to a new journal,
+        the old one is removed when the snapshot is complete.
+        """
+        if not self.path:
+            return
+        with self.save_lock:
+            with self.lock:
+                if self.journal is None:
+                    return  # closed
+                data = {
+                    'version': SNAPSHOT_VERSION,
+                    'postings': {token: posting[:] for token, posting in self.postings.items()},
+                    'doc_buddy': self.doc_buddy[:],
+                    'doc_number': self.doc_number[:],
+                    'buddy_ids': list(self.buddy_ids),
+                    'buddy_next': dict(self.buddy_next),
+                }
+                self.rotate_journal()
+            temp = self.path / 'search.idx.tmp'
+            with open(temp, 'wb') as file:
+                pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp, self.path / 'search.idx')
+            (self.path / 'search.journal.old').unlink()
+
+    def rotate_journal(self):
+        """Moves the journal to search.journal.old and starts a new one, call with the lock held."""
+        self.journal.close()
+        journal, old = self.path / 'search.journal', self.path / 'search.journal.old'
+        if old.exists():
+            # a save() failed, its entries are still not in a snapshot
+            with open(old, 'ab') as file:
+                file.write(journal.read_bytes())
+        else:
+            os.replace(journal, old)
+        self.journal = open(journal, 'w', encoding='utf-8')
+
+    def last_numbers(self) -> dict[str, int]:
+        """The number of the last indexed message + 1 of every buddy.
+
+        :return: Buddy id -> the message count of the conversation when it was indexed.
+        :rtype: dict[str, int]
+        """
+        with self.lock:
+            return dict(self.buddy_next)
+
+    def clear(self):
+        """Empties the index, its files included."""
+        with self.lock:
+            self.postings = {}
+            self.doc_buddy = array('I')
+            self.doc_number = array('Q')
+            self.buddy_ids = []
+            self.buddy_numbers = {}
+            self.buddy_next = {}
+            self.sorted_tokens = None
+        self.save()
+
+    def flush(self):
+        """Makes the journal durable, replaces it by a snapshot when it is too large."""
+        with self.lock:
+            if not self.journal:
+                return
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            compact = self.journal.tell() > JOURNAL_MAX_SIZE
+        if compact:
+            self.save()
+
+    def close(self):
+        """Saves the index, closing it again or closing an in-memory index does nothing."""
+        self.save()
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
@@ -0,0 +1,557 @@
+"""Serving the connections of one identity in several worker processes.
+
+The protocol code is pure Python, so one process uses one core no matter
+how many buddies are chatting. With [sharding] workers > 0 the identity
+is served by a Coordinator instead of a BuddyList:
+
+- every buddy belongs to the worker shard_of(address) picks, the worker
+  keeps its outgoing connection (with its own ConnectionManager, the
+  connect slots are split between the workers)
+- the coordinator accepts the incoming connections, reads the first line
+  and hands the socket and the line to a worker: the one of the address
+  in a "ping <address> <cookie>" greeting, else the next in turn
+- workers send their core.events notifications, the messages to store,
+  their connection counts and their core.metrics to the coordinator,
+  which owns the Profile and exports the metrics of all workers (with a
+  worker label)
+
+Coordinator and worker talk over a unix socket pair (the bus), one packet
+per message, so sockets can be passed along with them. This needs
+socket.send_fds (Python 3.9 on Unix). The global traffic limits of
+[limits] are split between the workers.
+"""
+import array
+import asyncio
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+
+import config
+import core.connections
+import core.contacts
+import core.events
+import core.identity
+import core.metrics
+import core.ratelimit
+import core.transport
+import core.utils
+
+MAX_PACKET = 64 * 1024  # bytes, the largest message on the bus
+FDS_SIZE = array.array('i').itemsize  # one file descriptor per message
+MAX_GREETING = 4096  # bytes read before the connection is handed to a worker
+GREETING_TIMEOUT = 5  # seconds to wait for the first line of an incoming connection
+STATS_INTERVAL = 1  # seconds between the connection counts a worker sends
+RESTART_DELAY = 1  # seconds before a worker that exited is started again
+STOP_TIMEOUT = 5  # seconds a worker gets to close its connections
+EVENTS = (core.events.CONTACTS_CHANGED, core.events.CONNECTIONS_CHANGED, core.events.TRANSFERS_CHANGED)
+
+
+def get_settings() -> dict:
+    return config.ini.get('sharding', config.config_defaults['sharding'])
+
+
+def get_workers() -> int:
+    """Returns the configured number of workers, 0 if sharding is off or unsupported."""
+    workers = get_settings()['workers']
+    if workers and not hasattr(socket, 'send_fds'):
+        print('(1) sharding needs socket.send_fds, serving all connections in this process')
+        return 0
+    max_connecting = core.connections.get_settings()['max_connecting']
+    if workers > max_connecting > 0:
+        # a worker without a connect slot would never connect its buddies
+        print(f'(1) [sharding] workers is more than [connections] max_connecting, '
+              f'starting {max_connecting} workers')
+        return max_connecting
+    return workers
+
+
+def shard_of(address: str, shards: int) -> int:
+    """Returns the shard of a buddy, the same in every process (unlike hash())."""
+    digest = hashlib.blake2b(address.encode('ascii'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shards
+
+
+def address_from_greeting(line: bytes) -> str | None:
+    """Returns the address of a "ping <address> <cookie>" line, if it is one."""
+    words = line.split(b' ', 2)
+    if len(words) == 3 and words[0] == b'ping':
+        address = words[1].decode('ascii', 'replace')
+        if core.utils.is_valid_address(address):
+            return address
+    return None
+
+
+class Bus:
+    """One end of the socket pair between the coordinator and a worker.
+
+    A message is one packet: a JSON object, a newline and the raw bytes of
+    the blob, file descriptors go along with it.
+    """
+    def __init__(self, sock: socket.socket):
+        self.socket = sock
+        self.lock = threading.Lock()  # the loop and the publishing threads send
+
+    def send(self, message: dict, blob: bytes = b'', fds: list[int] = None):
+        """:raises OSError: If the other end is gone."""
+        data = json.dumps(message).encode('utf-8') + b'\n' + blob
+        if len(data) > MAX_PACKET:
+            raise ValueError(f'bus message of {len(data)} bytes')
+        with self.lock:
+            if fds:
+                socket.send_fds(self.socket, [data], fds)
+            else:
+                self.socket.send(data)
+
+    def receive(self) -> tuple[dict, bytes, list[int]]:
+        """Receives one message without blocking.
+
+        :return: The message, its blob and the received file descriptors.
+        :rtype: tuple[dict, bytes, list[int]]
+        :raises BlockingIOError: If there is no message.
+        :raises EOFError: If the other end is gone.
+        """
+        # not socket.recv_fds, it ignores the flags before Python 3.12
+        data, ancillary, _, _ = self.socket.recvmsg(MAX_PACKET, socket.CMSG_SPACE(FDS_SIZE), socket.MSG_DONTWAIT)
+        if not data:
+            raise EOFError('bus closed')
+        fds = array.array('i')
+        for level, kind, fd_data in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % fds.itemsize])
+        header, _, blob = data.partition(b'\n')
+        return json.loads(header), blob, list(fds)
+
+    def close(self):
+        self.socket.close()
+
+
+class Shard:
+    """The coordinator's view of one worker."""
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.bus = None
+        self.stats = {'incoming': 0, 'outgoing': {}}
+        self.metrics = {}  # the last snapshot of the worker
+        self.handoffs = 0  # incoming connections handed to it
+
+    def send(self, message: dict, blob: bytes = b'', fds: list[int] = None) -> bool:
+        if self.bus is None:
+            return False
+        try:
+            self.bus.send(message, blob, fds)
+        except OSError:
+            return False
+        return True
+
+
+class Coordinator:
+    """Stands in for the BuddyList (and its manager) of a sharded identity."""
+    def __init__(self, workers: int, loop: core.transport.EventLoop, profile: core.contacts.Profile):
+        self.loop = loop
+        self.profile = profile
+        self.buddies: dict[str, core.identity.Buddy] = {}  # placeholders, the connections are in the workers
+        self.last_active: dict[str, float] = {}
+        self.shards = [Shard(index) for index in range(workers)]
+        self.manager = self  # for IdentityHost.rebalance and the Tor status
+        self.limit = core.connections.get_settings()['max_connecting']
+        self.socket = None
+        self.accept_task = None
+        self.pending = 0  # accepted connections whose greeting is being read
+        self.turn = itertools.count()
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        core.metrics.add_collector(self.collect_metrics)
+        for shard in self.shards:
+            self.start_worker(shard)
+
+    def start_worker(self, shard: Shard):
+        if not self.running:
+            return
+        here, there = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        context = multiprocessing.get_context('spawn')
+        shard.process = context.Process(target=run_worker, args=(shard.index, len(self.shards), there, config.ini),
+                                        name=f'onionchat-worker-{shard.index}', daemon=True)
+        shard.process.start()
+        there.close()
+        shard.bus = Bus(here)
+        shard.stats = {'incoming': 0, 'outgoing': {}}
+        self.loop.call(self.loop.loop.add_reader, here.fileno(), self.on_bus, shard)
+        shard.send({'type': 'limit', 'max_connecting': self.shard_limit(shard)})
+        for address, last_active in list(self.last_active.items()):
+            if shard_of(address, len(self.shards)) == shard.index:
+                shard.send({'type': 'want', 'address': address, 'last_active': last_active})
+        print(f'(1) sharding worker {shard.index} started, pid {shard.process.pid}')
+
+    def detach(self, shard: Shard):
+        """Stops listening to a worker, in the loop thread."""
+        if shard.bus is not None:
+            self.loop.loop.remove_reader(shard.bus.socket.fileno())
+            shard.bus.close()
+            shard.bus = None
+
+    def shard_for(self, address: str) -> Shard:
+        return self.shards[shard_of(address, len(self.shards))]
+
+    def add(self, address: str, last_active: float = 0) -> 'core.identity.Buddy':
+        buddy = self.buddies.get(address)
+        if buddy is None:
+            buddy = self.buddies[address] = core.identity.Buddy(address)
+            self.last_active[address] = last_active
+            self.shard_for(address).send({'type': 'want', 'address': address, 'last_active': last_active})
+        return buddy
+
+    def remove(self, address: str):
+        if self.buddies.pop(address, None) is not None:
+            del self.last_active[address]
+            self.shard_for(address).send({'type': 'forget', 'address': address})
+
+    def touch(self, address: str):
+        if address in self.last_active:
+            self.last_active[address] = time.time()
+            self.shard_for(address).send({'type': 'touch', 'address': address})
+
+    @property
+    def listen_port(self) -> int | None:
+        if self.socket is None:
+            return None
+        return self.socket.getsockname()[1]
+
+    def listen(self, listen_socket: socket.socket):
+        self.start()
+        listen_socket.listen(config.ini['client']['listen_backlog'])
+        listen_socket.setblocking(False)
+        self.socket = listen_socket
+        self.accept_task = self.loop.submit(self.accept())
+
+    def close(self):
+        """Stops the workers, they close their connections."""
+        if not self.running:
+            return
+        self.running = False
+        core.metrics.remove_collector(self.collect_metrics)
+        if self.accept_task is not None:
+            self.accept_task.cancel()
+            self.accept_task = None
+        if self.socket is not None:
+            self.loop.call(self.close_socket, self.socket)
+            self.socket = None
+        for shard in self.shards:
+            shard.send({'type': 'stop'})
+        for shard in self.shards:
+            if shard.process is None:
+                continue
+            shard.process.join(STOP_TIMEOUT)
+            if shard.process.is_alive():
+                print(f'(1) sharding worker {shard.index} did not stop, terminating it')
+                shard.process.terminate()
+                shard.process.join()
+            self.loop.call(self.detach, shard)
+
+    def close_socket(self, sock: socket.socket):
+        self.loop.loop.remove_reader(sock.fileno())
+        sock.close()
+
+    def get_stats(self) -> dict:
+        outgoing = {}
+        for shard in self.shards:
+            for state, number in shard.stats['outgoing'].items():
+                outgoing[state] = outgoing.get(state, 0) + number
+        return {'incoming': sum(shard.stats['incoming'] for shard in self.shards), 'outgoing': outgoing,
+                'workers': [{'pid': shard.process.pid if shard.process else None, **shard.stats}
+                            for shard in self.shards]}
+
+    def collect_metrics(self) -> dict:
+        """Adds the metrics of the workers, each with a worker label."""
+        result = core.metrics.single('sharding_workers', 'gauge', 'Running sharding workers.',
+                                     sum(shard.bus is not None for shard in self.shards))
+        result[core.metrics.PREFIX + 'sharding_handoffs_total'] = {
+            'type': 'counter', 'help': 'Incoming connections handed to a worker.',
+            'samples': [{'labels': {'worker': str(shard.index)}, 'value': shard.handoffs} for shard in self.shards]}
+        for shard in self.shards:
+            core.metrics.merge(result, shard.metrics, {'worker': str(shard.index)})
+        return result
+
+    # the ConnectionManager interface, for core.identity.IdentityHost
+
+    @property
+    def max_connecting(self) -> int:
+        return self.limit
+
+    @max_connecting.setter
+    def max_connecting(self, value: int):
+        self.limit = value
+        for shard in self.shards:
+            shard.send({'type': 'limit', 'max_connecting': self.shard_limit(shard)})
+
+    @property
+    def min_connecting(self) -> int:
+        """The fewest connect slots that give every worker one."""
+        return len(self.shards)
+
+    def shard_limit(self, shard: Shard) -> int:
+        """The worker's part of the connect slots, together they are the limit.
+
+        Every worker gets at least one slot, else its buddies would never
+        be connected. With fewer slots than workers they have more than
+        the limit together, IdentityHost.rebalance() avoids that.
+        """
+        share, rest = divmod(self.limit, len(self.shards))
+        return max(1, share + (shard.index < rest))
+
+    def dispatch(self):
+        pass  # the workers dispatch when their limit changes
+
+    def reset(self):
+        for shard in self.shards:
+            shard.send({'type': 'reset'})
+
+    # incoming connections
+
+    async def accept(self):
+        loop = asyncio.get_running_loop()
+        while self.running:
+            try:
+                sock, _ = await loop.sock_accept(self.socket)
+            except asyncio.CancelledError:
+                return
+            except OSError as err:
+                print(f'(1) sharding: accept failed: {err}')
+                await asyncio.sleep(0.1)
+                continue
+            loop.create_task(self.hand_off(sock))
+
+    async def hand_off(self, sock: socket.socket):
+        # the workers check the limit again, this one is for connections that never send a line
+        if self.pending >= config.ini['limits']['max_unauthenticated_connections'] * len(self.shards):
+            core.ratelimit.count('rejected_connections')
+            sock.close()
+            return
+        self.pending += 1
+        greeting = bytearray()
+        try:
+            await asyncio.wait_for(read_greeting(sock, greeting), GREETING_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass  # the worker gets what there is and applies its own timeouts
+        except OSError:
+            sock.close()
+            return
+        finally:
+            self.pending -= 1
+        first_line = bytes(greeting).split(b'\n', 1)[0]
+        address = address_from_greeting(first_line)
+        if address is not None:
+            shard = self.shard_for(address)
+        else:
+            shard = self.shards[next(self.turn) % len(self.shards)]
+        if shard.send({'type': 'connection'}, bytes(greeting), [sock.fileno()]):
+            shard.handoffs += 1
+        else:
+            print(f'(2) sharding worker {shard.index} is gone, dropping an incoming connection')
+        sock.close()
+
+    # messages from the workers, in the loop thread
+
+    def on_bus(self, shard: Shard):
+        while shard.bus is not None:
+            try:
+                message, blob, fds = shard.bus.receive()
+            except BlockingIOError:
+                return
+            except (EOFError, OSError):
+                self.on_worker_exit(shard)
+                return
+            for fd in fds:
+                os.close(fd)
+            kind = message.get('type')
+            if kind == 'event':
+                core.events.publish(message['event'], *message['args'])
+            elif kind == 'message':
+                self.profile.add_message(message['address'], blob.decode('utf-8'))
+            elif kind == 'stats':
+                shard.stats = {'incoming': message['incoming'], 'outgoing': message['outgoing']}
+                shard.metrics = message['metrics']
+
+    def on_worker_exit(self, shard: Shard):
+        self.detach(shard)
+        if self.running:
+            print(f'(1) sharding worker {shard.index} exited, restarting it')
+            self.loop.loop.call_later(RESTART_DELAY, self.start_worker, shard)
+
+
+async def read_greeting(sock: socket.socket, greeting: bytearray):
+    """Reads up to the end of the first line into greeting."""
+    loop = asyncio.get_running_loop()
+    while b'\n' not in greeting and len(greeting) < MAX_GREETING:
+        data = await loop.sock_recv(sock, MAX_GREETING - len(greeting))
+        if not data:
+            return
+        greeting += data
+
+
+class HandoffListener(core.transport.Listener):
+    """The Listener of a worker, the coordinator accepts the connections."""
+    async def run(self):
+        pass
+
+    async def adopt(self, sock: socket.socket, data: bytes):
+        """Serves an accepted socket, data is what the coordinator already read."""
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        protocol = asyncio.StreamReaderProtocol(reader)
+        try:
+            transport, _ = await loop.connect_accepted_socket(lambda: protocol, sock)
+        except OSError as err:
+            print(f'(2) sharding: cannot serve a handed off connection: {err}')
+            sock.close()
+            return
+        self.on_accept(reader, asyncio.StreamWriter(transport, protocol, reader, loop))
+
+    def _close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for conn in list(self.conns):
+            conn._close()
+
+
+class ForwardingProfile(core.contacts.Profile):
+    """The profile of a worker: received messages are stored by the coordinator."""
+    def __init__(self, worker: 'Worker'):
+        core.contacts.Profile.__init__(self)
+        self.worker = worker
+
+    def add_message(self, buddy_id, message: str):
+        self.worker.post({'type': 'message', 'address': buddy_id}, message.encode('utf-8'))
+
+
+class Worker:
+    """Serves the connections of one shard, in the worker process.
+
+    The worker's messages to the coordinator are sent by a thread of their
+    own: the coordinator may block on a send to the worker, so the event
+    loop of the worker must never block on a send to the coordinator.
+    """
+    def __init__(self, index: int, bus: Bus):
+        self.index = index
+        self.bus = bus
+        self.outbox = queue.SimpleQueue()
+        self.loop = core.transport.get_event_loop()
+        self.stopped = threading.Event()
+        core.contacts.profile = ForwardingProfile(self)
+        self.bl = core.identity.BuddyList(self.loop)
+        self.bl.listener = HandoffListener(self.bl, loop=self.loop)
+        self.handlers = {
+            'want': self.want,
+            'forget': self.forget,
+            'touch': self.touch,
+            'connection': self.connection,
+            'limit': self.limit,
+            'reset': self.reset,
+            'stop': self.stop,
+        }
+
+    def run(self):
+        threading.Thread(target=self.send_outbox, name='bus sender', daemon=True).start()
+        for event in EVENTS:
+            core.events.subscribe(event, self.make_forwarder(event))
+        self.loop.call(self.loop.loop.add_reader, self.bus.socket.fileno(), self.on_bus)
+        self.loop.call(self.send_stats)
+        self.stopped.wait()
+        self.loop.submit(self.shut_down()).result()
+        self.outbox.put(None)
+
+    async def shut_down(self):
+        asyncio.get_running_loop().remove_reader(self.bus.socket.fileno())
+        self.bl.close()
+
+    def post(self, message: dict, blob: bytes = b''):
+        """Sends a message to the coordinator (thread-safe, does not block)."""
+        self.outbox.put((message, blob))
+
+    def send_outbox(self):
+        while (item := self.outbox.get()) is not None:
+            try:
+                self.bus.send(*item)
+            except ValueError as err:
+                print(f'(1) sharding worker {self.index}: {item[0]["type"]} not sent: {err}')
+            except OSError:
+                return  # the coordinator is gone, on_bus stops the worker
+
+    def make_forwarder(self, event: str):
+        def forward(*args):
+            self.post({'type': 'event', 'event': event,
+                       'args': [sorted(arg) if isinstance(arg, set) else arg for arg in args]})
+        return forward
+
+    def send_stats(self):
+        if not self.stopped.is_set():
+            self.post({'type': 'stats', **self.bl.get_stats(), 'metrics': core.metrics.snapshot()})
+            self.loop.loop.call_later(STATS_INTERVAL, self.send_stats)
+
+    def on_bus(self):
+        while not self.stopped.is_set():
+            try:
+                message, blob, fds = self.bus.receive()
+            except BlockingIOError:
+                return
+            except (EOFError, OSError):
+                print(f'(1) sharding worker {self.index}: the coordinator is gone, stopping')
+                self.stop()
+                return
+            handler = self.handlers.get(message.get('type'))
+            if handler is None:
+                print(f'(1) sharding worker {self.index}: unknown bus message {message!r}')
+                for fd in fds:
+                    os.close(fd)
+            else:
+                handler(message, blob, fds)
+
+    def want(self, message: dict, blob: bytes = b'', fds: list[int] = ()):
+        self.bl.add(message['address'], message['last_active'])
+
+    def forget(self, message: dict, blob: bytes = b'', fds: list[int] = ()):
+        self.bl.remove(message['address'])
+
+    def touch(self, message: dict, blob: bytes = b'', fds: list[int] = ()):
+        self.bl.touch(message['address'])
+
+    def connection(self, message: dict, blob: bytes = b'', fds: list[int] = ()):
+        for fd in fds:
+            sock = socket.socket(fileno=fd)
+            sock.setblocking(False)
+            self.loop.loop.create_task(self.bl.listener.adopt(sock, blob))
+
+    def limit(self, message: dict, blob: bytes = b'', fds: list[int] = ()):
+        self.bl.manager.max_connecting = message['max_connecting']
+        self.bl.manager.dispatch()
+
+    def reset(self, message: dict, blob: bytes = b'', fds: list[int] = ()):
+        self.bl.manager.reset()
+
+    def stop(self, message: dict = None, blob: bytes = b'', fds: list[int] = ()):
+        self.stopped.set()
+
+
+def run_worker(index: int, shards: int, channel: socket.socket, ini: dict):
+    """Entry point of a worker process."""
+    # Ctrl+C reaches the whole process group, the coordinator stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    config.ini = ini
+    limits = config.ini['limits']
+    for key in ('global_lines_per_sec', 'global_bytes_per_sec', 'unauthenticated_lines_per_sec',
+                'unauthenticated_bytes_per_sec'):
+        limits[key] = limits[key] / shards
+    Worker(index, Bus(channel)).run()
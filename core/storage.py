@@ -0,0 +1,431 @@
+"""Persistent message and buddy storage.
+
+Layout of the profile directory:
+
+    buddies.json                    the buddy list, replaced atomically
+    messages/<buddy_id>/base        number of the first retained message
+    messages/<buddy_id>/index       one fixed size entry per message
+    messages/<buddy_id>/NNNNNNNN.log  append-only segments with the records
+    messages/<buddy_id>/compacting  only while compact() replaces the index
+
+Every record in a segment is a header (length of the text, crc32 of the
+text, timestamp) followed by the UTF-8 text. The index entry of message n
+is stored at offset (n - base) * INDEX_ENTRY.size and holds the segment
+number and the offset of the record, so any page of a conversation is one
+pread() of the index and one sequential read of a segment away.
+
+Writes are buffered and made durable in batches by sync(): segments are
+fsync()ed before the index, so after a crash the index never points to
+data that did not reach the disk. open() cuts off whatever was written
+after the last complete record. One background thread syncs all open
+stores, a process hosting many identities does not get a thread for each.
+
+A buddy id becomes a directory name, so only ids made of letters, digits,
+_ and - are accepted. The directory of a conversation is created by its
+first message, reading a conversation that does not exist creates nothing.
+"""
+import json
+import os
+import pathlib
+import re
+import struct
+import threading
+import time
+import zlib
+
+RECORD_HEADER = struct.Struct('>IId')  # text length, crc32 of text, timestamp
+INDEX_ENTRY = struct.Struct('>IQ')  # segment number, offset in segment
+SEGMENT_SIZE = 16 * 1024 * 1024
+SYNC_BATCH = 256  # appends after which sync() is called right away
+SYNC_INTERVAL = 1.0  # seconds the background sync waits for more appends
+BUDDY_ID = re.compile(r'[A-Za-z0-9_-]{1,128}')
+
+
+class StorageError(Exception):
+    pass
+
+
+def check_buddy_id(buddy_id: str) -> str:
+    """:raises ValueError: If the id cannot be used as a directory name."""
+    if not isinstance(buddy_id, str) or not BUDDY_ID.fullmatch(buddy_id):
+        raise ValueError(f'invalid buddy id {buddy_id!r}')
+    return buddy_id
+
+
+class Conversation:
+    """The segments and the index of one buddy's message history."""
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.RLock()
+        self.finish_compaction()
+        self.base = self.read_base()
+        self.index_file = open(self.path / 'index', 'a+b')
+        self.segments = sorted(int(name.stem) for name in self.path.glob('*.log'))
+        if not self.segments:
+            self.segments = [0]
+        self.segment_no = self.segments[-1]
+        self.segment_file = open(self.segment_path(self.segment_no), 'a+b')
+        self.dirty = False
+        self.recover()
+        self.count = self.base + self.index_size() // INDEX_ENTRY.size
+
+    def segment_path(self, number: int) -> pathlib.Path:
+        return self.path / f'{number:08d}.log'
+
+    def read_base(self) -> int:
+        try:
+            return int((self.path / 'base').read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def write_base(self, base: int):
+        write_atomic(self.path / 'base', str(base).encode('ascii'))
+        self.base = base
+
+    def index_size(self) -> int:
+        self.index_file.seek(0, os.SEEK_END)
+        return self.index_file.tell()
+
+    def read_entry(self, position: int) -> tuple[int, int]:
+        """Reads the index entry of the position-th retained message."""
+        data = os.pread(self.index_file.fileno(), INDEX_ENTRY.size, position * INDEX_ENTRY.size)
+        if len(data) < INDEX_ENTRY.size:
+            raise StorageError(f'index of {self.path} is truncated')
+        return INDEX_ENTRY.unpack(data)
+
+    def read_record(self, file, offset: int) -> tuple[float, str, int] | None:
+        """Reads one record, returns None if it is incomplete or damaged.
+
+        :return: Timestamp, text and the offset of the next record.
+        :rtype: tuple[float, str, int] | None
+        """
+        header = os.pread(file.fileno(), RECORD_HEADER.size, offset)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        length, crc, timestamp = RECORD_HEADER.unpack(header)
+        data = os.pread(file.fileno(), length, offset + RECORD_HEADER.size)
+        if len(data) < length or zlib.crc32(data) != crc:
+            return None
+        return timestamp, data.decode('utf-8'), offset + RECORD_HEADER.size + length
+
+    def recover(self):
+        """Drops index entries and segment data written after the last complete record."""
+        entries = self.index_size() // INDEX_ENTRY.size
+        self.index_file.truncate(entries * INDEX_ENTRY.size)
+        end = 0
+        while entries:
+            segment, offset = self.read_entry(entries - 1)
+            if segment == self.segment_no:
+                record = self.read_record(self.segment_file, offset)
+            else:
+                with open(self.segment_path(segment), 'rb') as file:
+                    record = self.read_record(file, offset)
+            if record is not None:
+                if segment == self.segment_no:
+                    end = record[2]
+                break
+            entries -= 1
+            self.index_file.truncate(entries * INDEX_ENTRY.size)
+        # the last segment may contain a record whose index entry was not written
+        self.segment_file.truncate(end)
+        self.segment_file.seek(0, os.SEEK_END)
+
+    def append(self, text: str, timestamp: float) -> int:
+        data = text.encode('utf-8')
+        with self.lock:
+            offset = self.segment_file.tell()
+            if offset and offset + RECORD_HEADER.size + len(data) > SEGMENT_SIZE:
+                self.roll()
+                offset = 0
+            self.segment_file.write(RECORD_HEADER.pack(len(data), zlib.crc32(data), timestamp) + data)
+            self.index_file.write(INDEX_ENTRY.pack(self.segment_no, offset))
+            self.dirty = True
+            self.count += 1
+            return self.count - 1
+
+    def roll(self):
+        self.sync()
+        self.segment_file.close()
+        self.segment_no += 1
+        self.segments.append(self.segment_no)
+        self.segment_file = open(self.segment_path(self.segment_no), 'a+b')
+
+    def sync(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            # data first, then the index pointing to it
+            self.segment_file.flush()
+            os.fsync(self.segment_file.fileno())
+            self.index_file.flush()
+            os.fsync(self.index_file.fileno())
+            self.dirty = False
+
+    def read(self, start: int, count: int) -> list[tuple[float, str]]:
+        """Reads up to count messages starting with message number start."""
+        with self.lock:
+            # messages before base were dropped by compact()
+            end = min(start + count, self.count)
+            start = max(start, self.base)
+            if start >= end:
+                return []
+            # make buffered appends visible to pread()
+            self.segment_file.flush()
+            self.index_file.flush()
+            result = []
+            segment, offset = self.read_entry(start - self.base)
+            file = None
+            try:
+                while len(result) < end - start:
+                    if file is None:
+                        file = open(self.segment_path(segment), 'rb')
+                    record = self.read_record(file, offset)
+                    if record is None:
+                        if offset < os.fstat(file.fileno()).st_size:
+                            # going on would give the following messages wrong numbers
+                            raise StorageError(f'damaged record in {file.name} at offset {offset}')
+                        # continue in the next segment
+                        file.close()
+                        file = None
+                        segment += 1
+                        offset = 0
+                        if segment > self.segment_no:
+                            raise StorageError(f'{self.path} ends before message {start + len(result)}')
+                        continue
+                    result.append(record[:2])
+                    offset = record[2]
+            finally:
+                if file is not None:
+                    file.close()
+            return result
+
+    def compact(self, keep: int):
+        """Drops all but the newest `keep` messages.
+
+        Segments that only contain dropped messages are deleted, the index
+        is rewritten without their entries. Message numbers do not change.
+
+        The new index and base must replace the old ones together: both are
+        prepared, then the compacting file commits them and
+        finish_compaction() installs them, after a crash again on open.
+        """
+        with self.lock:
+            new_base = self.count - keep
+            if new_base <= self.base:
+                return
+            self.sync()
+            segment, _ = self.read_entry(new_base - self.base)
+            self.index_file.seek((new_base - self.base) * INDEX_ENTRY.size)
+            remaining = self.index_file.read()
+            write_atomic(self.path / 'index.new', remaining)
+            write_atomic(self.path / 'compacting', str(new_base).encode('ascii'))
+            self.index_file.close()
+            self.finish_compaction()
+            self.index_file = open(self.path / 'index', 'a+b')
+            self.base = new_base
+            for number in [number for number in self.segments if number < segment]:
+                self.segment_path(number).unlink(missing_ok=True)
+                self.segments.remove(number)
+
+    def finish_compaction(self):
+        """Installs the index and the base of a committed compaction, drops an uncommitted one."""
+        try:
+            new_base = int((self.path / 'compacting').read_text())
+        except (FileNotFoundError, ValueError):
+            (self.path / 'index.new').unlink(missing_ok=True)
+            return
+        if (self.path / 'index.new').exists():
+            os.replace(self.path / 'index.new', self.path / 'index')
+        self.write_base(new_base)
+        (self.path / 'compacting').unlink()
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.segment_file.close()
+            self.index_file.close()
+
+
+class MessageStore:
+    """Message histories of all buddies of one profile."""
+    def __init__(self, path: str | pathlib.Path, max_history: int = 0):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_history = max_history
+        self.conversations: dict[str, Conversation] = {}
+        self.lock = threading.Lock()  # of conversations and pending
+        self.pending = 0  # appends since the last sync()
+        self.last_compaction = time.monotonic()
+        self.sync_callbacks = []
+        self.syncer = get_syncer()
+        self.syncer.add(self)
+
+    def conversation(self, buddy_id: str, create: bool = True) -> Conversation | None:
+        """Opens the history of a buddy.
+
+        :param create: Create it if it does not exist yet.
+        :return: The conversation, None if it does not exist and create is not set.
+        :rtype: Conversation | None
+        :raises ValueError: If the buddy id is not a valid directory name.
+        """
+        try:
+            return self.conversations[buddy_id]
+        except KeyError:
+            pass
+        path = self.path / 'messages' / check_buddy_id(buddy_id)
+        with self.lock:
+            if buddy_id not in self.conversations:
+                if not create and not path.is_dir():
+                    return None
+                self.conversations[buddy_id] = Conversation(path)
+            return self.conversations[buddy_id]
+
+    def append(self, buddy_id: str, text: str, timestamp: float = None) -> int:
+        """Stores a message.
+
+        :return: Number of the stored message in its conversation.
+        :rtype: int
+        """
+        number = self.conversation(buddy_id).append(text, timestamp or time.time())
+        with self.lock:
+            self.pending += 1
+            pending = self.pending
+        self.syncer.mark_dirty(self, pending >= SYNC_BATCH)
+        return number
+
+    def count(self, buddy_id: str) -> int:
+        conversation = self.conversation(buddy_id, create=False)
+        return conversation.count if conversation is not None else 0
+
+    def base(self, buddy_id: str) -> int:
+        """Number of the oldest retained message."""
+        conversation = self.conversation(buddy_id, create=False)
+        return conversation.base if conversation is not None else 0
+
+    def read(self, buddy_id: str, start: int, count: int) -> list[str]:
+        return [text for _, text in self.read_records(buddy_id, start, count)]
+
+    def read_records(self, buddy_id: str, start: int, count: int) -> list[tuple[float, str]]:
+        conversation = self.conversation(buddy_id, create=False)
+        return conversation.read(start, count) if conversation is not None else []
+
+    def buddy_ids(self) -> list[str]:
+        directory = self.path / 'messages'
+        if not directory.exists():
+            return []
+        return [path.name for path in directory.iterdir() if path.is_dir() and BUDDY_ID.fullmatch(path.name)]
+
+    def add_sync_callback(self, callback):
+        """Adds a function that is called after every sync(), e.g. to flush what refers to the messages."""
+        self.sync_callbacks.append(callback)
+
+    def sync(self):
+        """Makes all stored messages durable."""
+        with self.lock:
+            self.pending = 0
+        for conversation in list(self.conversations.values()):
+            conversation.sync()
+        for callback in list(self.sync_callbacks):
+            callback()
+
+    def compact(self):
+        if not self.max_history:
+            return
+        for conversation in list(self.conversations.values()):
+            conversation.compact(self.max_history)
+
+    def maintain(self):
+        """Called by the syncer in its thread."""
+        self.sync()
+        if time.monotonic() - self.last_compaction > 3600:
+            self.compact()
+            self.last_compaction = time.monotonic()
+
+    def load_buddies(self) -> list[dict] | None:
+        try:
+            with open(self.path / 'buddies.json', 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def save_buddies(self, buddies: list[dict]):
+        write_atomic(self.path / 'buddies.json', json.dumps(buddies, indent=4).encode('utf-8'))
+
+    def close(self):
+        # once removed, the syncer does not touch the store anymore
+        self.syncer.remove(self)
+        for conversation in list(self.conversations.values()):
+            conversation.close()
+
+
+class Syncer(threading.Thread):
+    """Syncs the message stores that have new messages.
+
+    The thread sleeps until a store is marked dirty and then waits out
+    SYNC_INTERVAL, so the appends of that second are synced together. A
+    store with a full batch is synced at once. Nothing wakes the thread
+    while nobody writes.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self, name='onionchat-store-sync', daemon=True)
+        self.stores: set[MessageStore] = set()
+        self.lock = threading.Lock()  # held while a store is synced
+        self.condition = threading.Condition()
+        self.dirty: set[MessageStore] = set()  # stores with unsynced appends
+        self.urgent = False  # a dirty store has a full batch
+        self.start()
+
+    def add(self, store: MessageStore):
+        with self.lock:
+            self.stores.add(store)
+
+    def remove(self, store: MessageStore):
+        with self.lock:
+            self.stores.discard(store)
+
+    def mark_dirty(self, store: MessageStore, urgent: bool = False):
+        """Schedules a sync of the store, right away if urgent."""
+        with self.condition:
+            self.dirty.add(store)
+            self.urgent = self.urgent or urgent
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.dirty:
+                    self.condition.wait()
+                deadline = time.monotonic() + SYNC_INTERVAL
+                while not self.urgent and (remaining := deadline - time.monotonic()) > 0:
+                    self.condition.wait(remaining)
+                dirty, self.dirty = self.dirty, set()
+                self.urgent = False
+            for store in dirty:
+                with self.lock:
+                    if store in self.stores:
+                        store.maintain()
+
+
+global syncer
+syncer: Syncer | None = None
+syncer_lock = threading.Lock()
+
+
+def get_syncer() -> Syncer:
+    """Returns the shared syncer, starting it on first use."""
+    global syncer
+    with syncer_lock:
+        if syncer is None:
+            syncer = Syncer()
+        return syncer
+
+
+def write_atomic(path: pathlib.Path, data: bytes):
+    """Replaces a file so that it contains either the old or the new data after a crash."""
+    temp = path.with_name(path.name + '.tmp')
+    with open(temp, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, path)
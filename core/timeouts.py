@@ -0,0 +1,58 @@
+"""Expiry of idle incoming connections.
+
+Instead of scanning all connections periodically, every connection is put
+into a heap ordered by the time it will become dead (last_active plus the
+timeout). Only the connections at the top of the heap are ever looked at.
+A connection that was active meanwhile is simply pushed again with its new
+deadline, so each connection costs one heap operation per timeout period.
+"""
+import heapq
+import itertools
+import time
+
+
+class IdleReaper:
+    """Keeps track of idle deadlines and expires connections.
+
+    on_expire(conn) is called for every connection that has not been active
+    for `timeout` seconds. Connections which are closed meanwhile
+    (conn.started is False) are silently forgotten. The owner calls
+    expire() at the returned deadline, e.g. with loop.call_later() like
+    core.transport.Listener. Not thread-safe.
+    """
+    def __init__(self, timeout: float, on_expire):
+        self.timeout = timeout
+        self.on_expire = on_expire
+        self.heap = []
+        self.sequence = itertools.count()  # tie breaker, connections are not comparable
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, conn):
+        """Starts watching a connection."""
+        heapq.heappush(self.heap, (conn.last_active + self.timeout, next(self.sequence), conn))
+
+    def expire(self, now: float = None) -> float | None:
+        """Expires all connections that are due.
+
+        :return: The next deadline or None if there is nothing to watch.
+        :rtype: float | None
+        """
+        now = now or time.time()
+        expired = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            _, _, conn = heapq.heappop(heap)
+            if not conn.started:
+                continue
+            deadline = conn.last_active + self.timeout
+            if deadline > now:
+                # active since it was pushed
+                heapq.heappush(heap, (deadline, next(self.sequence), conn))
+            else:
+                expired.append(conn)
+        next_deadline = heap[0][0] if heap else None
+        for conn in expired:
+            self.on_expire(conn)
+        return next_deadline
@@ -0,0 +1,366 @@
+"""Client for the Tor control protocol (control-spec.txt).
+
+The controller connects to the control_port of the active Tor config
+section, authenticates with whatever the Tor client offers (none,
+SAFECOOKIE, COOKIE or the control_password setting) and creates our onion
+service with ADD_ONION. The service lives as long as the control
+connection, so it disappears together with OnionChat.
+
+Tor reports its state as asynchronous events instead of being polled:
+STATUS_CLIENT for the bootstrap progress, CIRC for circuits and HS_DESC
+when the descriptor of our service was uploaded, which is the moment the
+service becomes reachable. Every change is published as
+core.events.TOR_STATUS_CHANGED.
+
+A reader thread receives everything. Replies are handed over to the
+thread waiting in command(), events are dispatched to the handlers in the
+reader thread, so handlers must not call command() themselves.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import pathlib
+import queue
+import re
+import socket
+import threading
+
+import config
+import core.events
+
+SAFECOOKIE_SERVER_KEY = b'Tor safe cookie authentication server-to-controller hash'
+SAFECOOKIE_CLIENT_KEY = b'Tor safe cookie authentication controller-to-server hash'
+# header of hs_ed25519_secret_key in the hidden service directory of torrc
+HS_SECRET_KEY_HEADER = b'== ed25519v1-secret: type0 ==\x00\x00\x00'
+EVENTS = ('STATUS_CLIENT', 'CIRC', 'HS_DESC')
+KEY_VALUE = re.compile(r'(\w+)=("(?:[^"\\]|\\.)*"|\S*)')
+
+
+class ControlError(Exception):
+    """Raised when Tor rejects a command or the control connection fails."""
+
+
+def quote(text: str) -> str:
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def unquote(text: str) -> str:
+    if len(text) >= 2 and text[0] == text[-1] == '"':
+        return re.sub(r'\\(.)', r'\1', text[1:-1])
+    return text
+
+
+def parse_keywords(text: str) -> dict[str, str]:
+    """Parses KEY=value KEY="quoted value" ... as found in replies and events."""
+    return {key: unquote(value) for key, value in KEY_VALUE.findall(text)}
+
+
+def read_hs_secret_key(path: str | pathlib.Path) -> str | None:
+    """Converts the key of a torrc hidden service directory for ADD_ONION.
+
+    :return: The key as ED25519-V3:<base64> or None if there is none.
+    :rtype: str | None
+    """
+    try:
+        data = pathlib.Path(path).read_bytes()
+    except OSError:
+        return None
+    if not data.startswith(HS_SECRET_KEY_HEADER) or len(data) != len(HS_SECRET_KEY_HEADER) + 64:
+        return None
+    return 'ED25519-V3:' + base64.b64encode(data[len(HS_SECRET_KEY_HEADER):]).decode('ascii')
+
+
+class TorController:
+    def __init__(self, address: str, port: int, timeout: float = 10):
+        self.address = address
+        self.port = port
+        self.timeout = timeout
+        self.socket = None
+        self.file = None
+        self.lock = threading.Lock()  # one command at a time
+        self.replies = queue.Queue()
+        self.handlers: dict[str, list] = {}  # event name -> callbacks(keyword line, data lines)
+        self.running = False
+        self.bootstrap_progress = 0
+        self.bootstrapped = threading.Event()
+        self.published: dict[str, threading.Event] = {}  # service id -> set when its descriptor is uploaded
+        self.circuits_built = 0
+
+    def connect(self):
+        """
+        :raises ControlError: If the control port cannot be reached.
+        """
+        try:
+            self.socket = socket.create_connection((self.address, self.port), self.timeout)
+        except OSError as err:
+            raise ControlError(f'cannot connect to control port {self.address}:{self.port}: {err}')
+        self.socket.settimeout(None)
+        self.file = self.socket.makefile('rb')
+        self.running = True
+        threading.Thread(target=self.read_replies, name='onionchat-tor-control', daemon=True).start()
+
+    def close(self):
+        self.running = False
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+        # wake up a command() that waits for a reply
+        self.replies.put(None)
+
+    def read_reply(self) -> list[tuple[str, str, list[str]]] | None:
+        """Reads one reply or event: [(status, text, data lines), ...]."""
+        lines = []
+        while True:
+            line = self.file.readline()
+            if not line:
+                return None
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            status, separator, text = line[:3], line[3:4], line[4:]
+            data = []
+            if separator == '+':
+                while True:
+                    data_line = self.file.readline()
+                    if not data_line:
+                        return None
+                    data_line = data_line.decode('utf-8', 'replace').rstrip('\r\n')
+                    if data_line == '.':
+                        break
+                    data.append(data_line[1:] if data_line.startswith('.') else data_line)
+            lines.append((status, text, data))
+            if separator == ' ':
+                return lines
+
+    def read_replies(self):
+        try:
+            while self.running:
+                reply = self.read_reply()
+                if reply is None:
+                    break
+                if reply[0][0].startswith('6'):
+                    self.on_event(reply)
+                else:
+                    self.replies.put(reply)
+        except OSError:
+            pass
+        if self.running:
+            print('(1) Tor control connection lost')
+            self.running = False
+            self.replies.put(None)
+            core.events.publish(core.events.TOR_STATUS_CHANGED)
+
+    def command(self, line: str) -> list[tuple[str, str, list[str]]]:
+        """Sends a command and returns its reply lines.
+
+        :raises ControlError: If Tor answers with an error or the connection is lost.
+        """
+        with self.lock:
+            if not self.running:
+                raise ControlError('not connected')
+            try:
+                self.socket.sendall(line.encode('utf-8') + b'\r\n')
+            except OSError as err:
+                raise ControlError(f'cannot send to Tor: {err}')
+            try:
+                reply = self.replies.get(timeout=self.timeout)
+            except queue.Empty:
+                # a late reply would be taken for the reply to the next command
+                self.close()
+                raise ControlError(f'no reply from Tor to {line.split()[0]}')
+        if reply is None:
+            raise ControlError('control connection closed')
+        status, text, _ = reply[-1]
+        if not status.startswith('2'):
+            raise ControlError(f'{line.split()[0]} failed: {status} {text}')
+        return reply
+
+    def authenticate(self, password: str = ''):
+        """Authenticates with the best method Tor offers.
+
+        :raises ControlError: If no method works.
+        """
+        methods = set()
+        cookie_file = None
+        for _, text, _ in self.command('PROTOCOLINFO 1'):
+            if text.startswith('AUTH '):
+                keywords = parse_keywords(text)
+                methods = set(keywords.get('METHODS', '').split(','))
+                cookie_file = keywords.get('COOKIEFILE')
+        if 'NULL' in methods:
+            self.command('AUTHENTICATE')
+        elif 'SAFECOOKIE' in methods and cookie_file:
+            cookie = self.read_cookie(cookie_file)
+            client_nonce = os.urandom(32)
+            _, text, _ = self.command(f'AUTHCHALLENGE SAFECOOKIE {client_nonce.hex()}')[0]
+            keywords = parse_keywords(text)
+            server_nonce = bytes.fromhex(keywords.get('SERVERNONCE', ''))
+            message = cookie + client_nonce + server_nonce
+            expected = hmac.new(SAFECOOKIE_SERVER_KEY, message, hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(expected, keywords.get('SERVERHASH', '').lower()):
+                raise ControlError('Tor does not know our cookie, wrong control port?')
+            self.command(f'AUTHENTICATE {hmac.new(SAFECOOKIE_CLIENT_KEY, message, hashlib.sha256).hexdigest()}')
+        elif 'COOKIE' in methods and cookie_file:
+            self.command(f'AUTHENTICATE {self.read_cookie(cookie_file).hex()}')
+        elif 'HASHEDPASSWORD' in methods and password:
+            self.command(f'AUTHENTICATE {quote(password)}')
+        else:
+            raise ControlError(f'no usable authentication method in {sorted(methods)}')
+
+    @staticmethod
+    def read_cookie(path: str) -> bytes:
+        try:
+            return pathlib.Path(path).read_bytes()
+        except OSError as err:
+            raise ControlError(f'cannot read the cookie file: {err}')
+
+    def get_info(self, key: str) -> str:
+        for _, text, data in self.command(f'GETINFO {key}'):
+            if text.startswith(key + '='):
+                return '\n'.join(data) if data else text[len(key) + 1:]
+        raise ControlError(f'no value for {key}')
+
+    def subscribe(self, event: str, callback):
+        """Calls callback(text, data) for every event of that name, in the reader thread."""
+        self.handlers.setdefault(event, []).append(callback)
+
+    def set_events(self, events=EVENTS):
+        self.command('SETEVENTS ' + ' '.join(events))
+        if 'STATUS_CLIENT' in events:
+            # events only tell about changes, ask for the current state once
+            self.on_bootstrap_status(self.get_info('status/bootstrap-phase'))
+
+    def add_onion(self, ports: dict[int, str], key: str = None) -> tuple[str, str | None]:
+        """Creates an onion service that lives as long as this connection.
+
+        :param ports: Virtual port -> target (host:port) of the service.
+        :param key: ED25519-V3:<base64> to keep an address, None for a new one.
+        :return: The service id (the address without .onion) and the new
+            private key (None if key was given).
+        :rtype: tuple[str, str | None]
+        """
+        arguments = [key or 'NEW:ED25519-V3']
+        if key:
+            arguments.append('Flags=DiscardPK')
+        arguments += [f'Port={port},{target}' for port, target in ports.items()]
+        service_id = private_key = None
+        for _, text, _ in self.command('ADD_ONION ' + ' '.join(arguments)):
+            if text.startswith('ServiceID='):
+                service_id = text[len('ServiceID='):]
+            elif text.startswith('PrivateKey='):
+                private_key = text[len('PrivateKey='):]
+        if not service_id:
+            raise ControlError('ADD_ONION returned no ServiceID')
+        self.published.setdefault(service_id, threading.Event())
+        return service_id, private_key
+
+    def del_onion(self, service_id: str):
+        self.command(f'DEL_ONION {service_id}')
+
+    def wait_bootstrapped(self, timeout: float = None) -> bool:
+        return self.bootstrapped.wait(timeout)
+
+    def wait_published(self, service_id: str, timeout: float = None) -> bool:
+        """Waits until the descriptor of the service was uploaded to a directory."""
+        return self.published.setdefault(service_id, threading.Event()).wait(timeout)
+
+    def on_event(self, reply):
+        _, text, data = reply[0]
+        name, _, text = text.partition(' ')
+        if name == 'STATUS_CLIENT':
+            self.on_bootstrap_status(text)
+        elif name == 'CIRC':
+            if text.split()[1:2] == ['BUILT']:
+                self.circuits_built += 1
+        elif name == 'HS_DESC':
+            words = text.split()
+            if words[:1] == ['UPLOADED'] and len(words) > 1 and words[1] in self.published:
+                if not self.published[words[1]].is_set():
+                    print(f'(1) onion service {words[1]} is reachable')
+                    self.published[words[1]].set()
+                    core.events.publish(core.events.TOR_STATUS_CHANGED)
+        for callback in self.handlers.get(name, ()):
+            callback(text, data)
+
+    def on_bootstrap_status(self, text: str):
+        if 'BOOTSTRAP' not in text.split():
+            return
+        try:
+            progress = int(parse_keywords(text).get('PROGRESS', 0))
+        except ValueError:
+            return
+        if progress != self.bootstrap_progress:
+            self.bootstrap_progress = progress
+            if progress >= 100:
+                print('(1) Tor is bootstrapped')
+                self.bootstrapped.set()
+            core.events.publish(core.events.TOR_STATUS_CHANGED)
+
+
+def load_onion_key(tor_dir: str | pathlib.Path) -> str | None:
+    """Returns the key of our onion service.
+
+    A key created by ADD_ONION is kept in onion_service_key. The first time
+    the key of the hidden service directory of torrc is taken over, so the
+    address stays the same.
+    """
+    tor_dir = pathlib.Path(tor_dir)
+    try:
+        return (tor_dir / 'onion_service_key').read_text().strip() or None
+    except OSError:
+        return read_hs_secret_key(tor_dir / 'hidden_service' / 'hs_ed25519_secret_key')
+
+
+def save_onion_key(tor_dir: str | pathlib.Path, key: str):
+    path = pathlib.Path(tor_dir, 'onion_service_key')
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+        file.write(key)
+
+
+def connect_controller(tor_section: str) -> TorController:
+    """Connects and authenticates to the Tor of a config section and subscribes to the events.
+
+    :raises ControlError: If Tor cannot be controlled.
+    """
+    settings = config.ini[tor_section]
+    controller = TorController(settings['address'], settings['control_port'])
+    controller.connect()
+    try:
+        controller.authenticate(settings.get('control_password', ''))
+        controller.set_events()
+    except ControlError:
+        controller.close()
+        raise
+    return controller
+
+
+def start_onion_service(tor_section: str, tor_dir: str | pathlib.Path) -> tuple[TorController, str]:
+    """Connects to Tor, creates our onion service and subscribes to the events.
+
+    :return: The controller (keep it open, the service lives as long as
+        the connection) and the onion address without .onion.
+    :rtype: tuple[TorController, str]
+    :raises ControlError: If Tor cannot be controlled.
+    """
+    controller = connect_controller(tor_section)
+    try:
+        key = load_onion_key(tor_dir)
+        client = config.ini['client']
+        target = f'{client["listen_interface"]}:{client["listen_port"]}'
+        try:
+            service_id, new_key = controller.add_onion({config.ONIONCHAT_PORT: target}, key)
+        except ControlError as err:
+            # torrc still has the HiddenServiceDir the key was taken from
+            hostname = pathlib.Path(tor_dir, 'hidden_service', 'hostname')
+            if 'collision' not in str(err).lower() or not hostname.exists():
+                raise
+            service_id, new_key = hostname.read_text().strip().removesuffix('.onion'), None
+            controller.published.setdefault(service_id, threading.Event())
+        if new_key:
+            save_onion_key(tor_dir, new_key)
+    except ControlError:
+        controller.close()
+        raise
+    return controller, service_id
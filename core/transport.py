@@ -0,0 +1,522 @@
+"""Asyncio transport layer.
+
+Listener, InConnection and OutConnection of all identities. Instead of
+one receiver thread per connection (and a sender thread for every
+outgoing one, as core.network had before) all connections are served by
+a single asyncio event loop running in one background thread. The
+connection objects call the buddy list callbacks (onConnected,
+onAuthenticated, onErrorIn, onErrorOut), protocol messages do not care
+which connection delivered them.
+"""
+import asyncio
+import threading
+import time
+import sys
+import struct
+
+import config
+import core.events
+import core.framing
+import core.metrics
+import core.protocol
+import core.ratelimit
+import core.scheduler
+import core.timeouts
+
+
+SOCKS4_CONNECT = 1
+SOCKS4_GRANTED = 0x5a
+READ_SIZE = 4096
+SEND_BATCH_SIZE = 65536
+
+
+class EventLoop(threading.Thread):
+    """A single asyncio event loop running in its own thread.
+
+    Everything in this module is scheduled on this loop. Methods that are
+    documented as thread-safe may be called from any thread (e.g. the GUI).
+    """
+    def __init__(self):
+        threading.Thread.__init__(self, name='onionchat-event-loop', daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.start()
+        self.ready.wait()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self.ready.set)
+        self.loop.run_forever()
+
+    def in_loop(self) -> bool:
+        """Checks whether we are currently running inside the event loop thread.
+
+        :return: Whether the caller runs in the event loop thread.
+        :rtype: bool
+        """
+        return threading.get_ident() == self.ident
+
+    def call(self, callback, *args):
+        """Schedules a callback in the event loop (thread-safe)."""
+        if self.in_loop():
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def submit(self, coroutine):
+        """Schedules a coroutine in the event loop (thread-safe).
+
+        :return: Future that can be waited for from the calling thread.
+        :rtype: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+global event_loop
+event_loop: EventLoop | None = None
+
+
+def get_event_loop() -> EventLoop:
+    """Returns the shared event loop, starting it on first use.
+
+    :return: The event loop all async connections are running on.
+    :rtype: EventLoop
+    """
+    global event_loop
+    if event_loop is None:
+        event_loop = EventLoop()
+    return event_loop
+
+
+class Connection:
+    """Common part of async incoming and outgoing connections."""
+    is_incoming = False
+
+    def __init__(self, buddy_list, loop: EventLoop):
+        self.bl = buddy_list
+        self.loop = loop
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.send_task = None
+        self.started = False
+        self.closed = False  # queued lines are kept until the connection is closed
+        # an incoming connection is a stranger until authenticate()
+        self.limiter = core.ratelimit.TrafficLimiter(not self.is_incoming)
+        self.lines = core.scheduler.LineScheduler()
+        self.send_event = asyncio.Event()
+        self.binary = False  # binary frames instead of lines, see switch_to_binary()
+        self.compressor = None  # core.compression.Compressor if the peer can decompress
+        direction = 'in' if self.is_incoming else 'out'
+        self.bytes_received = core.metrics.bytes_received.labels(direction)
+        self.bytes_sent = core.metrics.bytes_sent.labels(direction)
+        self.is_open = core.metrics.connections_open.labels(direction)
+        self.counted_open = False
+
+    def count_open(self):
+        self.counted_open = True
+        self.is_open.inc()
+        core.metrics.connections.labels('in' if self.is_incoming else 'out').inc()
+
+    def count_closed(self):
+        if self.counted_open:
+            self.counted_open = False
+            self.is_open.dec()
+
+    def send(self, text, stream=None):
+        """Queues text for sending (thread-safe).
+
+        Lines of a stream (file data) are sent after all other lines. Lines
+        queued before an outgoing connection is established are sent once
+        it is, they are only dropped when the connection closes.
+        """
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        self.loop.call(self._write, text, stream)
+
+    def _write(self, data: bytes, stream=None):
+        if self.closed:
+            return
+        if self.binary:
+            data = core.protocol.line_to_frame(data)
+        self.lines.add(data, stream)
+        self.send_event.set()
+
+    def send_msg(self, message):
+        """Queues a message (thread-safe), it is encoded in the loop thread."""
+        self.loop.call(self._write_msg, message)
+
+    def _write_msg(self, message):
+        if self.closed:
+            return
+        if self.compressor is not None:
+            data = self.compressor.encode(message)
+        else:
+            data = message.encode(self.binary)
+        self.lines.add(data, message.stream)
+        self.send_event.set()
+
+    def switch_to_binary(self, compressor=None):
+        """Sends binary frames from now on, compressed by compressor if given (thread-safe).
+
+        Lines that are still queued are converted and the switch line goes
+        out before all of them, so the peer sees the switch exactly where
+        the format changes.
+        """
+        self.loop.call(self._switch_to_binary, compressor)
+
+    def _switch_to_binary(self, compressor=None):
+        if self.binary or self.closed:
+            return
+        self.binary = True
+        self.compressor = compressor
+        self.lines.convert(core.protocol.line_to_frame)
+        self.lines.push_front(core.framing.SWITCH_LINE + b'\n')
+        self.send_event.set()
+
+    def discard(self, stream):
+        """Drops the queued lines of a stream (thread-safe)."""
+        self.loop.call(self._discard, stream)
+
+    def _discard(self, stream):
+        if self.compressor is not None:
+            self.compressor.forget(stream)
+        for wake in self.lines.discard(stream):
+            wake()
+
+    def wake(self):
+        # called by the upload limiter, maybe from another thread
+        self.loop.call(self.send_event.set)
+
+    def start_sending(self):
+        self.send_task = self.loop.loop.create_task(self.send_lines())
+
+    async def send_lines(self):
+        """Writes the scheduled lines.
+
+        drain() waits while the transport buffer is full, so file data
+        does not pile up in front of chat lines queued later.
+        """
+        try:
+            while True:
+                queued = len(self.lines)
+                batch, delay, wakers = self.lines.take(SEND_BATCH_SIZE, self.wake)
+                for wake in wakers:
+                    wake()
+                if batch is not None:
+                    core.metrics.send_queue_lines.observe(queued)
+                    self.bytes_sent.inc(len(batch))
+                    self.writer.write(batch)
+                    await self.writer.drain()
+                    continue
+                self.send_event.clear()
+                if delay is None:
+                    await self.send_event.wait()
+                else:
+                    try:
+                        await asyncio.wait_for(self.send_event.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+        except (ConnectionError, OSError, asyncio.CancelledError):
+            return
+
+    async def receive(self):
+        decoder = core.framing.WireDecoder()
+        limiter = self.limiter
+        try:
+            while self.started:
+                recv = await self.reader.read(READ_SIZE)
+                if not recv:
+                    break
+                self.bytes_received.inc(len(recv))
+                self.last_active = time.time()
+                delay = limiter.delay_for(len(recv))
+                if delay:
+                    # stop reading, TCP flow control will slow down the peer
+                    await asyncio.sleep(delay)
+                for line in decoder.feed(recv):
+                    if not self.started:
+                        break
+                    delay = limiter.delay_for_line()
+                    if delay:
+                        # too many lines: nothing is read meanwhile, TCP flow control slows down the peer
+                        await asyncio.sleep(delay)
+                        if not self.started:
+                            break
+                    self.on_line(line)
+        except ValueError as err:
+            # a line or frame too long, or a damaged compressed frame
+            core.metrics.protocol_errors.labels('framing').inc()
+            print(f'(2) closing connection: {err}')
+        except (ConnectionError, OSError):
+            pass
+        except asyncio.CancelledError:
+            return
+        if self.started:
+            self.on_receiver_error()
+
+    def on_line(self, line):
+        """Handles a received line or binary frame."""
+        try:
+            # on outgoing connections we do not allow any
+            # incoming messages other than file*
+            # this prevents an attacker from messaging
+            # or sending commands before the handshake is
+            # completed or pong on the wrong connection
+            if self.is_incoming or core.protocol.command_of(line)[:4] == b'file':
+                core.protocol.handle_item(self.bl, self, line)
+            else:
+                # this is an outgoing connection. Incoming protocol messages are ignored
+                print(f"Received unexpected '{line}' "
+                      f"on outgoing connection to {self.buddy.address}")
+        except Exception as err:
+            # a broken message must not close the connection, but it must not go unnoticed
+            print(f'(2) could not handle {core.protocol.command_of(line)!r}: {err!r}')
+
+    def on_receiver_error(self):
+        pass
+
+    def close_transport(self):
+        self.started = False
+        self.closed = True
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except:
+                print(f'(3) transport.close() {sys.exc_info()[1]}')
+        if self.task is not None and self.task is not asyncio.current_task(self.loop.loop):
+            self.task.cancel()
+        if self.send_task is not None:
+            self.send_task.cancel()
+        for wake in self.lines.clear():
+            wake()
+
+
+class InConnection(Connection):
+    is_incoming = True
+
+    def __init__(self, reader, writer, buddy_list, listener, loop: EventLoop):
+        Connection.__init__(self, buddy_list, loop)
+        self.buddy = None
+        self.listener = listener
+        self.reader = reader
+        self.writer = writer
+        self.last_ping_address = ''  # used to detect mass pings with fake addresses
+        self.last_ping_cookie = ''  # used to detect pings with fake cookies
+        self.last_active = time.time()
+        self.started = True
+        self.count_open()
+        self.task = loop.loop.create_task(self.receive())
+        self.start_sending()
+
+    def authenticate(self, buddy):
+        """Assigns the buddy who completed the handshake (in the loop thread)."""
+        if self.buddy is None and self.started:
+            self.listener.unauthenticated -= 1
+        self.buddy = buddy
+        buddy.conn_in = self
+        self.limiter.authenticate()
+        self.bl.onAuthenticated(self)
+
+    def on_receiver_error(self):
+        if self.buddy:
+            addr = self.buddy.address
+        else:
+            addr = self.last_ping_address + ' (unverified)'
+        print(f'(2) in-connection receive error: {addr}')
+        self.bl.onErrorIn(self)
+        self.close()
+
+    def close(self):
+        """Closes the connection (thread-safe)."""
+        self.loop.call(self._close)
+
+    def _close(self):
+        if not self.started and self.writer is None:
+            return
+        print(f'(2) in-connection closing {self.last_ping_address}')
+        if self.buddy is None and self.started:
+            self.listener.unauthenticated -= 1
+        self.count_closed()
+        self.close_transport()
+        self.writer = None
+        self.listener.conns.discard(self)
+        if self.buddy:
+            self.buddy.conn_in = None
+        core.events.publish(core.events.CONNECTIONS_CHANGED)
+
+
+class OutConnection(Connection):
+    def __init__(self, address, buddy_list, buddy, loop: EventLoop = None, manager=None):
+        Connection.__init__(self, buddy_list, loop or get_event_loop())
+        self.buddy = buddy
+        self.address = address
+        self.manager = manager  # core.connections.ConnectionManager that reconnects us
+        self.pong_sent = False
+        self.last_active = time.time()
+        self.loop.submit(self.run())
+
+    async def run(self):
+        self.started = True
+        self.task = asyncio.current_task()
+        try:
+            print(f"(2) trying to connect '{self.address}'")
+            start = time.perf_counter()
+            self.reader, self.writer = await socks4a_connect(config.ini['tor']['address'],
+                                                             config.ini['tor']['socks_port'],
+                                                             str(self.address), config.ONIONCHAT_PORT)
+            core.metrics.connect_seconds.observe(time.perf_counter() - start)
+            print(f'(2) connected to {self.address}')
+        except asyncio.CancelledError:
+            return
+        except:
+            print(f'(2) out-connection to {self.address} failed: {sys.exc_info()[1]}')
+            self.bl.onErrorOut(self)
+            self._close()
+            return
+        self.count_open()
+        self.start_sending()
+        if self.manager is not None:
+            self.manager.connected(self)
+        self.bl.onConnected(self)
+        core.events.publish(core.events.CONNECTIONS_CHANGED)
+        # this receive loop will only accept file* messages
+        await self.receive()
+
+    def on_receiver_error(self):
+        print('(2) out-connection receiver error')
+        self.bl.onErrorOut(self)
+        self.close()
+
+    def close(self):
+        """Closes the connection (thread-safe)."""
+        self.loop.call(self._close)
+
+    def _close(self):
+        self.count_closed()
+        self.close_transport()
+        self.writer = None
+        if self.manager is not None:
+            self.manager.closed(self)
+        if self.buddy and self.buddy.conn_out is self:
+            self.buddy.conn_out = None
+            print(f'(2) out-connection closed ({self.buddy.address})')
+        else:
+            print(f'(2) out connection without buddy closed')  # happens after remove_buddy()
+        core.events.publish(core.events.CONNECTIONS_CHANGED)
+
+
+class Listener:
+    """Accepts incoming connections on the shared event loop.
+
+    Creating it waits until the server listens, so not in the event loop
+    thread (it would wait for itself).
+
+    :raises RuntimeError: When created in the event loop thread.
+    """
+    def __init__(self, buddy_list, socket=None, loop: EventLoop = None):
+        self.buddy_list = buddy_list
+        self.conns = set()
+        self.unauthenticated = 0  # conns without a buddy, kept up to date by them
+        self.socket = socket
+        self.server = None
+        self.timer = None
+        self.reaper = core.timeouts.IdleReaper(config.DEAD_CONNECTION_TIMEOUT, self.on_idle)
+        self.loop = loop or get_event_loop()
+        if self.loop.in_loop():
+            raise RuntimeError('a Listener cannot be created in the event loop thread')
+        self.running = True
+        self.loop.submit(self.run()).result()
+
+    async def run(self):
+        if not self.socket:
+            interface = config.ini['client']['listen_interface']
+            port = config.ini['client']['listen_port']
+            self.server = await asyncio.start_server(self.on_accept, interface, port, reuse_address=True,
+                                                     backlog=config.ini['client']['listen_backlog'])
+        else:
+            self.server = await asyncio.start_server(self.on_accept, sock=self.socket,
+                                                     backlog=config.ini['client']['listen_backlog'])
+
+    def on_accept(self, reader, writer):
+        if not core.ratelimit.may_accept(self.unauthenticated):
+            print('(2) too many unauthenticated incoming connections, rejecting')
+            writer.close()
+            return
+        self.unauthenticated += 1
+        conn = InConnection(reader, writer, self.buddy_list, self, self.loop)
+        self.conns.add(conn)
+        self.reaper.add(conn)
+        if self.timer is None:
+            self.start_timer()
+        print('(2) new incoming connection')
+        print(f'(2) have now {len(self.conns)} incoming connections')
+        core.events.publish(core.events.CONNECTIONS_CHANGED)
+
+    def close(self):
+        self.running = False
+        self.loop.call(self._close)
+
+    def _close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        try:
+            print(f'(2) closing listening socket {config.ini["client"]["listen_interface"]}'
+                  f':{config.ini["client"]["listen_port"]}.')
+            self.server.close()
+            print('(2) success')
+        except:
+            print('(2) closing socket failed, traceback follows:')
+
+    def start_timer(self, deadline: float = None):
+        """Schedules the reaper for the next idle deadline.
+
+        All connections share one timeout, so a new connection never has
+        an earlier deadline than the ones already scheduled.
+        """
+        if deadline is None:
+            deadline = time.time() + config.DEAD_CONNECTION_TIMEOUT
+        self.timer = self.loop.loop.call_later(max(0, deadline - time.time()), self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        next_deadline = self.reaper.expire()
+        if self.running and next_deadline is not None:
+            self.start_timer(next_deadline)
+
+    def on_idle(self, conn):
+        """Called by the reaper for a connection that was not active for DEAD_CONNECTION_TIMEOUT."""
+        if conn.buddy:
+            print(f'(2) conn_in timeout: disconnecting {conn.buddy.address}')
+            conn.buddy.disconnect()
+        else:
+            print(f'(2) closing unused in-connection from {conn.last_ping_address}')
+            conn.close()
+        self.conns.discard(conn)
+        print(f'(2) have now {len(self.conns)} incoming connections')
+        core.events.publish(core.events.CONNECTIONS_CHANGED)
+
+
+async def socks4a_connect(proxy_address, proxy_port, hostname, port):
+    """Opens a connection to hostname:port through a SOCKS4a proxy (Tor).
+
+    :return: Stream reader and writer of the established connection.
+    :rtype: tuple[asyncio.StreamReader, asyncio.StreamWriter]
+    """
+    reader, writer = await asyncio.open_connection(proxy_address, proxy_port)
+    try:
+        # SOCKS4a: an invalid ip 0.0.0.x tells the proxy to resolve the hostname itself
+        request = struct.pack('>BBH', 4, SOCKS4_CONNECT, port) + b'\x00\x00\x00\x01' + b'\x00' \
+            + hostname.encode('ascii') + b'\x00'
+        writer.write(request)
+        reply = await reader.readexactly(8)
+        if reply[1] != SOCKS4_GRANTED:
+            raise ConnectionError(f'SOCKS request rejected (code {reply[1]:#x})')
+    except:
+        writer.close()
+        raise
+    return reader, writer
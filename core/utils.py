@@ -5,11 +5,21 @@ import hashlib
 import binascii
 import shutil
 import ctypes
+import threading
+from collections import OrderedDict
+from collections.abc import Iterable
 
 from config import *
 
 
 global cached_data_dir
+cached_data_dir: str | None = None
+
+ONION_CHECKSUM_PREFIX = b'.onion checksum'
+
+# LRU of addresses that passed is_valid_address(), values are unused
+valid_address_cache: OrderedDict[str, None] = OrderedDict()
+valid_address_cache_lock = threading.Lock()
 
 
 def get_relative_path(path: str | pathlib.Path) -> str:
@@ -63,49 +73,101 @@ def terminate_process(pid: int) -> bool:
         return False
 
 
-def is_valid_address(v3_address) -> bool:
-    """
-    Checks if a received address is a correct v3 onion address.
-
-    V3 Onion address consists of 56 base32 chars, e.g.
-    pzhdfe7jraknpj2qgu5cz2u3i4deuyfwmonvzu5i3nyw4t4bmg7o5pad
-    We measure address length, try to decode it, check onion version
-    in address, calculate checksum and compare it with the one
-    that is in the address.
-    See Tor rend-spec-v3.txt for details of implementation.
+def check_address(v3_address: str) -> bool:
+    """Checks a v3 onion address without using the cache.
 
     :return: Whether onion v3 address is correct
     :rtype: bool
     """
     if not len(v3_address) == 56:
-        print(f'Incorrect address length: {v3_address}')
         return False
 
     try:
         # onion_address = base32(PUBKEY | CHECKSUM | VERSION) + ".onion"
-        address_decoded = b32decode(v3_address)
-    except binascii.Error:
+        address_decoded = b32decode(v3_address, casefold=True)
+    except (binascii.Error, ValueError):
         # Incorrect padding or chars that are not from b32 alphabet
-        print(f'Could not decode onion address: {v3_address}')
         return False
 
     version = address_decoded[-1]
     # If not a V3 onion
     if not version == 3:
-        print(f'Incorrect onion version number in address: {v3_address}')
         return False
 
     pubkey = address_decoded[:-3]  # Truncate two checksum bytes and one version byte
     # Specs don't specify hash function (it's sha3-256)
     # CHECKSUM = sha3_256(".onion checksum" | PUBKEY | VERSION)[:2]
-    checksum_bytes = '.onion checksum'.encode('utf-8') + pubkey + version.to_bytes(1, byteorder='little')
-    checksum = hashlib.sha3_256(checksum_bytes).digest()[:2]
-    if not checksum == address_decoded[-3:-1]:
-        print(f'Incorrect onion checksum in address: {v3_address}')
+    checksum = hashlib.sha3_256(ONION_CHECKSUM_PREFIX + pubkey + b'\x03').digest()[:2]
+    return checksum == address_decoded[-3:-1]
+
+
+def is_valid_address(v3_address) -> bool:
+    """
+    Checks if a received address is a correct v3 onion address.
+
+    V3 Onion address consists of 56 base32 chars, e.g.
+    pzhdfe7jraknpj2qgu5cz2u3i4deuyfwmonvzu5i3nyw4t4bmg7o5pad
+    We measure address length, try to decode it, check onion version
+    in address, calculate checksum and compare it with the one
+    that is in the address.
+    See Tor rend-spec-v3.txt for details of implementation.
+
+    Valid addresses are remembered in a bounded LRU cache, so checking
+    a known buddy again costs one dict lookup. Invalid addresses are not
+    cached: a flood of fake addresses must not evict the real ones.
+    Nothing is printed, this is called for every incoming ping.
+
+    :return: Whether onion v3 address is correct
+    :rtype: bool
+    """
+    with valid_address_cache_lock:
+        if v3_address in valid_address_cache:
+            valid_address_cache.move_to_end(v3_address)
+            return True
+
+    if not check_address(v3_address):
         return False
+
+    with valid_address_cache_lock:
+        valid_address_cache[v3_address] = None
+        if len(valid_address_cache) > VALID_ADDRESS_CACHE_SIZE:
+            valid_address_cache.popitem(last=False)
     return True
 
 
+def validate_addresses(addresses: Iterable[str]) -> dict[str, bool]:
+    """Checks many addresses at once, e.g. when importing a contact list.
+
+    Like is_valid_address(), but the cache is looked up for the whole list
+    under one lock and the new valid addresses are added under another,
+    the checksums are computed without holding it.
+
+    :param: Addresses to check, duplicates are checked only once.
+    :type: Iterable[str]
+    :return: Mapping of every given address to whether it is valid.
+    :rtype: dict[str, bool]
+    """
+    result = dict.fromkeys(addresses, False)
+    unknown = []
+    with valid_address_cache_lock:
+        for address in result:
+            if address in valid_address_cache:
+                valid_address_cache.move_to_end(address)
+                result[address] = True
+            else:
+                unknown.append(address)
+
+    valid = [address for address in unknown if check_address(address)]
+    if valid:
+        with valid_address_cache_lock:
+            for address in valid:
+                result[address] = True
+                valid_address_cache[address] = None
+            while len(valid_address_cache) > VALID_ADDRESS_CACHE_SIZE:
+                valid_address_cache.popitem(last=False)
+    return result
+
+
 def get_data_dir():
     global cached_data_dir
 
@@ -143,8 +205,9 @@ def get_data_dir():
         tor_exe = 'tor.sh'
     if not os.path.exists(data_dir_tor):
         os.mkdir(data_dir_tor)
-        shutil.copy(os.path.join('Tor', tor_exe), data_dir_tor)
-        shutil.copy(os.path.join('Tor', 'torrc.txt'), data_dir_tor)
+        if os.path.exists(os.path.join('Tor', tor_exe)):
+            shutil.copy(os.path.join('Tor', tor_exe), data_dir_tor)
+            shutil.copy(os.path.join('Tor', 'torrc.txt'), data_dir_tor)
 
     # fix permissions
     for filename in os.listdir(data_dir):
@@ -153,8 +216,9 @@ def get_data_dir():
             os.chmod(os.path.join(data_dir, filename), 0o600)
     os.chmod(data_dir, 0o700)
     os.chmod(data_dir_tor, 0o700)
-    os.chmod(os.path.join(data_dir_tor, tor_exe), 0o700)
-    os.chmod(os.path.join(data_dir_tor, 'torrc.txt'), 0o600)
+    if os.path.exists(os.path.join(data_dir_tor, tor_exe)):
+        os.chmod(os.path.join(data_dir_tor, tor_exe), 0o700)
+        os.chmod(os.path.join(data_dir_tor, 'torrc.txt'), 0o600)
 
     cached_data_dir = data_dir
     return data_dir
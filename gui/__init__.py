@@ -1,3 +1,4 @@
+import gui.events
 import gui.menu
 import gui.settings
 import gui.window
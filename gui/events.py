@@ -0,0 +1,68 @@
+"""Delivers core.events to the GUI thread.
+
+Core events may be published from any thread (receiver threads, the event
+loop). EventBridge re-emits them as Qt signals in the GUI thread and merges
+bursts of events into one signal per frame, so e.g. a hundred buddies
+coming online at once cause a single repaint. Nothing runs while nothing
+changes: there is no polling timer.
+"""
+from functools import partial
+from PyQt5.QtCore import QObject, QTimer, Qt, pyqtSignal
+
+import config
+import core.events
+
+
+class EventBridge(QObject):
+    # emitted from any thread, delivered queued to the GUI thread
+    posted = pyqtSignal(str, tuple)
+
+    contacts_changed = pyqtSignal()
+    messages_changed = pyqtSignal(set)  # buddy ids
+    connections_changed = pyqtSignal()
+    transfers_changed = pyqtSignal(set)  # transfer ids
+
+    def __init__(self):
+        super().__init__()
+        self.pending: dict[str, set] = {}
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(config.Gui.event_coalesce_ms)
+        self.timer.timeout.connect(self.flush)
+        self.posted.connect(self.on_posted, Qt.QueuedConnection)
+
+        for event in (core.events.CONTACTS_CHANGED, core.events.MESSAGES_CHANGED,
+                      core.events.CONNECTIONS_CHANGED, core.events.TRANSFERS_CHANGED):
+            core.events.subscribe(event, partial(self.post, event))
+
+    def post(self, event: str, *args):
+        """Called by core.events in the publishing thread."""
+        self.posted.emit(event, args)
+
+    def on_posted(self, event: str, args: tuple):
+        self.pending.setdefault(event, set()).update(args)
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        if core.events.CONTACTS_CHANGED in pending:
+            self.contacts_changed.emit()
+        if core.events.MESSAGES_CHANGED in pending:
+            self.messages_changed.emit(pending[core.events.MESSAGES_CHANGED])
+        if core.events.CONNECTIONS_CHANGED in pending:
+            self.connections_changed.emit()
+        if core.events.TRANSFERS_CHANGED in pending:
+            self.transfers_changed.emit(pending[core.events.TRANSFERS_CHANGED])
+
+
+global bridge
+bridge: EventBridge | None = None
+
+
+def get_bridge() -> EventBridge:
+    """Returns the bridge, it must be created after the QApplication."""
+    global bridge
+    if bridge is None:
+        bridge = EventBridge()
+    return bridge
@@ -1,4 +1,4 @@
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QSize
 from PyQt5.QtWidgets import QDialog, QLabel, QToolBar, QStatusBar, QAction, QMenuBar, QMenu, QVBoxLayout
 from PyQt5.QtGui import QIcon, QFont
 
@@ -15,7 +15,7 @@ class AboutDialog(QDialog):
                             Qt.WindowTitleHint)
         self.setWindowTitle('About')
         self.setWindowIcon(QIcon(config.Gui.ICON_ABOUT))
-        self.setFixedSize(Gui.about_dialog_size)
+        self.setFixedSize(QSize(*Gui.about_dialog_size))
 
         self.layout = QVBoxLayout()
 
@@ -1,5 +1,5 @@
 from functools import partial
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QSize
 from PyQt5.QtWidgets import QDialog, QTabWidget, QVBoxLayout, QHBoxLayout,  QFormLayout, QLabel, QLineEdit, \
     QPushButton, QFileDialog, QComboBox, QCheckBox, QGroupBox, QTabBar
 from PyQt5.QtGui import QIcon, QMouseEvent
@@ -137,7 +137,7 @@ class SettingsDialog(QDialog):
         self.setWindowFlags(Qt.WindowType.Window |
                             Qt.WindowType.WindowCloseButtonHint |
                             Qt.WindowType.WindowTitleHint)
-        self.setFixedSize(config.Gui.settings_dialog_size)
+        self.setFixedSize(QSize(*config.Gui.settings_dialog_size))
         self.setWindowTitle('Settings')
         self.setWindowIcon(QIcon(config.Gui.ICON_SETTINGS))
         self.layout = QVBoxLayout()
@@ -1,22 +1,26 @@
 import os.path
-from PyQt5.QtCore import Qt, QEvent, QPoint, QTimer
+from PyQt5.QtCore import Qt, QPoint, QSize, QTimer, pyqtSignal, QModelIndex, QAbstractListModel
 from PyQt5.QtWidgets import QMainWindow, QWidget, QGridLayout, QLabel, QHBoxLayout, QRadioButton, \
-    QButtonGroup, QVBoxLayout, QComboBox, QFrame, QMenu, QAction
-from PyQt5.QtGui import QIcon, QPixmap, QBrush, QPalette, QEnterEvent, QMouseEvent
+    QButtonGroup, QVBoxLayout, QComboBox, QFrame, QMenu, QAction, QListView, QAbstractItemView, \
+    QStyledItemDelegate, QStyleOptionViewItem, QStyle, QLineEdit
+from PyQt5.QtGui import QIcon, QPixmap, QBrush, QPalette, QMouseEvent, QPainter, QColor
 
 import config
 import core.contacts
+import core.filetransfer
+import core.profiling
 import gui
 
 
-global ignore_mouse_press_events, show_status, chat_list_changed
+global ignore_mouse_press_events, show_status
 ignore_mouse_press_events: bool = False
 show_group: int = 0  # Defaults to Everyone
 show_status = config.STATUS_ALL
-chat_list_changed: bool = True
 
 
 class StatusSelectWidget(QWidget):
+    changed = pyqtSignal()
+
     def __init__(self):
         super().__init__()
         self.layout = QHBoxLayout()
@@ -37,8 +41,7 @@ class StatusSelectWidget(QWidget):
 
     def button_toggled(self, button: QRadioButton, checked: bool):
         if checked:
-            global show_status, chat_list_changed
-            chat_list_changed = True
+            global show_status
             match button:
                 case self.status_all:
                     show_status = config.STATUS_ALL
@@ -46,9 +49,12 @@ class StatusSelectWidget(QWidget):
                     show_status = config.STATUS_ONLINE
                 case self.status_offline:
                     show_status = config.STATUS_OFFLINE
+            self.changed.emit()
 
 
 class GroupSelectWidget(QWidget):
+    changed = pyqtSignal()
+
     def __init__(self):
         super().__init__()
         self.layout = QGridLayout()
@@ -65,59 +71,123 @@ class GroupSelectWidget(QWidget):
 
         self.setLayout(self.layout)
 
-    @staticmethod
-    def index_changed(index: int):
-        global chat_list_changed, show_group
-        chat_list_changed = True
+    def index_changed(self, index: int):
+        global show_group
         show_group = index
+        self.changed.emit()
+
 
+class ChatListModel(QAbstractListModel):
+    """The buddies shown in the chat list.
 
-class ChatListItem(QFrame):
-    def __init__(self, item):
+    The model only holds a reference to the list returned by
+    core.contacts.get_buddies(), rows are painted by ChatListDelegate.
+    """
+    BuddyRole = Qt.UserRole + 1
+
+    def __init__(self):
         super().__init__()
-        self.item = item
-        self.id = item['id']
-        self.position = item['position']
-        self.layout = QHBoxLayout()
-        self.layout.setContentsMargins(6, 6, 6, 6)
-        self.setCursor(Qt.PointingHandCursor)
-
-        icon = QLabel('')
-        icon.setPixmap(item['icon'])
-        self.layout.addWidget(icon)
-        name = QLabel(item['name'])
-        self.layout.addWidget(name)
-        message = QLabel(item['message'])
-        self.layout.addWidget(message)
-        self.setLayout(self.layout)
+        self.buddies = []
 
-        self.enterEvent = self.mouse_enter
-        self.leaveEvent = self.mouse_leave
-        self.mousePressEvent = self.mouse_pressed
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(self.buddies)
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        buddy = self.buddies[index.row()]
+        match role:
+            case Qt.DisplayRole:
+                return buddy['name']
+            case Qt.ToolTipRole:
+                return buddy['message']
+            case Qt.DecorationRole:
+                return core.contacts.get_icon(buddy['icon'])
+            case self.BuddyRole:
+                return buddy
+        return None
+
+    def set_buddies(self, buddies: list):
+        self.beginResetModel()
+        self.buddies = buddies
+        self.endResetModel()
+
+
+class ChatListDelegate(QStyledItemDelegate):
+    """Paints one row of the chat list: icon, name and message."""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.icon_size = QSize(*config.Gui.chat_list_icon_size)
+        self.row_height = self.icon_size.height() + 2 * config.Gui.chat_list_row_margin
+        self.hover_color = QColor(255, 255, 255, 102)
+        # icon file name -> pixmap scaled to icon_size
+        self.icons: dict[str, QPixmap] = {}
+
+    def get_icon(self, filename: str) -> QPixmap:
+        try:
+            return self.icons[filename]
+        except KeyError:
+            icon = core.contacts.get_icon(filename).scaled(self.icon_size, Qt.KeepAspectRatio,
+                                                            Qt.SmoothTransformation)
+            self.icons[filename] = icon
+            return icon
+
+    def paint(self, painter: QPainter, option: QStyleOptionViewItem, index: QModelIndex):
+        buddy = index.data(ChatListModel.BuddyRole)
+        margin = config.Gui.chat_list_row_margin
+        rect = option.rect.adjusted(margin, margin, -margin, -margin)
+        painter.save()
+        if option.state & QStyle.State_MouseOver:
+            painter.fillRect(option.rect, self.hover_color)
+
+        icon = self.get_icon(buddy['icon'])
+        painter.drawPixmap(rect.left(), rect.top() + (rect.height() - icon.height()) // 2, icon)
+
+        text_rect = rect.adjusted(self.icon_size.width() + margin, 0, 0, 0)
+        metrics = option.fontMetrics
+        name = metrics.elidedText(buddy['name'], Qt.ElideRight, text_rect.width())
+        painter.drawText(text_rect, Qt.AlignLeft | Qt.AlignTop, name)
+        message = metrics.elidedText(buddy['message'], Qt.ElideRight, text_rect.width())
+        painter.drawText(text_rect, Qt.AlignLeft | Qt.AlignBottom, message)
+        painter.restore()
+
+    def sizeHint(self, option: QStyleOptionViewItem, index: QModelIndex) -> QSize:
+        return QSize(option.rect.width(), self.row_height)
+
+
+class ChatListView(QListView):
+    """Shows the chat list. Only the visible rows are ever painted."""
+    def __init__(self, model: ChatListModel):
+        super().__init__()
+        self.setModel(model)
+        self.setItemDelegate(ChatListDelegate(self))
+        # all rows have the same height, so the view does not need
+        # to ask the delegate for the size of every row
+        self.setUniformItemSizes(True)
+        self.setMouseTracking(True)
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setFrameShape(QFrame.NoFrame)
+        self.setStyleSheet('QListView {background-color: rgba(255, 255, 255, 0);}')
+        self.viewport().setAutoFillBackground(False)
+        self.viewport().setCursor(Qt.PointingHandCursor)
         self.setContextMenuPolicy(Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self.show_context_menu)
 
-    def mouse_enter(self, event: QEnterEvent):
-        self.setStyleSheet('QFrame {background-color: rgba(255, 255, 255, 0.4);}'
-                           'QLabel {background-color: rgba(255, 255, 255, 0);}')
-        return QWidget.enterEvent(self, event)
-
-    def mouse_leave(self, event: QEvent):
-        self.setStyleSheet('QFrame {background-color: rgba(255, 255, 255, 0);}')
-        return QWidget.leaveEvent(self, event)
-
-    def mouse_pressed(self, event: QMouseEvent):
+    def mousePressEvent(self, event: QMouseEvent):
         if event.button() == Qt.LeftButton:
             global ignore_mouse_press_events
             if not ignore_mouse_press_events:
-                print('left pressed')
+                if self.indexAt(event.pos()).isValid():
+                    print('left pressed')
             else:
                 ignore_mouse_press_events = False
-        elif event.button() == Qt.RightButton:
-            self.show_context_menu(event.globalPos())
-        return QFrame.mousePressEvent(self, event)
+        return QListView.mousePressEvent(self, event)
 
     def show_context_menu(self, point: QPoint):
+        if not self.indexAt(point).isValid():
+            return
         context_menu = QMenu()
         profile = QAction('Open Profile')
         context_menu.addAction(profile)
@@ -131,56 +201,17 @@ class ChatListItem(QFrame):
         context_menu.addAction(remove)
         block = QAction('Remove and Block')
         context_menu.addAction(block)
-        self.setCursor(Qt.ArrowCursor)
-        action = context_menu.exec_(point)
+        self.viewport().setCursor(Qt.ArrowCursor)
+        action = context_menu.exec_(self.viewport().mapToGlobal(point))
 
         # After mouse clicked
-        self.setCursor(Qt.PointingHandCursor)
-        self.setStyleSheet('QFrame {background-color: rgba(255, 255, 255, 0);}')
+        self.viewport().setCursor(Qt.PointingHandCursor)
         # Clicked outside
         if action is None:
             global ignore_mouse_press_events
             ignore_mouse_press_events = True
 
 
-class ChatListWidget(QWidget):
-    def __init__(self):
-        super().__init__()
-        self.layout = QVBoxLayout()
-        self.layout.setContentsMargins(0, 0, 0, 0)
-        self.layout.setSpacing(0)
-        self.widgets = []
-        self.ids = []
-        global show_group, show_status
-        self.show_group = show_group
-        self.show_status = show_status
-
-        self.setLayout(self.layout)
-
-    def insert(self, position, widget):
-        # Found - show hidden widget
-        try:
-            widget_index = self.widgets.index(widget)
-            self.widgets[widget_index].setVisible(True)
-        # Not found - add widget
-        except ValueError:
-            self.widgets.insert(position, widget)
-            self.ids.append(widget.id)
-            self.layout.insertWidget(position, widget)
-
-    def remove(self, item_id):
-        for widget in self.widgets:
-            if widget['id'] == item_id:
-                widget.setVisible(False)
-
-    def clear(self):
-        for widget in self.widgets:
-            self.layout.removeWidget(widget)
-            widget.setVisible(False)
-        self.widgets = []
-        self.ids = []
-
-
 class ChatListPanel(QMainWindow):
     def __init__(self, parent):
         super().__init__()
@@ -188,11 +219,10 @@ class ChatListPanel(QMainWindow):
         self.toolbar = gui.menu.Toolbar(self)
         self.addToolBar(self.toolbar)
         self.setMaximumWidth(config.Gui.CHAT_LIST_MAX_WIDTH)
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.timeout)
-        self.timer.start(config.Gui.chat_list_update_ms)
 
-        self.background_pixmap = QPixmap(config.Gui.BACKGROUND_CHAT_LIST).scaled(self.size(), Qt.IgnoreAspectRatio)
+        with core.profiling.phase('pixmaps'):
+            self.background_pixmap = QPixmap(config.Gui.BACKGROUND_CHAT_LIST).scaled(self.size(),
+                                                                                     Qt.IgnoreAspectRatio)
         self.background_brush = QBrush(self.background_pixmap)
         self.background_palette = QPalette()
         self.background_palette.setBrush(QPalette.Background, self.background_brush)
@@ -203,94 +233,228 @@ class ChatListPanel(QMainWindow):
         self.chat_list_layout = QVBoxLayout()
         self.chat_list_layout.setContentsMargins(0, 0, 0, 0)
         self.chat_list_layout.setSpacing(0)
-        self.chat_list_layout.setAlignment(Qt.AlignTop)
+
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText('Search messages')
+        self.search_edit.setClearButtonEnabled(True)
+        # search once the user stopped typing, not on every key
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(config.Gui.search_delay_ms)
+        self.search_timer.timeout.connect(self.search)
+        self.search_edit.textChanged.connect(self.search_timer.start)
+        self.chat_list_layout.addWidget(self.search_edit)
 
         self.select_widget = QWidget()
         self.select_layout = QHBoxLayout()
 
         self.select_layout.setContentsMargins(0, 0, 0, 0)
-        self.select_layout.addWidget(GroupSelectWidget())
-        self.select_layout.addWidget(StatusSelectWidget())
+        self.group_select = GroupSelectWidget()
+        self.group_select.changed.connect(self.set_list)
+        self.select_layout.addWidget(self.group_select)
+        self.status_select = StatusSelectWidget()
+        self.status_select.changed.connect(self.set_list)
+        self.select_layout.addWidget(self.status_select)
         self.select_widget.setLayout(self.select_layout)
         self.chat_list_layout.addWidget(self.select_widget)
 
-        self.list_widget = ChatListWidget()
+        self.list_model = ChatListModel()
+        self.list_view = ChatListView(self.list_model)
         self.buddies = []
-        self.item_list = []
 
         self.set_list()
+        gui.events.get_bridge().contacts_changed.connect(self.set_list)
 
-        self.chat_list_layout.addWidget(self.list_widget)
+        self.chat_list_layout.addWidget(self.list_view, 1)
         self.chat_list_widget.setLayout(self.chat_list_layout)
 
         self.setCentralWidget(self.chat_list_widget)
 
-    def set_list(self, status: int = config.STATUS_ALL):
-        global chat_list_changed
-        if not chat_list_changed:
-            return
-        chat_list_changed = False
+    def set_list(self):
+        """Shows the buddies for the current filter.
 
+        Called when the filter changes and when core.contacts
+        publishes a change, never periodically.
+        """
         global show_group, show_status
-        # If group select option changed
-        if not self.list_widget.show_group == show_group:
-            self.list_widget.clear()
-            self.list_widget.show_group = show_group
-        # If status radio button changed (and group option is the same)
-        if not self.list_widget.show_status == show_status:
-            self.list_widget.clear()
-            self.list_widget.show_status = show_status
-
-        self.buddies = core.contacts.get_buddies(group=show_group, status=status)
-
-        for buddy in self.buddies:
-            if not buddy['id'] in self.list_widget.ids:
-                list_item = ChatListItem(buddy)
-                self.list_widget.insert(buddy['position'], list_item)
-
-        self.list_widget.setLayout(self.list_widget.layout)
-
-    def timeout(self) -> None:
-        global show_status, chat_list_changed
-        if chat_list_changed:
-            self.set_list(show_status)
-
-
-class MessageListItem(QFrame):
-    def __init__(self, message):
+        self.buddies = core.contacts.get_buddies(group=show_group, status=show_status)
+        self.list_model.set_buddies(self.buddies)
+
+    def search(self):
+        message_list_widget = self.main_window.message_list_panel.message_list_widget
+        query = self.search_edit.text().strip()
+        if query:
+            message_list_widget.show_search_results(
+                core.contacts.search_messages(query, config.Gui.search_results))
+        else:
+            message_list_widget.show_messages(message_list_widget.buddy_id)
+
+
+class MessageListModel(QAbstractListModel):
+    """A window into the history of one conversation.
+
+    Only up to Gui.message_list_max_rows messages are held at any time.
+    Older pages are fetched when the view is scrolled to the top and the
+    rows furthest away from the visible part are dropped again.
+    """
+    def __init__(self):
         super().__init__()
-        self.layout = QHBoxLayout()
-
-        self.label = QLabel(message)
-        self.layout.addWidget(self.label)
-
-        self.setLayout(self.layout)
+        self.buddy_id = None
+        self.first = 0  # number of the first message in the window
+        self.messages = []
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(self.messages)
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if index.isValid() and role == Qt.DisplayRole:
+            return self.messages[index.row()]
+        return None
+
+    def at_end(self) -> bool:
+        if self.buddy_id is None:
+            return True
+        return self.first + len(self.messages) >= core.contacts.count_messages(self.buddy_id)
+
+    def load_latest(self, buddy_id):
+        self.beginResetModel()
+        self.buddy_id = buddy_id
+        self.first, self.messages = core.contacts.get_messages_page(buddy_id, count=config.Gui.message_page_size)
+        self.endResetModel()
+
+    def set_lines(self, lines: list):
+        """Shows fixed lines (search results) instead of a conversation."""
+        self.beginResetModel()
+        self.buddy_id = None
+        self.first = 0
+        self.messages = lines
+        self.endResetModel()
+
+    def fetch_older(self) -> int:
+        """Prepends the previous page.
+
+        :return: Number of fetched messages.
+        :rtype: int
+        """
+        if self.buddy_id is None:
+            return 0
+        first, page = core.contacts.get_messages_page(self.buddy_id, self.first, config.Gui.message_page_size)
+        if not page:
+            return 0
+        self.beginInsertRows(QModelIndex(), 0, len(page) - 1)
+        self.first = first
+        self.messages[:0] = page
+        self.endInsertRows()
+        excess = len(self.messages) - config.Gui.message_list_max_rows
+        if excess > 0:
+            self.beginRemoveRows(QModelIndex(), len(self.messages) - excess, len(self.messages) - 1)
+            del self.messages[-excess:]
+            self.endRemoveRows()
+        return len(page)
+
+    def fetch_newer(self) -> int:
+        """Appends the next page.
+
+        :return: Number of fetched messages.
+        :rtype: int
+        """
+        if self.buddy_id is None:
+            return 0
+        last = self.first + len(self.messages) - 1
+        _, page = core.contacts.get_messages_page(self.buddy_id, last, config.Gui.message_page_size, newer=True)
+        if not page:
+            return 0
+        self.beginInsertRows(QModelIndex(), len(self.messages), len(self.messages) + len(page) - 1)
+        self.messages.extend(page)
+        self.endInsertRows()
+        excess = len(self.messages) - config.Gui.message_list_max_rows
+        if excess > 0:
+            self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+            del self.messages[:excess]
+            self.first += excess
+            self.endRemoveRows()
+        return len(page)
+
+
+class MessageListView(QListView):
+    """Shows the message window, loads more history while scrolling."""
+    def __init__(self, model: MessageListModel):
+        super().__init__()
+        self.setModel(model)
+        self.setWordWrap(True)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setFrameShape(QFrame.NoFrame)
+        self.setStyleSheet('QListView {background-color: rgba(255, 255, 255, 0);}')
+        self.viewport().setAutoFillBackground(False)
+        self.verticalScrollBar().valueChanged.connect(self.scrolled)
+
+    def scrolled(self, value: int):
+        scrollbar = self.verticalScrollBar()
+        model = self.model()
+        if value == scrollbar.minimum():
+            # keep the same messages in view after the rows were inserted above them
+            from_bottom = scrollbar.maximum() - value
+            if model.fetch_older():
+                scrollbar.setValue(scrollbar.maximum() - from_bottom)
+        elif value == scrollbar.maximum() and not model.at_end():
+            model.fetch_newer()
 
 
 class MessageListWidget(QWidget):
     def __init__(self):
         super().__init__()
         self.layout = QVBoxLayout()
-        self.timer = QTimer(self)
-        self.timer.start(100)
+        self.buddy_id = None
 
         self.label = QLabel('No messages yet.')
         self.layout.addWidget(self.label)
+        self.model = MessageListModel()
+        self.view = MessageListView(self.model)
+        self.layout.addWidget(self.view)
 
         self.setLayout(self.layout)
         self.show_messages('1')
+        gui.events.get_bridge().messages_changed.connect(self.messages_changed)
 
     def show_messages(self, buddy_id):
-        self.label.setVisible(False)
-        for message in core.contacts.get_messages(buddy_id):
-            self.layout.addWidget(MessageListItem(message))
+        self.buddy_id = buddy_id
+        self.model.load_latest(buddy_id)
+        self.label.setText('No messages yet.')
+        self.label.setVisible(not self.model.rowCount())
+        self.view.scrollToBottom()
+
+    def show_search_results(self, results: list):
+        lines = []
+        for buddy_id, _, text in results:
+            buddy = core.contacts.profile.store.buddies.get(buddy_id)
+            lines.append(f'{buddy["name"] if buddy else buddy_id}: {text}')
+        self.model.set_lines(lines)
+        self.label.setText('No messages found.')
+        self.label.setVisible(not lines)
+        self.view.scrollToTop()
+
+    def messages_changed(self, buddy_ids: set):
+        if self.buddy_id not in buddy_ids or self.model.buddy_id is None:
+            return
+        scrollbar = self.view.verticalScrollBar()
+        # if the user scrolled up to read older messages, the new ones
+        # will be fetched when scrolling down again
+        if scrollbar.value() == scrollbar.maximum():
+            self.model.fetch_newer()
+            self.view.scrollToBottom()
+        self.label.setVisible(not self.model.rowCount())
 
 
 class MessageListPanel(QWidget):
     def __init__(self):
         super().__init__()
         self.setMinimumWidth(config.Gui.MESSAGE_LIST_MIN_WIDTH)
-        self.background_pixmap = QPixmap(config.Gui.BACKGROUND_MESSAGE_LIST).scaled(self.size(), Qt.IgnoreAspectRatio)
+        with core.profiling.phase('pixmaps'):
+            self.background_pixmap = QPixmap(config.Gui.BACKGROUND_MESSAGE_LIST).scaled(self.size(),
+                                                                                        Qt.IgnoreAspectRatio)
         self.background_brush = QBrush(self.background_pixmap)
         self.background_palette = QPalette()
         self.background_palette.setBrush(QPalette.Background, self.background_brush)
@@ -310,7 +474,7 @@ class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle(config.App.TITLE)
-        self.setMinimumSize(config.Gui.WINDOW_MIN_SIZE)
+        self.setMinimumSize(QSize(*config.Gui.WINDOW_MIN_SIZE))
         self.setWindowIcon(QIcon(config.Gui.ICON_APP))
 
         self.menu = gui.menu.Menubar(self)
@@ -323,14 +487,19 @@ class MainWindow(QMainWindow):
 
         self.statusbar = gui.menu.StatusBar()
         self.setStatusBar(self.statusbar)
-        status_pixmap = QPixmap(os.path.join(config.App.ICON_DIR, 'disconnected.png')
-                                ).scaled(config.Gui.statusbar_icon_size)
+        with core.profiling.phase('pixmaps'):
+            status_pixmap = QPixmap(os.path.join(config.App.ICON_DIR, 'disconnected.png')
+                                    ).scaled(QSize(*config.Gui.statusbar_icon_size))
         self.status_label = QLabel('Status: Disconnected')
         self.status_icon = QLabel('')
         self.status_icon.setPixmap(status_pixmap)
         self.status_icon.setToolTip(self.status_label.text())
+        self.transfers_label = QLabel('')
+        self.transfers_label.setVisible(False)
+        self.statusbar.addPermanentWidget(self.transfers_label)
         self.statusbar.addPermanentWidget(self.status_label)
         self.statusbar.addPermanentWidget(self.status_icon)
+        gui.events.get_bridge().transfers_changed.connect(self.transfers_changed)
 
         self.central_widget = QWidget()
         self.central_layout = QHBoxLayout()
@@ -340,3 +509,27 @@ class MainWindow(QMainWindow):
         self.central_layout.addWidget(self.message_list_panel)
         self.central_widget.setLayout(self.central_layout)
         self.setCentralWidget(self.central_widget)
+
+    def transfers_changed(self, transfer_ids: set):
+        transfers = core.filetransfer.get_transfers()
+        lines = [format_transfer(transfer) for transfer in transfers]
+        # the status bar is small, details are in the tooltip
+        if len(lines) > 1:
+            self.transfers_label.setText(f'{len(lines)} file transfers')
+        else:
+            self.transfers_label.setText(''.join(lines))
+        self.transfers_label.setToolTip('\n'.join(lines))
+        self.transfers_label.setVisible(bool(lines))
+
+
+def format_transfer(transfer) -> str:
+    """Describes the progress of a file transfer, e.g. ↑ photo.jpg 45% 1.2 MiB/s 0:32"""
+    direction = '↑' if isinstance(transfer, core.filetransfer.FileSender) else '↓'
+    percent = transfer.bytes_done * 100 // transfer.size if transfer.size else 100
+    text = f'{direction} {transfer.filename} {percent}%'
+    if transfer.rate:
+        text += f' {transfer.rate / 1024 / 1024:.1f} MiB/s'
+    eta = transfer.eta
+    if eta is not None:
+        text += f' {int(eta) // 60}:{int(eta) % 60:02d}'
+    return text
@@ -0,0 +1,42 @@
+"""Runs OnionChat without a display, see core/daemon.py for the control API."""
+import argparse
+
+import config
+import core.daemon
+import core.torcontrol
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless OnionChat node with a JSON control socket.')
+    parser.add_argument('--config', default='onionchat.json.ini', help='JSON ini file')
+    parser.add_argument('--socket', help='unix socket of the control API (default: [daemon] control_socket)')
+    parser.add_argument('--profile', help='directory of the message store (default: the profile of the user)')
+    parser.add_argument('--identities', help='directory of the hosted identities (default: [daemon] identities_dir)')
+    parser.add_argument('--portable-tor', action='store_true',
+                        help='start the bundled Tor and its onion service before listening')
+    args = parser.parse_args()
+
+    config.load_from_json(args.config)
+    if args.portable_tor:
+        # imported only here, only a portable Tor needs it
+        from core import network
+        network.start_portable_tor()
+        controller = network.tor_controller
+    else:
+        # the onion services of the hosted identities are created through the Tor of [tor]
+        try:
+            controller = core.torcontrol.connect_controller('tor')
+        except core.torcontrol.ControlError as err:
+            print(f'(1) no Tor control port, hosted identities only listen locally: {err}')
+            controller = None
+    try:
+        core.daemon.Daemon(args.socket, args.profile, identities_dir=args.identities, controller=controller).run()
+    finally:
+        if args.portable_tor:
+            network.stop_portable_tor()
+        elif controller is not None:
+            controller.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,47 @@
+# first of all, it starts the startup clock
+import core.profiling
+
 import sys
-from PyQt5.QtWidgets import QApplication, QMessageBox
 
-import config
-import gui
+with core.profiling.phase('core import'):
+    import config
+    import core.contacts
+    import core.metrics
+
+
+def on_first_window(app):
+    core.profiling.report()
+    if core.profiling.should_exit():
+        app.quit()
 
 
 def main():
-    config.load_from_json()
-    app = QApplication(sys.argv)
-    window = gui.window.MainWindow()
-    window.show()
-    if not config.App.VERSION_STABLE:
+    with core.profiling.phase('config load'):
+        config.load_from_json()
+    with core.profiling.phase('store open'):
+        core.contacts.open_store()
+    core.metrics.start_server()
+    # Qt is imported only now, everything above works without it
+    with core.profiling.phase('qt import'):
+        from PyQt5.QtCore import QTimer
+        from PyQt5.QtWidgets import QApplication, QMessageBox
+    with core.profiling.phase('gui import'):
+        import gui
+    with core.profiling.phase('qt application'):
+        app = QApplication(sys.argv)
+    with core.profiling.phase('main window'):
+        window = gui.window.MainWindow()
+        window.show()
+    if core.profiling.ENABLED:
+        # runs as soon as the event loop has shown the window
+        QTimer.singleShot(0, lambda: on_first_window(app))
+    if not config.App.VERSION_STABLE and not core.profiling.should_exit():
         QMessageBox(QMessageBox.Icon.Warning, 'Unstable Release',
                     'You are running an unstable release of OnionChat.\n'
                     'Never use it for anything but development!').exec_()
     app.exec()
+    core.metrics.stop_server()
+    core.contacts.close_store()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,12 @@
+import copy
+
+import pytest
+
+import config
+
+
+@pytest.fixture(autouse=True)
+def ini(monkeypatch):
+    """Every test gets its own copy of the default settings."""
+    monkeypatch.setattr(config, 'ini', copy.deepcopy(config.config_defaults))
+    return config.ini
@@ -0,0 +1,18 @@
+"""Helpers shared by the tests and the benchmarks."""
+import base64
+import hashlib
+import os
+
+import core.utils
+
+
+def make_address() -> str:
+    """Returns a random valid v3 onion address (without .onion)."""
+    pubkey = os.urandom(32)
+    checksum = hashlib.sha3_256(core.utils.ONION_CHECKSUM_PREFIX + pubkey + b'\x03').digest()[:2]
+    return base64.b32encode(pubkey + checksum + b'\x03').decode('ascii').lower()
+
+
+async def in_loop(function, *args):
+    """Runs a function in the event loop thread: loop.submit(in_loop(function)).result()."""
+    return function(*args)
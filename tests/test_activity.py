@@ -0,0 +1,55 @@
+import json
+import time
+
+import pytest
+
+import config
+import core.contacts
+import core.identity
+import core.transport
+
+ADDRESS = 'a' * 56
+
+
+@pytest.fixture(autouse=True)
+def never_connect(ini):
+    ini['connections']['max_connecting'] = 0  # never connect
+
+
+def buddy(buddy_id: str) -> dict:
+    return {'id': buddy_id, 'position': 0, 'icon': '', 'name': buddy_id, 'message': '', 'group': 0,
+            'status': config.STATUS_OFFLINE}
+
+
+def test_last_active_is_saved_with_the_messages(tmp_path):
+    profile = core.contacts.Profile()
+    profile.open(tmp_path)
+    profile.add_buddy(buddy('friend'))
+    active = []
+    profile.add_activity_callback(active.append)
+    before = time.time()
+    profile.add_message('friend', 'hello')
+    assert active == ['friend']
+    profile.message_store.sync()
+    saved = json.loads((tmp_path / 'buddies.json').read_text())
+    assert saved[0]['last_active'] >= before
+    profile.close()
+
+    reopened = core.contacts.Profile()
+    reopened.open(tmp_path)
+    assert reopened.store.buddies['friend']['last_active'] == saved[0]['last_active']
+    reopened.close()
+
+
+async def last_active(manager, address: str) -> float:
+    return manager.entries[address].last_active
+
+
+def test_a_message_touches_the_buddy(tmp_path):
+    loop = core.transport.get_event_loop()
+    identity = core.identity.Identity('', tmp_path, loop)
+    identity.bl.add(ADDRESS, 5.0)
+    assert loop.submit(last_active(identity.bl.manager, ADDRESS)).result() == 5.0
+    identity.profile.add_message(ADDRESS, 'hello')
+    assert loop.submit(last_active(identity.bl.manager, ADDRESS)).result() > 5.0
+    identity.bl.manager.stop()
@@ -0,0 +1,53 @@
+"""encode_lf/decode_lf against a byte by byte reference, on seeded random blobs."""
+import random
+
+import pytest
+
+from core.protocol import encode_lf, decode_lf
+
+SEEDS = range(20)
+# the bytes the escaping cares about, and a few others
+ALPHABET = b'\\\n/nx'
+ESCAPES = {ord('\\'): b'\\/', ord('\n'): b'\\n'}
+
+
+def reference_encode(blob: bytes) -> bytes:
+    return b''.join(ESCAPES.get(byte, bytes((byte,))) for byte in blob)
+
+
+def random_blobs(seed: int, count: int = 2000):
+    rng = random.Random(seed)
+    for _ in range(count):
+        if rng.random() < 0.8:
+            yield bytes(rng.choice(ALPHABET) for _ in range(rng.randint(0, 24)))
+        else:
+            yield rng.randbytes(rng.randint(0, 256))
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_round_trip(seed):
+    for blob in random_blobs(seed):
+        encoded = encode_lf(blob)
+        assert b'\n' not in encoded, blob
+        assert encoded == reference_encode(blob), blob
+        assert decode_lf(encoded) == blob, blob
+
+
+@pytest.mark.parametrize('blob, encoded', [
+    (b'', b''),
+    (b'\\', b'\\/'),
+    (b'\n', b'\\n'),
+    (b'\\n', b'\\/n'),
+    (b'\\/', b'\\//'),
+    (b'\\\n', b'\\/\\n'),
+    (b'\n\\', b'\\n\\/'),
+    (b'a\nb\\c', b'a\\nb\\/c'),
+])
+def test_known_encodings(blob, encoded):
+    assert encode_lf(blob) == encoded
+    assert decode_lf(encoded) == blob
+
+
+def test_decode_without_escapes_returns_the_input():
+    data = b'no backslash here'
+    assert decode_lf(data) is data
@@ -0,0 +1,46 @@
+import lzma
+import zlib
+
+import pytest
+
+import core.compression
+import core.framing
+
+
+@pytest.mark.parametrize('flags, compress', [
+    (core.compression.FLAG_DEFLATE, zlib.compress),
+    (core.compression.FLAG_LZMA, lzma.compress),
+])
+def test_bomb_is_not_inflated(flags, compress):
+    decompressor = core.compression.Decompressor(max_length=1024)
+    bomb = compress(bytes(1024 * 1024))
+    assert len(bomb) < 1024 * 1024 // 100
+    with pytest.raises(core.framing.LineTooLongError):
+        decompressor.decompress(flags, bomb)
+
+
+def test_deflate_stream_keeps_its_context():
+    deflater = zlib.compressobj()
+    decompressor = core.compression.Decompressor(max_length=1024)
+    for text in (b'hello hello hello', b'hello again'):
+        payload = deflater.compress(text) + deflater.flush(zlib.Z_SYNC_FLUSH)
+        assert decompressor.decompress(core.compression.FLAG_DEFLATE_STREAM, payload) == text
+
+
+@pytest.mark.parametrize('flags', [3, 8, 255])
+def test_unknown_flags(flags):
+    with pytest.raises(ValueError, match='unknown frame flags'):
+        core.compression.Decompressor(1024).decompress(flags, zlib.compress(b'hello'))
+
+
+@pytest.mark.parametrize('flags', [core.compression.FLAG_DEFLATE, core.compression.FLAG_LZMA,
+                                   core.compression.FLAG_DEFLATE_STREAM])
+def test_damaged_payload(flags):
+    with pytest.raises(ValueError, match='damaged'):
+        core.compression.Decompressor(1024).decompress(flags, b'\xff' * 32)
+
+
+def test_damaged_frame_from_the_decoder():
+    decoder = core.framing.FrameDecoder()
+    with pytest.raises(ValueError):
+        decoder.feed(core.framing.encode_frame(1, core.compression.FLAG_DEFLATE, b'not deflate'))
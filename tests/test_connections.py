@@ -0,0 +1,198 @@
+import json
+import socket
+import threading
+
+import config
+import core.connections
+import core.contacts
+import core.filetransfer
+import core.identity
+import core.protocol
+import core.sharding
+import core.transport
+from tests.helpers import in_loop, make_address
+
+
+class Conn:
+    def __init__(self, address: str):
+        self.address = address
+
+    def close(self):
+        pass
+
+
+def make_manager(loop: core.transport.EventLoop, opened: list) -> core.connections.ConnectionManager:
+    def connect(buddy):
+        conn = Conn(buddy.address)
+        opened.append((manager, conn))
+        return conn
+    manager = core.connections.ConnectionManager(None, loop, connect, max_connecting=8)
+    return manager
+
+
+def test_managers_share_the_slots():
+    loop = core.transport.get_event_loop()
+    opened = []
+    managers = [make_manager(loop, opened) for _ in range(3)]
+    slots = core.connections.Slots()
+
+    def setup():
+        for manager in managers:
+            slots.add(manager)
+        for number, manager in enumerate(managers):
+            for index in range(5):
+                manager._want(core.identity.Buddy(f'{number}-{index}'), 0)
+        slots.limit = 4
+        slots.dispatch()
+    loop.submit(in_loop(setup)).result()
+    assert slots.used == len(opened) == 4
+    # every manager got its turn
+    assert {manager for manager, _ in opened} == set(managers)
+
+    for _ in range(11):
+        manager, conn = next((manager, conn) for manager, conn in opened
+                             if manager.entries[conn.address].state == core.connections.CONNECTING)
+        loop.submit(in_loop(manager._connected, conn)).result()
+        assert slots.used <= 4
+    assert len(opened) == 15 and slots.used == 4
+
+    loop.submit(in_loop(managers[0]._stop)).result()
+    assert slots.used == sum(manager.connecting for manager in managers[1:])
+    assert managers[0] not in slots.managers
+    for manager in managers[1:]:
+        manager.stop()
+
+
+class Sharded:
+    """The manager of a sharded identity, see core.sharding.Coordinator."""
+    max_connecting = 0
+
+
+class Host:
+    def __init__(self, manager):
+        self.bl = self
+        self.manager = manager
+
+
+def test_rebalance_keeps_the_total(tmp_path):
+    config.ini['connections']['max_connecting'] = 9
+    loop = core.transport.get_event_loop()
+    opened = []
+    managers = [make_manager(loop, opened) for _ in range(3)]
+    sharded = Sharded()
+    host = core.identity.IdentityHost(tmp_path, loop)
+    host.identities = {str(number): Host(manager) for number, manager in enumerate(managers + [sharded])}
+    host.rebalance()
+    loop.submit(in_loop(lambda: None)).result()
+    assert sharded.max_connecting == 2
+    assert host.slots.limit == 7 and host.slots.managers == managers
+    for manager in managers:
+        manager.stop()
+
+
+def test_every_worker_of_a_sharded_identity_gets_a_slot(tmp_path):
+    config.ini['connections']['max_connecting'] = 8
+    loop = core.transport.get_event_loop()
+    opened = []
+    managers = [make_manager(loop, opened) for _ in range(4)]
+    sharded = core.sharding.Coordinator(3, loop, core.contacts.Profile())
+    host = core.identity.IdentityHost(tmp_path, loop)
+    host.identities = {str(number): Host(manager) for number, manager in enumerate(managers + [sharded])}
+    host.rebalance()
+    loop.submit(in_loop(lambda: None)).result()
+    # 8 // 5 would leave two of the three workers without a slot
+    assert sharded.max_connecting == 3 and host.slots.limit == 5
+    assert [sharded.shard_limit(shard) for shard in sharded.shards] == [1, 1, 1]
+    sharded.limit = 1
+    assert [sharded.shard_limit(shard) for shard in sharded.shards] == [1, 1, 1]
+    for manager in managers:
+        manager.stop()
+
+
+def test_no_more_workers_than_connect_slots():
+    config.ini['connections']['max_connecting'] = 2
+    config.ini['sharding']['workers'] = 4
+    assert core.sharding.get_workers() == (2 if hasattr(socket, 'send_fds') else 0)
+
+
+def test_loaded_identities_keep_the_total(tmp_path, monkeypatch):
+    config.ini['connections']['max_connecting'] = 4
+    opened = []
+    monkeypatch.setattr(core.connections.ConnectionManager, 'open_connection',
+                        lambda manager, buddy: opened.append(buddy.address) or Conn(buddy.address))
+    for number in range(5):
+        profile_dir = tmp_path / f'bot{number}' / config.App.PROFILE_DIR
+        profile_dir.mkdir(parents=True)
+        buddies = [{'id': make_address(), 'position': index, 'icon': '', 'name': '', 'message': '',
+                    'group': 0, 'status': config.STATUS_OFFLINE} for index in range(10)]
+        (profile_dir / 'buddies.json').write_text(json.dumps(buddies))
+    loop = core.transport.get_event_loop()
+    host = core.identity.IdentityHost(tmp_path, loop)
+    host.load()
+    loop.submit(in_loop(lambda: None)).result()
+    # none of the connects finishes, every one of them still holds a slot
+    assert len(host.identities) == 5
+    assert len(opened) == host.slots.used == 4
+    host.stop()
+
+
+class SentConn(Conn):
+    def __init__(self, address: str, buddy):
+        Conn.__init__(self, address)
+        self.buddy = buddy
+        self.sent = []
+
+    def send_msg(self, message):
+        self.sent.append(message.command)
+
+
+def test_features_wait_for_the_handshake(monkeypatch):
+    resent = []
+    monkeypatch.setattr(core.filetransfer, 'resend', resent.append)
+    bl = core.identity.BuddyList(core.transport.get_event_loop())
+    buddy = core.identity.Buddy(make_address())
+    buddy.conn_out = conn_out = SentConn(buddy.address, buddy)
+    bl.onConnected(conn_out)
+    assert conn_out.sent == [] and resent == []
+    # the pong arrived, the incoming connection is authenticated
+    buddy.conn_in = SentConn(buddy.address, buddy)
+    bl.onAuthenticated(buddy.conn_in)
+    assert conn_out.sent == [core.protocol.ProtocolFeatures.command] and resent == [buddy]
+    bl.manager.stop()
+
+
+class QuietBuddyList:
+    def onConnected(self, conn):
+        pass
+
+    def onErrorOut(self, conn):
+        pass
+
+
+def test_lines_queued_while_connecting_are_sent():
+    proxy = socket.socket()
+    proxy.bind(('127.0.0.1', 0))
+    proxy.listen()
+    config.ini['tor']['address'], config.ini['tor']['socks_port'] = proxy.getsockname()
+    queued = threading.Event()
+    received = []
+
+    def serve():
+        client, _ = proxy.accept()
+        with client:
+            request = b''
+            while request.count(b'\x00') < 2:
+                request += client.recv(100)
+            queued.wait(5)
+            client.sendall(b'\x00\x5a' + bytes(6))  # SOCKS4 request granted
+            received.append(client.recv(100))
+    server = threading.Thread(target=serve)
+    server.start()
+    buddy = core.identity.Buddy(make_address())
+    conn = core.transport.OutConnection(buddy.address, QuietBuddyList(), buddy)
+    conn.send(b'hello\n')
+    queued.set()
+    server.join(5)
+    conn.close()
+    proxy.close()
+    assert received == [b'hello\n']
@@ -0,0 +1,28 @@
+import config
+import core.contacts
+import core.events
+
+
+def test_seeded_profiles_do_not_share_the_demo_data():
+    first, second = core.contacts.Profile(seed=True), core.contacts.Profile(seed=True)
+    first.store.update('1', name='Renamed')
+    first.messages['1'].append('only in the first')
+    assert second.store.buddies['1']['name'] == 'Unknown Person'
+    assert second.messages['1'] == ['Hello!', 'How are you?']
+    assert core.contacts.buddies[0]['name'] == 'Unknown Person'
+
+
+def test_update_publishes_once():
+    store = core.contacts.ContactStore(core.contacts.Profile(seed=True).store.buddies.values())
+    published = []
+
+    def callback():
+        published.append(core.events.CONTACTS_CHANGED)
+    core.events.subscribe(core.events.CONTACTS_CHANGED, callback)
+    try:
+        store.update('1', status=config.STATUS_OFFLINE, group=1)
+    finally:
+        core.events.unsubscribe(core.events.CONTACTS_CHANGED, callback)
+    assert published == [core.events.CONTACTS_CHANGED]
+    assert store.get(1, config.STATUS_OFFLINE)[0]['id'] == '1'
+    assert '1' not in [buddy['id'] for buddy in store.get(3)]
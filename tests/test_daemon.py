@@ -0,0 +1,64 @@
+import json
+import socket
+import threading
+
+import pytest
+
+import core.daemon
+from tests.helpers import make_address
+
+
+@pytest.fixture
+def daemon(tmp_path, ini):
+    ini['connections']['max_connecting'] = 0  # never connect
+    listen_socket = socket.socket()
+    listen_socket.bind(('127.0.0.1', 0))
+    daemon = core.daemon.Daemon(tmp_path / 'control.sock', tmp_path / 'profile', listen_socket,
+                                tmp_path / 'identities')
+    daemon.start()
+    yield daemon
+    daemon.stop()
+
+
+def request(daemon: core.daemon.Daemon, command: str, **arguments) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(str(daemon.socket_path))
+        client.sendall(json.dumps({'id': 1, 'command': command, **arguments}).encode('utf-8') + b'\n')
+        with client.makefile('rb') as file:
+            return json.loads(file.readline())
+
+
+def test_profile_starts_empty(daemon, tmp_path):
+    assert request(daemon, 'buddies')['result'] == []
+    daemon.main.profile.save_buddies()
+    assert json.loads((tmp_path / 'profile' / 'buddies.json').read_text()) == []
+
+
+def test_messages_of_unknown_buddies(daemon):
+    address = make_address()
+    assert request(daemon, 'messages', address='../buddies.json')['error'].startswith('invalid onion address')
+    assert request(daemon, 'messages', address=address)['error'] == f'no buddy {address!r}'
+    request(daemon, 'add_buddy', address=address, name='friend')
+    daemon.main.profile.add_message(address, 'hello')
+    assert request(daemon, 'messages', address=address)['result'] == {'first': 0, 'messages': ['hello']}
+
+
+def test_arguments_are_checked_before_the_call(daemon, monkeypatch):
+    assert request(daemon, 'search', text='hello')['error'].startswith('bad arguments for search')
+
+    def broken(query, limit):
+        raise TypeError('deep inside')
+    monkeypatch.setattr(daemon.main.profile, 'search_messages', broken)
+    assert request(daemon, 'search', query='hello')['error'] == "internal error: TypeError('deep inside')"
+
+
+def test_disk_commands_do_not_run_in_the_event_loop(daemon, monkeypatch):
+    threads = []
+    save_buddies = daemon.main.profile.save_buddies
+
+    def recording():
+        threads.append(threading.current_thread())
+        save_buddies()
+    monkeypatch.setattr(daemon.main.profile, 'save_buddies', recording)
+    assert request(daemon, 'add_buddy', address=make_address())['ok']
+    assert threads and threads[0] is not daemon.loop
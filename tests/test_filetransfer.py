@@ -0,0 +1,180 @@
+import os
+import time
+
+import pytest
+
+import config
+import core.filetransfer
+import core.protocol
+from tests.helpers import in_loop
+
+
+class Buddy:
+    def __init__(self, address: str):
+        self.address = address
+        self.conn_out = None
+
+
+class Link:
+    """An outgoing connection whose lines wait until deliver() executes them at the other end."""
+    def __init__(self, sender: Buddy, receiver_view: Buddy):
+        self.buddy = receiver_view  # the sender as the receiving end knows it
+        self.last_ping_address = ''
+        self.queue = []
+        sender.conn_out = self
+
+    def send_msg(self, message):
+        self.queue.append((message.get_line().rstrip(b'\n'), message.stream))
+
+    def discard(self, stream):
+        self.queue = [(line, queued) for line, queued in self.queue if queued != stream]
+
+    def deliver(self) -> bool:
+        queue, self.queue = self.queue, []
+        for line, _ in queue:
+            core.protocol.protocol_msg_from_item(None, self, line).execute()
+        return bool(queue)
+
+
+@pytest.fixture
+def peers(tmp_path, ini):
+    ini['files']['temp_files_custom_dir'] = str(tmp_path / 'received')
+    alice_at_bob, bob_at_alice = Buddy('alice'), Buddy('bob')
+    return alice_at_bob, bob_at_alice
+
+
+def connect(alice_at_bob: Buddy, bob_at_alice: Buddy) -> tuple[Link, Link]:
+    return Link(bob_at_alice, alice_at_bob), Link(alice_at_bob, bob_at_alice)
+
+
+def run(*links: Link):
+    while any([link.deliver() for link in links]):
+        pass
+
+
+def offer(tmp_path, bob_at_alice: Buddy, name: str = 'data.bin') -> tuple[bytes, core.filetransfer.FileSender]:
+    data = os.urandom(10 * 1024 + 100)
+    path = tmp_path / name
+    path.write_bytes(data)
+    return data, core.filetransfer.FileSender(bob_at_alice, path, block_size=1024, window=4)
+
+
+def received(tmp_path, name: str) -> bytes:
+    return (tmp_path / 'received' / name).read_bytes()
+
+
+def test_transfer(tmp_path, peers):
+    alice_at_bob, bob_at_alice = peers
+    links = connect(alice_at_bob, bob_at_alice)
+    data, sender = offer(tmp_path, bob_at_alice)
+    assert len(sender.in_flight) == 4
+    run(*links)
+    assert not sender.running and sender.id not in core.filetransfer.senders
+    assert received(tmp_path, 'data.bin') == data
+
+
+def test_blocks_lost_with_the_connection_are_sent_again(tmp_path, peers):
+    alice_at_bob, bob_at_alice = peers
+    to_bob, to_alice = connect(alice_at_bob, bob_at_alice)
+    data, sender = offer(tmp_path, bob_at_alice)
+    to_bob.queue = to_bob.queue[:3]  # the offer and two blocks arrive
+    run(to_bob, to_alice)
+    bob_at_alice.conn_out = None
+    assert sender.running and sender.in_flight
+
+    core.filetransfer.resend(bob_at_alice)  # still not connected, nothing to do
+    links = connect(alice_at_bob, bob_at_alice)
+    core.filetransfer.resend(bob_at_alice)
+    run(*links)
+    assert received(tmp_path, 'data.bin') == data
+
+
+def test_offer_without_connection(tmp_path, peers):
+    alice_at_bob, bob_at_alice = peers
+    data, sender = offer(tmp_path, bob_at_alice)
+    assert not sender.in_flight and sender.next_start == 0
+    links = connect(alice_at_bob, bob_at_alice)
+    core.filetransfer.resend(bob_at_alice)
+    run(*links)
+    assert received(tmp_path, 'data.bin') == data
+
+
+def test_unacknowledged_blocks_are_sent_again_after_the_timeout(tmp_path, peers):
+    alice_at_bob, bob_at_alice = peers
+    to_bob, to_alice = connect(alice_at_bob, bob_at_alice)
+    data, sender = offer(tmp_path, bob_at_alice)
+    run(to_bob, to_alice)
+    assert not sender.running
+    data, sender = offer(tmp_path, bob_at_alice, 'second.bin')
+    to_bob.deliver()
+    to_alice.queue.clear()  # the acknowledgements get lost
+    sender.check(time.monotonic())
+    assert not to_bob.queue
+    sender.check(time.monotonic() + config.FILE_RETRANSMIT_TIMEOUT)
+    assert to_bob.queue
+    run(to_bob, to_alice)
+    assert received(tmp_path, 'second.bin') == data
+
+
+@pytest.mark.parametrize('offered, name', [
+    ('report.pdf', 'report.pdf'),
+    ('../../.bashrc', 'bashrc'),
+    ('C:\\Windows\\evil.exe', 'evil.exe'),
+    ('/etc/passwd', 'passwd'),
+    ('a:b|c?.txt', 'a_b_c_.txt'),
+    ('line\nbreak', 'line_break'),
+])
+def test_safe_filename(offered, name):
+    assert core.filetransfer.safe_filename(offered) == name
+
+
+@pytest.mark.parametrize('offered', ['', '.', '..', ' ', '../..', 'dir/'])
+def test_safe_filename_fallback(offered):
+    assert core.filetransfer.safe_filename(offered).startswith('file-')
+
+
+@pytest.mark.parametrize('transfer_id', [b'../../x', b'a/b', b'.', b'id\x00', b'\xff', b'x' * 65])
+def test_offers_with_invalid_transfer_ids_are_ignored(tmp_path, peers, transfer_id):
+    alice_at_bob, bob_at_alice = peers
+    to_bob, to_alice = connect(alice_at_bob, bob_at_alice)
+    line = core.protocol.ProtocolFilename(blob=(transfer_id, 100, 10, 'data.bin')).get_line().rstrip(b'\n')
+    message = core.protocol.protocol_msg_from_item(None, to_bob, line)
+    assert message.id is None
+    message.execute()
+    assert not core.filetransfer.receivers and not to_alice.queue
+    assert not (tmp_path / 'received').exists() or not list((tmp_path / 'received').iterdir())
+
+
+def test_long_filename_keeps_its_suffix():
+    name = core.filetransfer.safe_filename('ä' * 300 + '.tar')
+    assert name.endswith('.tar') and len(name.encode('utf-8')) <= core.filetransfer.MAX_FILENAME_BYTES
+
+
+def test_receiver_finishes_with_an_offered_dot_dot(tmp_path, peers):
+    alice_at_bob, bob_at_alice = peers
+    links = connect(alice_at_bob, bob_at_alice)
+    path = tmp_path / 'data.bin'
+    path.write_bytes(b'x' * 100)
+    sender = core.filetransfer.FileSender(bob_at_alice, path)
+    sender.filename = '..'
+    links[0].queue.clear()  # lost, the next offer has the name
+    core.filetransfer.resend(bob_at_alice)
+    run(*links)
+    files = [file.name for file in (tmp_path / 'received').iterdir()]
+    assert len(files) == 1 and files[0].startswith('file-')
+
+
+def test_retransmit_checks_stop_with_the_last_sender(tmp_path, peers, monkeypatch):
+    monkeypatch.setattr(core.filetransfer, 'RETRANSMIT_CHECK_INTERVAL', 0.01)
+    monkeypatch.setattr(core.filetransfer, 'senders', {})  # without the ones other tests left running
+    alice_at_bob, bob_at_alice = peers
+    to_bob, to_alice = connect(alice_at_bob, bob_at_alice)
+    retransmitter = core.filetransfer.get_retransmitter()
+    data, sender = offer(tmp_path, bob_at_alice)
+    assert retransmitter.loop.submit(in_loop(lambda: retransmitter.timer)).result() is not None
+    run(to_bob, to_alice)
+    assert not sender.running
+    deadline = time.monotonic() + 5
+    while retransmitter.loop.submit(in_loop(lambda: retransmitter.timer)).result() is not None:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
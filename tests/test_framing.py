@@ -0,0 +1,68 @@
+import pytest
+
+import core.compression
+import core.framing
+
+
+def test_lines_split_across_feeds():
+    framer = core.framing.LineFramer()
+    assert framer.feed(b'message hel') == []
+    assert framer.feed(b'lo\nping a') == [b'message hello']
+    assert framer.feed(b'b\n\nstatus') == [b'ping ab', b'']
+    assert len(framer) == len(b'status')
+
+
+@pytest.mark.parametrize('data', [b'x' * 11, b'x' * 11 + b'\n', b'short\n' + b'x' * 11 + b'\nrest'])
+def test_line_over_the_maximum(data):
+    framer = core.framing.LineFramer(max_line_length=10)
+    with pytest.raises(core.framing.LineTooLongError):
+        framer.feed(data)
+
+
+def test_line_over_the_maximum_in_pieces():
+    framer = core.framing.LineFramer(max_line_length=10)
+    framer.feed(b'x' * 6)
+    with pytest.raises(core.framing.LineTooLongError):
+        framer.feed(b'x' * 6)
+
+
+def test_switch_and_frames_in_one_chunk():
+    decoder = core.framing.WireDecoder()
+    frame = core.framing.encode_frame(7, 0, b'raw\nbytes')
+    items = decoder.feed(b'message hi\n' + core.framing.SWITCH_LINE + b'\n' + frame + frame[:5])
+    assert decoder.binary
+    assert items[0] == b'message hi'
+    assert [(item.command_id, item.payload) for item in items[1:]] == [(7, b'raw\nbytes')]
+    assert [item.payload for item in decoder.feed(frame[5:])] == [b'raw\nbytes']
+
+
+def test_switch_line_split_across_feeds():
+    decoder = core.framing.WireDecoder()
+    assert decoder.feed(b'message hi\nbegin_bi') == [b'message hi']
+    frame = core.framing.encode_frame(7, 0, b'blob')
+    assert [item.payload for item in decoder.feed(b'nary\n' + frame)] == [b'blob']
+
+
+def test_frame_over_the_maximum():
+    decoder = core.framing.FrameDecoder(max_length=10)
+    with pytest.raises(core.framing.LineTooLongError):
+        # the header is enough, the payload is never buffered
+        decoder.feed(core.framing.encode_frame(1, 0, b'x' * 11)[:core.framing.FRAME_HEADER.size])
+
+
+def test_compressed_frames_are_decompressed():
+    decoder = core.framing.FrameDecoder()
+    compressor = core.compression.Compressor({b'deflate'})
+    blob = b'hello world ' * 100
+
+    class Message:
+        command_id = 3
+        stream = None
+
+        def get_frame(self):
+            return core.framing.encode_frame(self.command_id, 0, self.blob)
+    message = Message()
+    message.blob = blob
+    frame = compressor.encode(message)
+    assert len(frame) < len(blob)
+    assert [(item.command_id, item.flags, item.payload) for item in decoder.feed(frame)] == [(3, 0, blob)]
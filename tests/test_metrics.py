@@ -0,0 +1,58 @@
+import pytest
+
+import core.metrics
+
+
+def test_labels_and_defaults():
+    registry = core.metrics.Registry()
+    sent = core.metrics.Counter('test_sent', 'Sent.', ('direction',), registry=registry)
+    sent.labels('in').inc(3)
+    sent.labels('out').inc()
+    assert sent.labels('in') is sent.labels('in')
+    with pytest.raises(ValueError):
+        sent.labels('in', 'out')
+    open_ = core.metrics.Gauge('test_open', 'Open.', registry=registry)
+    open_.inc(5)
+    open_.dec(2)
+    with pytest.raises(ValueError):
+        core.metrics.Gauge('test_open', 'Open again.', registry=registry)
+    snapshot = registry.snapshot()
+    assert snapshot['onionchat_test_sent_total']['samples'] == [
+        {'labels': {'direction': 'in'}, 'value': 3}, {'labels': {'direction': 'out'}, 'value': 1}]
+    assert snapshot['onionchat_test_open']['samples'] == [{'labels': {}, 'value': 3}]
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = core.metrics.Registry()
+    seconds = core.metrics.Histogram('test_seconds', 'Seconds.', (1, 0.5), registry=registry)
+    for value in (0.1, 0.5, 0.7, 2):
+        seconds.observe(value)
+    assert registry.snapshot()['onionchat_test_seconds']['samples'][0]['value'] == {
+        'buckets': {'0.5': 2, '1': 3, '+Inf': 4}, 'sum': 3.3, 'count': 4}
+
+
+def test_render():
+    registry = core.metrics.Registry()
+    sent = core.metrics.Counter('test_sent', 'Sent.', ('direction',), registry=registry)
+    sent.labels('in "x"').inc(2)
+    seconds = core.metrics.Histogram('test_seconds', 'Seconds.', (0.5,), registry=registry)
+    seconds.observe(0.25)
+    registry.add_collector(lambda: core.metrics.single('test_ratio', 'gauge', 'Ratio.', 0.75))
+    assert core.metrics.render(registry.snapshot()) == (
+        '# HELP onionchat_test_ratio Ratio.\n'
+        '# TYPE onionchat_test_ratio gauge\n'
+        'onionchat_test_ratio 0.75\n'
+        '# HELP onionchat_test_seconds Seconds.\n'
+        '# TYPE onionchat_test_seconds histogram\n'
+        'onionchat_test_seconds_bucket{le="0.5"} 1\n'
+        'onionchat_test_seconds_bucket{le="+Inf"} 1\n'
+        'onionchat_test_seconds_sum 0.25\n'
+        'onionchat_test_seconds_count 1\n'
+        '# HELP onionchat_test_sent_total Sent.\n'
+        '# TYPE onionchat_test_sent_total counter\n'
+        'onionchat_test_sent_total{direction="in \\"x\\""} 2\n')
+
+
+def test_metric_is_abstract():
+    with pytest.raises(TypeError):
+        core.metrics.Metric('test_abstract', 'Abstract.', registry=core.metrics.Registry())
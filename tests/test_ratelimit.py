@@ -0,0 +1,125 @@
+import socket
+import time
+
+import pytest
+
+import core.ratelimit
+import core.transport
+from tests.helpers import in_loop
+
+
+@pytest.fixture(autouse=True)
+def buckets(monkeypatch):
+    monkeypatch.setattr(core.ratelimit, 'global_lines', None)
+    monkeypatch.setattr(core.ratelimit, 'global_bytes', None)
+    monkeypatch.setattr(core.ratelimit, 'unauthenticated_lines', None)
+    monkeypatch.setattr(core.ratelimit, 'unauthenticated_bytes', None)
+
+
+def test_burst_is_at_least_one_token():
+    bucket = core.ratelimit.TokenBucket(0.5)
+    assert bucket.burst == 1
+    assert bucket.consume()
+    assert not bucket.consume()
+
+
+def test_lines_above_the_limit_are_delayed_not_dropped(ini):
+    ini['limits']['connection_lines_per_sec'] = 10
+    limiter = core.ratelimit.TrafficLimiter()
+    before = core.ratelimit.get_stats()['throttled_lines']
+    delays = [limiter.delay_for_line() for _ in range(12)]
+    assert delays[:10] == [0] * 10
+    assert 0 < delays[10] < delays[11] <= 0.21
+    assert core.ratelimit.get_stats()['throttled_lines'] == before + 2
+
+
+def test_a_flooding_connection_does_not_starve_the_buddies(ini):
+    ini['limits']['connection_lines_per_sec'] = 10
+    ini['limits']['global_lines_per_sec'] = 20
+    flooding, buddy = core.ratelimit.TrafficLimiter(), core.ratelimit.TrafficLimiter()
+    for number in range(1000):
+        flooding.delay_for_line()
+        if not number % 100:
+            # the buddy sends a line now and then while the flood goes on
+            assert buddy.delay_for_line() < 0.1
+    assert flooding.delay_for_line() > 50  # the flood waits for its own debt
+
+
+def test_strangers_have_limits_of_their_own(ini):
+    ini['limits']['unauthenticated_lines_per_sec'] = 5
+    ini['limits']['global_lines_per_sec'] = 5
+    strangers = [core.ratelimit.TrafficLimiter(authenticated=False) for _ in range(10)]
+    for stranger in strangers:
+        stranger.delay_for_line()
+    assert strangers[0].delay_for_line() > 0
+    buddy = core.ratelimit.TrafficLimiter()
+    assert buddy.delay_for_line() == 0
+    strangers[0].authenticate()
+    assert strangers[0].global_lines is buddy.global_lines
+
+
+def test_may_accept(ini):
+    ini['limits']['max_unauthenticated_connections'] = 2
+    assert core.ratelimit.may_accept(1)
+    assert not core.ratelimit.may_accept(2)
+
+
+class BuddyList:
+    def onAuthenticated(self, conn):
+        pass
+
+    def onErrorIn(self, conn):
+        pass
+
+
+class Buddy:
+    address = 'buddy'
+    conn_in = None
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_listener_counts_unauthenticated_connections(ini):
+    ini['limits']['max_unauthenticated_connections'] = 2
+    loop = core.transport.get_event_loop()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    listener = core.transport.Listener(BuddyList(), sock, loop)
+    port = sock.getsockname()[1]
+    clients = [socket.create_connection(('127.0.0.1', port)) for _ in range(2)]
+    try:
+        wait_for(lambda: len(listener.conns) == 2)
+        assert listener.unauthenticated == 2
+        rejected = socket.create_connection(('127.0.0.1', port))
+        assert rejected.recv(1) == b''  # closed at once
+        rejected.close()
+
+        conn = next(iter(listener.conns))
+        buddy = Buddy()
+        loop.submit(in_loop(conn.authenticate, buddy)).result()
+        assert listener.unauthenticated == 1 and buddy.conn_in is conn
+        clients.append(socket.create_connection(('127.0.0.1', port)))
+        wait_for(lambda: len(listener.conns) == 3)
+
+        for client in clients:
+            client.close()
+        wait_for(lambda: not listener.conns)
+        assert listener.unauthenticated == 0
+    finally:
+        listener.close()
+
+
+def test_listener_is_not_created_in_the_event_loop():
+    loop = core.transport.get_event_loop()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    try:
+        with pytest.raises(RuntimeError):
+            loop.submit(in_loop(core.transport.Listener, BuddyList(), sock, loop)).result(timeout=5)
+    finally:
+        sock.close()
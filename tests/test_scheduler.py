@@ -0,0 +1,73 @@
+import core.scheduler
+
+
+def wake():
+    pass
+
+
+def test_lines_go_before_file_data():
+    lines = core.scheduler.LineScheduler(core.scheduler.UploadLimiter(0))
+    lines.add(b'block 1\n', 'file')
+    lines.add(b'message 1\n')
+    lines.add(b'message 2\n')
+    assert lines.take(65536, wake)[0] == b'message 1\nmessage 2\n'
+    lines.add(b'block 2\n', 'file')
+    lines.add(b'message 3\n')
+    assert lines.take(65536, wake)[0] == b'message 3\n'
+    # file data one block at a time
+    assert lines.take(65536, wake)[0] == b'block 1\n'
+    assert lines.take(65536, wake)[0] == b'block 2\n'
+    assert lines.take(65536, wake) == (None, None, [])
+
+
+def test_batches_are_bounded():
+    lines = core.scheduler.LineScheduler(core.scheduler.UploadLimiter(0))
+    for _ in range(3):
+        lines.add(b'x' * 9 + b'\n')
+    assert len(lines.take(25, wake)[0]) == 20
+    assert len(lines.take(25, wake)[0]) == 10
+
+
+def test_streams_take_turns():
+    lines = core.scheduler.LineScheduler(core.scheduler.UploadLimiter(0))
+    for block in range(3):
+        lines.add(b'a%d' % block, 'a')
+        lines.add(b'b%d' % block, 'b')
+    lines.add(b'c0', 'c')
+    sent = [lines.take(65536, wake)[0] for _ in range(7)]
+    assert sent == [b'a0', b'b0', b'c0', b'a1', b'b1', b'a2', b'b2']
+    assert not len(lines)
+
+
+def test_upload_limit_is_shared_fairly():
+    limiter = core.scheduler.UploadLimiter(1000)
+    limiter.bucket.tokens = 0
+    woken = []
+    # both transfers wait, the first one in the queue is told how long
+    wait, _ = limiter.request('a', 500, wake)
+    assert 0 < wait <= 0.5
+    assert limiter.request('b', 500, lambda: woken.append('b')) == (None, [])
+    limiter.bucket.tokens = 500
+    wait, wakers = limiter.request('a', 500, wake)
+    assert wait == 0
+    for waker in wakers:
+        waker()
+    assert woken == ['b']
+    # a's next block finishes after b's waiting one
+    limiter.bucket.tokens = 500
+    assert limiter.request('a', 500, wake) == (None, [])
+    assert limiter.request('b', 500, wake)[0] == 0
+
+
+def test_discard_wakes_the_next_stream():
+    limiter = core.scheduler.UploadLimiter(1000)
+    limiter.bucket.tokens = 0
+    lines = core.scheduler.LineScheduler(limiter)
+    woken = []
+    lines.add(b'x' * 100, 'a')
+    lines.add(b'y' * 100, 'b')
+    lines.take(65536, lambda: woken.append(True))
+    for waker in lines.discard('a'):
+        waker()
+    assert woken == [True]
+    assert lines.discard('unknown') == []
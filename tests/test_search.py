@@ -0,0 +1,97 @@
+import pytest
+
+import core.contacts
+import core.search
+import core.storage
+
+
+def test_store_sync_flushes_the_journal(tmp_path):
+    store = core.storage.MessageStore(tmp_path)
+    index = core.search.SearchIndex(tmp_path / 'search')
+    store.add_sync_callback(index.flush)
+    index.add('buddy', store.append('buddy', 'hello world'), 'hello world')
+    assert (tmp_path / 'search' / 'search.journal').stat().st_size == 0
+    store.sync()
+    assert (tmp_path / 'search' / 'search.journal').stat().st_size > 0
+    store.close()
+    index.close()
+
+
+def test_large_journal_is_replaced_by_a_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(core.search, 'JOURNAL_MAX_SIZE', 1000)
+    index = core.search.SearchIndex(tmp_path)
+    for number in range(100):
+        index.add('buddy', number, f'message number {number}')
+    index.flush()
+    assert (tmp_path / 'search.idx').exists()
+    assert (tmp_path / 'search.journal').stat().st_size == 0
+    index.journal.close()
+    index.journal = None  # a crash, nothing saved on close
+
+    loaded = core.search.SearchIndex(tmp_path)
+    assert len(loaded) == 100
+    assert loaded.search('number 42') == [('buddy', 42)]
+    assert loaded.last_numbers() == {'buddy': 100}
+    loaded.close()
+
+
+def test_profile_rebuilds_an_index_that_misses_messages(tmp_path):
+    profile = core.contacts.Profile()
+    profile.open(tmp_path)
+    for number in range(5):
+        profile.add_message('buddy', f'message {number}')
+    profile.message_store.sync()
+    # a crash after the messages reached the disk but before the index did
+    journal = tmp_path / 'search' / 'search.journal'
+    lines = journal.read_text().splitlines(keepends=True)
+    profile.search_index.journal.close()
+    profile.search_index.journal = None
+    profile.message_store.close()
+    journal.write_text(''.join(lines[:3]))
+
+    reopened = core.contacts.Profile()
+    reopened.open(tmp_path)
+    assert len(reopened.search_index) == 5
+    assert [number for _, number, _ in reopened.search_messages('message')] == [4, 3, 2, 1, 0]
+    reopened.close()
+
+
+def test_close_twice_and_in_memory(tmp_path):
+    core.search.SearchIndex().close()
+    index = core.search.SearchIndex(tmp_path)
+    index.add('buddy', 0, 'hello')
+    index.close()
+    index.close()
+    reloaded = core.search.SearchIndex(tmp_path)
+    assert reloaded.search('hello') == [('buddy', 0)]
+    reloaded.close()
+
+
+def test_interrupted_save_keeps_the_journal(tmp_path, monkeypatch):
+    index = core.search.SearchIndex(tmp_path)
+    for number in range(3):
+        index.add('buddy', number, f'message {number}')
+    index.flush()
+
+    def crash(*args, **kwargs):
+        raise OSError('disk full')
+    with monkeypatch.context() as patch:
+        patch.setattr(core.search.pickle, 'dump', crash)
+        with pytest.raises(OSError):
+            index.save()
+        index.add('buddy', 3, 'message 3')
+        with pytest.raises(OSError):
+            index.save()
+    index.add('buddy', 4, 'message 4')
+    index.flush()
+    index.journal.close()
+    index.journal = None  # a crash
+
+    loaded = core.search.SearchIndex(tmp_path)
+    assert [number for _, number in loaded.search('message')] == [4, 3, 2, 1, 0]
+    loaded.save()
+    assert not (tmp_path / 'search.journal.old').exists()
+    loaded.close()
+    reloaded = core.search.SearchIndex(tmp_path)
+    assert len(reloaded) == 5
+    reloaded.close()
@@ -0,0 +1,99 @@
+import os
+import time
+
+import pytest
+
+import core.storage
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = core.storage.MessageStore(tmp_path)
+    yield store
+    store.close()
+
+
+@pytest.mark.parametrize('buddy_id', ['', '.', '..', '../x', 'a/b', 'a\\b', 'x' * 129, None])
+def test_invalid_buddy_ids_are_rejected(store, tmp_path, buddy_id):
+    with pytest.raises(ValueError):
+        store.append(buddy_id, 'hello')
+    with pytest.raises(ValueError):
+        store.read(buddy_id, 0, 10)
+    assert not (tmp_path / 'messages').exists()
+
+
+def test_reading_creates_nothing(store, tmp_path):
+    assert store.count('nobody') == 0
+    assert store.base('nobody') == 0
+    assert store.read('nobody', 0, 10) == []
+    assert not (tmp_path / 'messages' / 'nobody').exists()
+    assert store.buddy_ids() == []
+
+
+def fill(store, count: int):
+    for i in range(count):
+        store.append('buddy', f'message {i}')
+    store.sync()
+
+
+def test_compaction_keeps_the_numbers(tmp_path, store, monkeypatch):
+    monkeypatch.setattr(core.storage, 'SEGMENT_SIZE', 256)
+    fill(store, 40)
+    store.conversation('buddy').compact(10)
+    assert store.base('buddy') == 30
+    assert store.read('buddy', 0, 100) == [f'message {i}' for i in range(30, 40)]
+    store.close()
+    reopened = core.storage.MessageStore(tmp_path)
+    assert (reopened.base('buddy'), reopened.count('buddy')) == (30, 40)
+    assert reopened.read('buddy', 35, 1) == ['message 35']
+    reopened.close()
+
+
+def crash_during_compaction(store, tmp_path, commit: bool):
+    """Prepares a compaction to 30 of 40 messages like compact() does and stops."""
+    path = tmp_path / 'messages' / 'buddy'
+    with open(path / 'index', 'rb') as file:
+        remaining = file.read()[30 * core.storage.INDEX_ENTRY.size:]
+    core.storage.write_atomic(path / 'index.new', remaining)
+    if commit:
+        core.storage.write_atomic(path / 'compacting', b'30')
+    store.close()
+    return path
+
+
+@pytest.mark.parametrize('commit, base', [(False, 0), (True, 30)])
+def test_interrupted_compaction(tmp_path, store, commit, base):
+    fill(store, 40)
+    path = crash_during_compaction(store, tmp_path, commit)
+    reopened = core.storage.MessageStore(tmp_path)
+    assert (reopened.base('buddy'), reopened.count('buddy')) == (base, 40)
+    assert reopened.read('buddy', 35, 2) == ['message 35', 'message 36']
+    assert not (path / 'index.new').exists() and not (path / 'compacting').exists()
+    reopened.close()
+
+
+def test_damaged_record_is_reported(tmp_path, store):
+    fill(store, 3)
+    path = tmp_path / 'messages' / 'buddy' / '00000000.log'
+    offset = core.storage.RECORD_HEADER.size + len('message 0') + core.storage.RECORD_HEADER.size
+    with open(path, 'r+b') as file:
+        file.seek(offset)
+        file.write(b'X')
+    with pytest.raises(core.storage.StorageError):
+        store.read('buddy', 0, 3)
+    assert store.read('buddy', 2, 1) == ['message 2']
+    assert os.path.getsize(path) > offset
+
+
+def test_only_dirty_stores_are_synced(store, monkeypatch):
+    monkeypatch.setattr(core.storage, 'SYNC_INTERVAL', 0.05)
+    synced = []
+    store.add_sync_callback(lambda: synced.append(store.pending))
+    store.append('buddy', 'hello')
+    deadline = time.monotonic() + 5
+    while not synced:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert synced == [0] and not store.syncer.dirty
+    time.sleep(0.2)
+    assert len(synced) == 1  # nothing to sync, the syncer sleeps
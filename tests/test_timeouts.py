@@ -0,0 +1,39 @@
+import core.timeouts
+
+
+class Conn:
+    def __init__(self, last_active: float):
+        self.last_active = last_active
+        self.started = True
+
+
+def test_idle_connections_expire_at_their_deadline():
+    expired = []
+    reaper = core.timeouts.IdleReaper(10, expired.append)
+    first, second = Conn(100), Conn(105)
+    reaper.add(first)
+    reaper.add(second)
+    assert reaper.expire(109) == 110 and expired == []
+    assert reaper.expire(110) == 115 and expired == [first]
+    assert reaper.expire(115) is None and expired == [first, second]
+    assert not len(reaper)
+
+
+def test_activity_moves_the_deadline():
+    expired = []
+    reaper = core.timeouts.IdleReaper(10, expired.append)
+    conn = Conn(100)
+    reaper.add(conn)
+    conn.last_active = 108
+    # pushed again with the new deadline instead of expiring
+    assert reaper.expire(110) == 118 and expired == []
+    assert reaper.expire(118) is None and expired == [conn]
+
+
+def test_closed_connections_are_forgotten():
+    expired = []
+    reaper = core.timeouts.IdleReaper(10, expired.append)
+    conn = Conn(100)
+    reaper.add(conn)
+    conn.started = False
+    assert reaper.expire(200) is None and expired == []
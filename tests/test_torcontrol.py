@@ -0,0 +1,165 @@
+"""TorController against the fake control port of the benchmarks."""
+import os
+import socket
+import threading
+
+import pytest
+
+import config
+import core.torcontrol
+from benchmarks.fake_tor_control import FakeTorControl
+
+
+@pytest.fixture
+def start(tmp_path):
+    servers, controllers = [], []
+
+    def start(auth: str = 'null', connect: bool = True, **options):
+        """Starts a fake Tor, by default with a controller connected to it."""
+        server = FakeTorControl(auth, tmp_path, bootstrap_time=0.1, descriptor_time=0.05, **options)
+        server.start()
+        servers.append(server)
+        config.ini['tor']['control_port'] = server.port
+        controller = core.torcontrol.TorController('127.0.0.1', server.port, timeout=5)
+        controllers.append(controller)
+        connect_when_open(controller)
+        if not connect:
+            controller.close()
+        return server, controller
+
+    yield start
+    for controller in controllers:
+        controller.close()
+    for server in servers:
+        server.stop()
+
+
+def connect_when_open(controller: core.torcontrol.TorController):
+    # the fake opens its port in a thread of its own
+    for _ in range(100):
+        try:
+            controller.connect()
+            return
+        except core.torcontrol.ControlError:
+            threading.Event().wait(0.01)
+    controller.connect()
+
+
+@pytest.mark.parametrize('auth', ['null', 'cookie', 'safecookie'])
+def test_authentication(start, auth):
+    server, controller = start(auth)
+    controller.authenticate()
+    assert controller.get_info('status/bootstrap-phase').startswith('NOTICE BOOTSTRAP')
+    assert server.clients[-1].authenticated
+
+
+def test_password_authentication(start):
+    server, controller = start('password', password='secret "password"')
+    controller.authenticate('secret "password"')
+    assert server.clients[-1].authenticated
+
+
+def test_wrong_password(start):
+    _, controller = start('password', password='secret')
+    with pytest.raises(core.torcontrol.ControlError, match='515'):
+        controller.authenticate('guess')
+
+
+def test_no_usable_method(start):
+    _, controller = start('password', password='secret')
+    with pytest.raises(core.torcontrol.ControlError, match='no usable authentication method'):
+        controller.authenticate()
+
+
+def test_safecookie_server_hash_is_checked(start):
+    server, controller = start('safecookie', server_cookie=os.urandom(32))
+    with pytest.raises(core.torcontrol.ControlError, match='does not know our cookie'):
+        controller.authenticate()
+    assert not server.clients[-1].authenticated
+
+
+def test_add_onion_without_and_with_key(start):
+    server, controller = start()
+    controller.authenticate()
+    service_id, key = controller.add_onion({11009: '127.0.0.1:11009'})
+    assert len(service_id) == 56 and key.startswith('ED25519-V3:')
+    controller.del_onion(service_id)
+
+    again, no_key = controller.add_onion({11009: '127.0.0.1:11009'}, key)
+    assert again == service_id and no_key is None
+    assert service_id in server.services
+
+
+def test_bad_key_is_an_error(start):
+    _, controller = start()
+    controller.authenticate()
+    with pytest.raises(core.torcontrol.ControlError, match='513'):
+        controller.add_onion({11009: '127.0.0.1:11009'}, 'RSA1024:abc')
+
+
+def test_events(start):
+    _, controller = start()
+    statuses = []
+    controller.subscribe('STATUS_CLIENT', lambda text, data: statuses.append(text))
+    controller.authenticate()
+    controller.set_events()
+    service_id, _ = controller.add_onion({11009: '127.0.0.1:11009'})
+    assert controller.wait_bootstrapped(5)
+    assert controller.bootstrap_progress == 100
+    assert controller.wait_published(service_id, 5)
+    assert any('PROGRESS=100' in status for status in statuses)
+    assert any('CIRCUIT_ESTABLISHED' in status for status in statuses)
+
+
+def test_start_onion_service_saves_a_new_key(start, tmp_path):
+    start(connect=False)
+    controller, service_id = core.torcontrol.start_onion_service('tor', tmp_path)
+    try:
+        key = core.torcontrol.load_onion_key(tmp_path)
+        assert key.startswith('ED25519-V3:')
+    finally:
+        controller.close()
+    # the same address the next time
+    controller, again = core.torcontrol.start_onion_service('tor', tmp_path)
+    controller.close()
+    assert again == service_id
+
+
+def test_collision_falls_back_to_the_torrc_service(start, tmp_path):
+    _, other = start()
+    other.authenticate()
+    # the HiddenServiceDir of torrc has the service with our key already
+    service_id, key = other.add_onion({11009: '127.0.0.1:11009'})
+    core.torcontrol.save_onion_key(tmp_path, key)
+    with pytest.raises(core.torcontrol.ControlError, match='collision'):
+        core.torcontrol.start_onion_service('tor', tmp_path)
+
+    (tmp_path / 'hidden_service').mkdir()
+    (tmp_path / 'hidden_service' / 'hostname').write_text(service_id + '.onion\n')
+    controller, fallback = core.torcontrol.start_onion_service('tor', tmp_path)
+    try:
+        assert fallback == service_id
+        assert service_id in controller.published
+    finally:
+        controller.close()
+
+
+def test_command_timeout():
+    with socket.create_server(('127.0.0.1', 0)) as server:
+        controller = core.torcontrol.TorController('127.0.0.1', server.getsockname()[1], timeout=0.2)
+        controller.connect()
+        silent, _ = server.accept()
+        with pytest.raises(core.torcontrol.ControlError, match='no reply'):
+            controller.command('PROTOCOLINFO 1')
+        assert not controller.running
+        with pytest.raises(core.torcontrol.ControlError, match='not connected'):
+            controller.command('PROTOCOLINFO 1')
+        silent.close()
+
+
+def test_lost_connection_wakes_up_the_command(start):
+    server, controller = start()
+    controller.authenticate()
+    server.stop()
+    with pytest.raises(core.torcontrol.ControlError):
+        controller.command('GETINFO status/bootstrap-phase')
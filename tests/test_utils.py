@@ -0,0 +1,13 @@
+import core.utils
+from tests.helpers import make_address
+
+
+def test_validate_addresses_caches_the_valid_ones():
+    known, new = make_address(), make_address()
+    assert core.utils.is_valid_address(known)
+    fake = 'a' * 56
+    assert core.utils.validate_addresses([known, new, fake, new]) == {known: True, new: True, fake: False}
+    assert new in core.utils.valid_address_cache
+    assert fake not in core.utils.valid_address_cache
+    # the most recently checked addresses are evicted last
+    assert list(core.utils.valid_address_cache)[-2:] == [known, new]